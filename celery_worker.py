@@ -1,4 +1,15 @@
+import sys
+
 from app.core.celery_app import celery_app
 
 if __name__ == "__main__":
-    celery_app.worker_main()
+    if len(sys.argv) > 1 and sys.argv[1] == "asyncio":
+        # Asyncio consumer: hundreds of concurrent Gemini calls per process
+        from app.services.gemini_consumer import main
+        main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "relay":
+        # Outbox relay: publishes tasks committed by the API to the broker
+        from app.services.outbox import main
+        main(sys.argv[2:])
+    else:
+        celery_app.worker_main()
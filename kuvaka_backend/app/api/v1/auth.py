@@ -9,6 +9,7 @@ from app.models.user import User
 from app.db.session import get_db
 from app.services import otp
 from app.core import security
+from app.core.password_hasher import password_hasher
 from datetime import datetime
 from typing import Optional
 
@@ -23,7 +24,7 @@ async def signup(data: SignupRequest, db: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=400, detail="User already exists")
     new_user = User(
         mobile_number=data.mobile_number,
-        hashed_password=security.get_password_hash(data.password) if data.password else None
+        hashed_password=await password_hasher.hash(data.password) if data.password else None
     )
     db.add(new_user)
     await db.commit()
@@ -72,16 +73,14 @@ async def forgot_password(data: ForgotPasswordRequest, db: AsyncSession = Depend
 async def change_password(
     data: ChangePasswordRequest,
     db: AsyncSession = Depends(get_db),
-    token: str = Depends(security.oauth2_scheme)
+    user_id: int = Depends(security.get_current_user_id)
 ):
-    payload = security.verify_access_token(token)
-    user_id = int(payload["sub"])
     q = await db.execute(select(User).where(User.id == user_id))
     user = q.scalar_one_or_none()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if not security.verify_password(data.old_password, user.hashed_password):
+    if not await password_hasher.verify(data.old_password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect old password")
-    user.hashed_password = security.get_password_hash(data.new_password)
+    user.hashed_password = await password_hasher.hash(data.new_password)
     await db.commit()
     return {"message": "Password changed successfully"}
@@ -1,84 +1,65 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from app.db.session import get_db
 from app.models.chatroom import Chatroom
-from app.models.message import Message
-from app.models.user import User
-from app.schemas.chatroom import ChatroomCreate, ChatroomResponse, MessageCreate, MessageResponse
-from app.core import security
-from typing import List
+from app.models.message import Message, MessageStatus
+from app.schemas.auth import JWTUser
+from app.schemas.chatroom import (
+    ChatroomCreate, ChatroomResponse, ChatroomUpdate, MessageBatchCreate, MessageBatchResponse, MessageCreate,
+    MessageResponse, MessagePage,
+)
+from app.core import chatroom_cache, quota, security
+from app.core.pagination import encode_cursor, decode_cursor
+from sqlalchemy import insert, tuple_
+from typing import List, Optional
+from collections import namedtuple
+import orjson
 from datetime import datetime, timedelta
 
 router = APIRouter()
 
 # POST /chatroom - create a new chatroom
-def get_current_user(token: str = Depends(security.oauth2_scheme), db: AsyncSession = Depends(get_db)):
-    payload = security.verify_access_token(token)
-    user_id = int(payload["sub"])
-    return user_id
-
 @router.post("/chatroom", response_model=ChatroomResponse)
 async def create_chatroom(
     data: ChatroomCreate,
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
-    chatroom = Chatroom(user_id=user_id, name=data.name)
+    chatroom = Chatroom(user_id=user_id, name=data.name, cache_responses=data.cache_responses)
     db.add(chatroom)
     await db.commit()
     await db.refresh(chatroom)
-    # Invalidate chatroom cache for this user
-    cache_key = f"chatrooms:{user_id}"
-    await redis_client.delete(cache_key)
+    # Write the new chatroom through to this user's cached list
+    await chatroom_cache.upsert_chatroom(chatroom)
     return ChatroomResponse(
         id=chatroom.id,
         user_id=chatroom.user_id,
         name=chatroom.name,
+        cache_responses=chatroom.cache_responses,
         created_at=chatroom.created_at,
         updated_at=chatroom.updated_at,
         messages=[]
     )
 
-# GET /chatroom - list all chatrooms for user
-from app.core.redis import redis_client
+# GET /chatroom - list all chatrooms for user, most recently active first
 import json
 
 @router.get("/chatroom", response_model=List[ChatroomResponse])
 async def list_chatrooms(
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
-    cache_key = f"chatrooms:{user_id}"
-    cached = await redis_client.get(cache_key)
-    if cached:
-        return [ChatroomResponse(**item) for item in json.loads(cached)]
-    result = await db.execute(select(Chatroom).where(Chatroom.user_id == user_id))
-    chatrooms = result.scalars().all()
-    from datetime import datetime
-    def serialize_chatroom(chat):
-        d = ChatroomResponse(
-            id=chat.id,
-            user_id=chat.user_id,
-            name=chat.name,
-            created_at=chat.created_at,
-            updated_at=chat.updated_at,
-            messages=[]
-        ).dict()
-        # Convert datetime fields to isoformat
-        d['created_at'] = d['created_at'].isoformat() if isinstance(d['created_at'], datetime) else d['created_at']
-        d['updated_at'] = d['updated_at'].isoformat() if isinstance(d['updated_at'], datetime) else d['updated_at']
-        return d
-    data = [serialize_chatroom(chat) for chat in chatrooms]
-    await redis_client.set(cache_key, json.dumps(data), ex=30)
-    return [ChatroomResponse(**item) for item in data]
+    entries = await chatroom_cache.get_or_load(db, user_id)
+    # Cached entries are already JSON; response_model only documents the shape
+    return Response(chatroom_cache.list_payload(entries), media_type="application/json")
 
 # GET /chatroom/{id} - get chatroom details
 @router.get("/chatroom/{id}", response_model=ChatroomResponse)
 async def get_chatroom(
     id: int,
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
     chatroom = await db.get(Chatroom, id)
     if not chatroom or chatroom.user_id != user_id:
@@ -87,88 +68,378 @@ async def get_chatroom(
         id=chatroom.id,
         user_id=chatroom.user_id,
         name=chatroom.name,
+        cache_responses=chatroom.cache_responses,
         created_at=chatroom.created_at,
         updated_at=chatroom.updated_at,
         messages=[]
     )
 
-# POST /chatroom/{id}/message - send message (Gemini async integration to be added)
-from app.services.gemini import process_gemini_message
-
-from sqlalchemy.future import select
-from app.models.user import User
-
-@router.post("/chatroom/{id}/message", response_model=MessageResponse)
-async def send_message(
+# PATCH /chatroom/{id} - rename a chatroom or opt it out of the response cache
+@router.patch("/chatroom/{id}", response_model=ChatroomResponse)
+async def update_chatroom(
     id: int,
-    data: MessageCreate,
+    data: ChatroomUpdate,
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
     chatroom = await db.get(Chatroom, id)
     if not chatroom or chatroom.user_id != user_id:
         raise HTTPException(status_code=404, detail="Chatroom not found")
-    # Rate limit for Basic users
-    user = await db.get(User, user_id)
-    if not user.is_pro:
-        today = datetime.utcnow().date()
-        tomorrow = today + timedelta(days=1)
-        result = await db.execute(
-            select(Message).where(
-                Message.user_id == user_id,
-                Message.created_at >= datetime.combine(today, datetime.min.time()),
-                Message.created_at < datetime.combine(tomorrow, datetime.min.time())
-            )
+    if data.name is not None:
+        chatroom.name = data.name
+    if data.cache_responses is not None:
+        chatroom.cache_responses = data.cache_responses
+    await db.commit()
+    await db.refresh(chatroom)
+    await chatroom_cache.upsert_chatroom(chatroom)
+    return ChatroomResponse(
+        id=chatroom.id,
+        user_id=chatroom.user_id,
+        name=chatroom.name,
+        cache_responses=chatroom.cache_responses,
+        created_at=chatroom.created_at,
+        updated_at=chatroom.updated_at,
+        messages=[]
+    )
+
+# POST /chatroom/{id}/message - send message (Gemini async integration to be added)
+from app.services.gemini import (
+    GEMINI_API_KEY, api_gemini, get_api_client, stream_gemini_api
+)
+from app.services.gemini_client import GEMINI_STREAM_SLOT_WAIT, GeminiRetryableError
+from app.db.session import AsyncSessionLocal
+from app.core.notifications import publish_message_completed, subscribe, user_channel, wait_for_completion
+from app.core.redis import redis_client
+from app.services import archive, context, outbox
+from app.services.outbox import OUTBOX_STREAM_DELAY
+from app.services.response_cache import RESPONSE_CACHE_ENABLED, cache_scope, chatroom_opted_in, response_cache
+from fastapi.responses import StreamingResponse
+import asyncio
+import logging
+import os
+import time
+
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv("MESSAGE_BATCH_MAX_SIZE", "100"))
+# A stream, slot wait included, has to end before its held-back task is released to the worker
+GEMINI_STREAM_DEADLINE = min(float(os.getenv("GEMINI_STREAM_DEADLINE", "90")), OUTBOX_STREAM_DELAY * 0.75)
+
+async def _create_message(
+    db: AsyncSession, chatroom_id: int, user: JWTUser, content: str, outbox_delay: float = None
+):
+    user_id = user.id
+    chatroom = await db.get(Chatroom, chatroom_id)
+    if not chatroom or chatroom.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Chatroom not found")
+    # Daily limit per tier (Basic: 10/day by default)
+    usage = await quota.consume(db, user_id, quota.tier_for(user.is_pro))
+    if usage is not None and usage.granted < 1:
+        raise HTTPException(
+            status_code=429,
+            detail="Daily message limit reached. Upgrade to Pro for unlimited access.",
+            headers=usage.headers()
         )
-        count_today = len(result.scalars().all())
-        if count_today >= 10:
-            raise HTTPException(status_code=429, detail="Daily message limit reached. Upgrade to Pro for unlimited access.")
-    message = Message(chatroom_id=id, user_id=user_id, content=data.content, created_at=datetime.utcnow())
+    message = Message(chatroom_id=chatroom_id, user_id=user_id, content=content, created_at=datetime.utcnow())
     db.add(message)
-    await db.commit()
+    try:
+        # The Gemini task is committed with the message; the outbox relay publishes it
+        await db.flush()
+        event = outbox.add_gemini_task(
+            db, message.id, content, chatroom_id, user_id, quota.tier_for(user.is_pro), outbox_delay
+        )
+        await db.commit()
+    except Exception:
+        if usage is not None:
+            await quota.refund(user_id)
+        raise
     await db.refresh(message)
-    # Invalidate chatroom cache for this user
-    cache_key = f"chatrooms:{user_id}"
-    await redis_client.delete(cache_key)
-    # Enqueue Gemini async task
-    process_gemini_message.delay(message.id, data.content)
+    # Bump message count / activity in the cached chatroom list
+    await chatroom_cache.record_message(user_id, chatroom_id, message.created_at)
+    return message, usage, event.id
+
+@router.post("/chatroom/{id}/message", response_model=MessageResponse)
+async def send_message(
+    id: int,
+    data: MessageCreate,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    user: JWTUser = Depends(security.get_current_user)
+):
+    message, usage, _ = await _create_message(db, id, user, data.content)
+    if usage is not None:
+        response.headers.update(usage.headers())
     return MessageResponse(
         id=message.id,
         user_id=message.user_id,
         content=message.content,
         gemini_response=message.gemini_response,
+        status=message.status,
+        error=message.error,
         created_at=message.created_at
     )
 
-# GET /chatroom/{id}/messages - get all messages in a chatroom
-@router.get("/chatroom/{id}/messages", response_model=List[MessageResponse])
-async def get_chatroom_messages(
+# POST /chatroom/{id}/messages:batch - send many messages at once (one quota check, one INSERT, per-item results)
+@router.post("/chatroom/{id}/messages:batch", response_model=MessageBatchResponse)
+async def send_message_batch(
     id: int,
+    data: MessageBatchCreate,
+    response: Response,
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user: JWTUser = Depends(security.get_current_user)
 ):
+    if not data.messages:
+        raise HTTPException(status_code=400, detail="No messages to send")
+    if len(data.messages) > MESSAGE_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MESSAGE_BATCH_MAX_SIZE} messages per batch")
     chatroom = await db.get(Chatroom, id)
-    if not chatroom or chatroom.user_id != user_id:
+    if not chatroom or chatroom.user_id != user.id:
         raise HTTPException(status_code=404, detail="Chatroom not found")
-    result = await db.execute(select(Message).where(Message.chatroom_id == id))
-    messages = result.scalars().all()
-    return [
-        MessageResponse(
-            id=msg.id,
-            user_id=msg.user_id,
-            content=msg.content,
-            gemini_response=msg.gemini_response,
-            created_at=msg.created_at
+    # Reserve the whole batch at once; a partial grant accepts the first messages in order
+    usage = await quota.consume(db, user.id, quota.tier_for(user.is_pro), amount=len(data.messages))
+    granted = len(data.messages) if usage is None else usage.granted
+    if granted < 1:
+        raise HTTPException(
+            status_code=429,
+            detail="Daily message limit reached. Upgrade to Pro for unlimited access.",
+            headers=usage.headers()
+        )
+    created_at = datetime.utcnow()
+    # PostgreSQL returns rows in parameter order from one multi-row INSERT. SQLite would fall back to a
+    # statement per row for that, but its ids follow the VALUES order, so sort by id instead.
+    in_order = db.bind.dialect.name == "postgresql"
+    try:
+        result = await db.execute(
+            insert(Message).returning(*MESSAGE_COLUMNS, sort_by_parameter_order=in_order),
+            [
+                {"chatroom_id": id, "user_id": user.id, "content": item.content, "created_at": created_at}
+                for item in data.messages[:granted]
+            ],
+        )
+        rows = result.all() if in_order else sorted(result.all(), key=lambda row: row.id)
+        # Gemini tasks go out with the messages through the outbox
+        await outbox.add_gemini_tasks(
+            db, [(row.id, row.content, id) for row in rows], user.id, quota.tier_for(user.is_pro)
         )
-        for msg in messages
+        await db.commit()
+    except Exception:
+        if usage is not None:
+            await quota.refund(user.id, granted)
+        raise
+    await chatroom_cache.record_message(user.id, id, created_at, count=len(rows))
+    if usage is not None:
+        response.headers.update(usage.headers())
+    results = [
+        {"index": index, "status": "queued", "message": dict(zip(MESSAGE_FIELDS, row))}
+        for index, row in enumerate(rows)
     ]
+    results.extend(
+        {"index": index, "status": "rejected", "error": "Daily message limit reached"}
+        for index in range(len(rows), len(data.messages))
+    )
+    return {"accepted": len(rows), "rejected": len(data.messages) - len(rows), "results": results}
+
+# POST /chatroom/{id}/message/stream - send message and stream the Gemini reply (SSE)
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _save_gemini_response(message_id: int, event_id: int, gemini_response: str):
+    async with AsyncSessionLocal() as session:
+        message = await session.get(Message, message_id)
+        # A worker may have answered first if the held-back task was released
+        if message and message.status == MessageStatus.pending:
+            message.gemini_response = gemini_response
+            message.status = MessageStatus.done
+            # The reply is in, so the held-back task goes with the same commit
+            await outbox.discard_event(session, event_id)
+            await session.commit()
+            await context.record_turn(
+                redis_client, message.chatroom_id, message.id, message.content, gemini_response, message.created_at
+            )
+            await publish_message_completed(message)
+
+async def _stream_until(deadline: float, chunks):
+    """Yield from ``chunks`` until the loop clock reaches ``deadline``, then raise ``GeminiRetryableError``."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), deadline - loop.time())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise GeminiRetryableError("Gemini stream ran past GEMINI_STREAM_DEADLINE") from None
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+@router.post("/chatroom/{id}/message/stream")
+async def send_message_stream(
+    id: int,
+    data: MessageCreate,
+    db: AsyncSession = Depends(get_db),
+    user: JWTUser = Depends(security.get_current_user)
+):
+    # The task is always committed with the message. While we stream it is held back, so the worker only
+    # gets it if streaming fails or this process dies; without an API key it is queued straight away.
+    message, usage, event_id = await _create_message(
+        db, id, user, data.content, outbox_delay=OUTBOX_STREAM_DELAY if GEMINI_API_KEY else None
+    )
+    deadline = asyncio.get_running_loop().time() + GEMINI_STREAM_DEADLINE
+    message_id = message.id
+    user_id = user.id
+    contents = None
+    cached = None
+    use_cache = RESPONSE_CACHE_ENABLED and await chatroom_opted_in(db, id)
+    if GEMINI_API_KEY:
+        contents = await context.build_context(redis_client, db, id, message_id, data.content)
+        if use_cache:
+            cached = await response_cache.lookup(redis_client, data.content, cache_scope(id, contents))
+
+    async def events():
+        yield _sse("message", {
+            "id": message_id,
+            "user_id": user_id,
+            "content": message.content,
+            "created_at": message.created_at.isoformat(),
+        })
+        if not GEMINI_API_KEY:
+            yield _sse("queued", {"id": message_id})
+            return
+        if cached is not None:
+            await _save_gemini_response(message_id, event_id, cached)
+            yield _sse("token", {"text": cached})
+            yield _sse("done", {"id": message_id, "gemini_response": cached})
+            return
+        chunks = []
+        finished = False
+        started = time.perf_counter()
+        try:
+            # Breaker open, provider overloaded, no slot free within GEMINI_STREAM_SLOT_WAIT or past
+            # GEMINI_STREAM_DEADLINE: fail fast into the queued path below
+            slot_wait = min(GEMINI_STREAM_SLOT_WAIT, deadline - asyncio.get_running_loop().time())
+            async with api_gemini.guard(slot_wait):
+                reply = stream_gemini_api(data.content, GEMINI_API_KEY, get_api_client(), contents)
+                async for chunk in _stream_until(deadline, reply):
+                    chunks.append(chunk)
+                    yield _sse("token", {"text": chunk})
+            gemini_response = "".join(chunks)
+            await _save_gemini_response(message_id, event_id, gemini_response)
+            if use_cache:
+                await response_cache.store(
+                    redis_client, data.content, gemini_response, time.perf_counter() - started,
+                    cache_scope(id, contents),
+                )
+            finished = True
+            yield _sse("done", {"id": message_id, "gemini_response": gemini_response})
+        except Exception:
+            logging.exception("Streaming Gemini reply failed for message %s", message_id)
+        finally:
+            if not finished:
+                # Streaming failed or the client went away: release the task to the worker now.
+                # Shielded, since a disconnect cancels this generator; if it fails, the delay releases it.
+                await asyncio.shield(outbox.release_event(AsyncSessionLocal, event_id))
+        if not finished:
+            yield _sse("queued", {"id": message_id})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            **(usage.headers() if usage is not None else {}),
+        },
+    )
+
+# GET /chatroom/{id}/messages - page through messages in a chatroom (keyset on created_at, id)
+# Plain column rows: no ORM identity map, and they go straight to orjson
+MESSAGE_COLUMNS = (
+    Message.id, Message.user_id, Message.content, Message.gemini_response,
+    Message.status, Message.error, Message.created_at,
+)
+MESSAGE_FIELDS = tuple(column.key for column in MESSAGE_COLUMNS)
+# Same shape as a row of MESSAGE_COLUMNS, for messages read back from the archive
+ArchivedMessage = namedtuple("ArchivedMessage", MESSAGE_FIELDS)
+
+def message_page_json(messages, next_cursor: Optional[str]) -> bytes:
+    """``MessagePage`` as JSON bytes, without building a model per row."""
+    return orjson.dumps({
+        "messages": [dict(zip(MESSAGE_FIELDS, row)) for row in messages],
+        "next_cursor": next_cursor,
+    })
+
+async def fetch_message_page(
+    db: AsyncSession,
+    chatroom_id: int,
+    limit: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    archived_until: Optional[datetime] = None,
+):
+    """Return (message rows in chronological order, next_cursor).
+
+    Without ``after`` pages go backwards from the newest message (or from
+    ``before``) and ``next_cursor`` points at older history; with ``after``
+    pages go forward and ``next_cursor`` points at newer messages. With
+    ``archived_until`` set, history continues into the chatroom's archive.
+    """
+    key = tuple_(Message.created_at, Message.id)
+    q = select(*MESSAGE_COLUMNS).where(Message.chatroom_id == chatroom_id)
+    cursor = decode_cursor(after or before) if after or before else None
+    if after:
+        messages = []
+        if archived_until is not None and cursor[0] <= archived_until:
+            # Archived messages are older than any live one, so they come first going forward
+            messages = await archived_rows(db, chatroom_id, limit + 1, after=cursor)
+        if len(messages) <= limit:
+            # The bare created_at bound lets PostgreSQL skip partitions; the row comparison alone does not
+            q = q.where(Message.created_at >= cursor[0], key > tuple_(*cursor))
+            q = q.order_by(Message.created_at, Message.id).limit(limit + 1 - len(messages))
+            messages.extend((await db.execute(q)).all())
+    else:
+        if before:
+            q = q.where(Message.created_at <= cursor[0], key < tuple_(*cursor))
+        q = q.order_by(Message.created_at.desc(), Message.id.desc())
+        messages = (await db.execute(q.limit(limit + 1))).all()
+        if len(messages) <= limit and archived_until is not None:
+            # Reached the start of the live history
+            messages.extend(await archived_rows(db, chatroom_id, limit + 1 - len(messages), before=cursor))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
+    next_cursor = None
+    if has_more:
+        edge = messages[-1] if after else messages[0]
+        next_cursor = encode_cursor(edge.created_at, edge.id)
+    return messages, next_cursor
+
+async def archived_rows(db: AsyncSession, chatroom_id: int, limit: int, **cursor):
+    records = await archive.read_page(db, chatroom_id, limit, **cursor)
+    return [ArchivedMessage(*(record[field] for field in MESSAGE_FIELDS)) for record in records]
+
+@router.get("/chatroom/{id}/messages", response_model=MessagePage)
+async def get_chatroom_messages(
+    id: int,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(security.get_current_user_id)
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    chatroom = await db.get(Chatroom, id)
+    if not chatroom or chatroom.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Chatroom not found")
+    messages, next_cursor = await fetch_message_page(db, id, limit, before, after, chatroom.archived_until)
+    return Response(message_page_json(messages, next_cursor), media_type="application/json")
 
 # GET /message/{id} - get a single message by ID
 @router.get("/message/{id}", response_model=MessageResponse)
 async def get_message(
     id: int,
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
     result = await db.execute(select(Message).where(Message.id == id))
     message = result.scalar_one_or_none()
@@ -179,5 +450,43 @@ async def get_message(
         user_id=message.user_id,
         content=message.content,
         gemini_response=message.gemini_response,
+        status=message.status,
+        error=message.error,
         created_at=message.created_at
     )
+
+# GET /message/{id}/wait - long-poll until the Gemini reply lands (Redis pub/sub, no DB polling)
+@router.get("/message/{id}/wait", response_model=MessageResponse)
+async def wait_for_message(
+    id: int,
+    timeout: float = Query(25.0, gt=0, le=60),
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(security.get_current_user_id)
+):
+    # Subscribe before reading so a reply landing in between is not missed
+    pubsub = await subscribe(user_channel(user_id))
+    try:
+        message = await db.get(Message, id)
+        if not message or message.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Message not found")
+        response = MessageResponse(
+            id=message.id,
+            user_id=message.user_id,
+            content=message.content,
+            gemini_response=message.gemini_response,
+            status=message.status,
+            error=message.error,
+            created_at=message.created_at
+        )
+        if response.status != MessageStatus.pending:
+            return response
+        # Give the DB connection back to the pool while we wait
+        await db.close()
+        event = await wait_for_completion(pubsub, id, timeout)
+        if event:
+            response.gemini_response = event["gemini_response"]
+            response.status = event.get("status", MessageStatus.done.value)
+            response.error = event.get("error")
+        return response
+    finally:
+        await pubsub.aclose()
@@ -1,32 +1,86 @@
-from fastapi import APIRouter, Depends
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from app.db.session import get_db
-from app.models.message import Message
-from app.core import security
+from app.models.message import Message, MessageStatus
+from app.core import chatroom_cache, security
+from app.core.redis import redis_client
+from app.services import context
 
 router = APIRouter()
 
-def get_current_user(token: str = Depends(security.oauth2_scheme), db: AsyncSession = Depends(get_db)):
-    payload = security.verify_access_token(token)
-    user_id = int(payload["sub"])
-    return user_id
+PURGE_BATCH_SIZE = int(os.getenv("ADMIN_PURGE_BATCH_SIZE", "1000"))
+
+# Matches the ix_messages_user_not_done partial index predicate
+not_done = Message.status != MessageStatus.done.value
 
 @router.delete("/messages/cleanup")
 async def cleanup_messages(
     db: AsyncSession = Depends(get_db),
-    user_id: int = Depends(get_current_user)
+    user_id: int = Depends(security.get_current_user_id)
 ):
-    # Find messages with null or error gemini_response
-    result = await db.execute(select(Message).where(
-        Message.user_id == user_id,
-        ((Message.gemini_response == None) |
-         (Message.gemini_response.ilike('%[Gemini API Error]%')))
-    ))
-    messages = result.scalars().all()
-    deleted_count = 0
-    for msg in messages:
-        await db.delete(msg)
-        deleted_count += 1
+    # Delete the user's pending and failed messages in one statement
+    result = await db.execute(
+        delete(Message).where(Message.user_id == user_id, not_done).returning(Message.id, Message.chatroom_id)
+    )
+    rows = result.all()
     await db.commit()
-    return {"deleted": deleted_count}
+    if rows:
+        await chatroom_cache.invalidate(user_id)
+        await context.forget(redis_client, (row.chatroom_id for row in rows))
+    return {"deleted": len(rows)}
+
+# DELETE /admin/messages/purge - remove failed (and stale pending) messages for all users, in chunks
+@router.delete("/admin/messages/purge", dependencies=[Depends(security.require_admin)])
+async def purge_messages(
+    batch_size: int = Query(PURGE_BATCH_SIZE, ge=1, le=10000),
+    stale_minutes: int = Query(60, ge=0, description="Pending messages older than this are purged too"),
+    pause_ms: int = Query(0, ge=0, le=10000, description="Sleep between chunks to leave room for live traffic"),
+    user_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    cutoff = datetime.utcnow() - timedelta(minutes=stale_minutes)
+    condition = not_done & (
+        (Message.status == MessageStatus.error.value) | (Message.created_at < cutoff)
+    )
+    if user_id is not None:
+        condition = condition & (Message.user_id == user_id)
+
+    deleted_count = 0
+    batches = 0
+    users = set()
+    chatrooms = set()
+    last_id = 0
+    while True:
+        # Each chunk is its own short transaction; rows a worker is writing right now are skipped
+        chunk = (
+            select(Message.id)
+            .where(condition, Message.id > last_id)
+            .order_by(Message.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        result = await db.execute(
+            delete(Message).where(Message.id.in_(chunk)).returning(Message.id, Message.user_id, Message.chatroom_id)
+        )
+        rows = result.all()
+        await db.commit()
+        if not rows:
+            break
+        deleted_count += len(rows)
+        batches += 1
+        last_id = max(row.id for row in rows)
+        users.update(row.user_id for row in rows)
+        chatrooms.update(row.chatroom_id for row in rows)
+        if pause_ms:
+            await asyncio.sleep(pause_ms / 1000)
+
+    for affected in users:
+        await chatroom_cache.invalidate(affected)
+    await context.forget(redis_client, chatrooms)
+    return {"deleted": deleted_count, "batches": batches, "users": len(users)}
@@ -0,0 +1,32 @@
+import logging
+from fastapi import APIRouter, HTTPException, Response
+from app.core import instrumentation
+from app.core.celery_app import celery_app
+from app.core.redis import redis_client
+from app.db.engine import pool_stats
+from app.db.session import engine
+from app.services.response_cache import get_stats
+
+router = APIRouter()
+
+# GET /metrics/response-cache - hit rate and estimated latency saved by the Gemini response cache
+@router.get("/metrics/response-cache")
+async def response_cache_metrics():
+    return await get_stats(redis_client)
+
+# GET /metrics/pool - connection pool usage of this API process
+@router.get("/metrics/pool")
+async def pool_metrics():
+    return pool_stats(engine)
+
+# GET /metrics - Prometheus text exposition (API process, plus workers in multiprocess mode)
+@router.get("/metrics")
+async def prometheus_metrics():
+    if not instrumentation.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    try:
+        await instrumentation.update_queue_depths(celery_app.conf.broker_url)
+    except Exception:
+        logging.getLogger(__name__).warning("Could not read queue depth from the broker", exc_info=True)
+    body, content_type = instrumentation.render()
+    return Response(content=body, media_type=content_type)
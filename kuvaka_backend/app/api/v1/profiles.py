@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from app.core import profiling, security
+from app.core.redis import redis_client
+
+router = APIRouter(dependencies=[Depends(security.require_admin)])
+
+# GET /admin/profiles - newest stored request/task profiles, without call trees
+@router.get("/admin/profiles")
+async def list_profiles(limit: int = Query(20, ge=1, le=1000), kind: str = None):
+    profiles = await profiling.load_all(redis_client)
+    if kind:
+        profiles = [p for p in profiles if p["kind"] == kind]
+    return {
+        "profiling_enabled": profiling.PROFILING_ENABLED,
+        "skipped": profiling.skipped,
+        "profiles": [{k: v for k, v in p.items() if k not in ("sql", "tree")} for p in profiles[:limit]],
+    }
+
+# GET /admin/profiles/{id} - one profile with its call tree and SQL timings
+@router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    for profile in await profiling.load_all(redis_client):
+        if profile["id"] == profile_id:
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found")
@@ -4,18 +4,14 @@ from sqlalchemy.future import select
 from app.db.session import get_db
 from app.models.user import User
 from app.core import security
+from app.schemas.auth import JWTUser
 from app.services import stripe as stripe_service
 
 router = APIRouter()
 
 # POST /subscribe/pro - Initiate Stripe Checkout
 @router.post("/subscribe/pro")
-async def subscribe_pro(
-    db: AsyncSession = Depends(get_db),
-    token: str = Depends(security.oauth2_scheme)
-):
-    payload = security.verify_access_token(token)
-    user_id = int(payload["sub"])
+async def subscribe_pro(user_id: int = Depends(security.get_current_user_id)):
     url = await stripe_service.create_checkout_session(user_id)
     return {"checkout_url": url}
 
@@ -54,18 +50,11 @@ async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
         if user:
             user.is_pro = True
             await db.commit()
+            # Existing tokens still say is_pro=False; publish the new tier to the auth layer
+            await security.set_user_tier(user_id, True)
     return {"status": "success"}
 
 # GET /subscription/status - Check user subscription tier
 @router.get("/subscription/status")
-async def subscription_status(
-    db: AsyncSession = Depends(get_db),
-    token: str = Depends(security.oauth2_scheme)
-):
-    payload = security.verify_access_token(token)
-    user_id = int(payload["sub"])
-    q = await db.execute(select(User).where(User.id == user_id))
-    user = q.scalar_one_or_none()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def subscription_status(user: JWTUser = Depends(security.get_current_user)):
     return {"tier": "pro" if user.is_pro else "basic"}
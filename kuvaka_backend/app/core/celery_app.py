@@ -1,11 +1,21 @@
 from celery import Celery
+from app.core.instrumentation import instrument_celery
 
 celery_app = Celery(
     "kuvaka_backend",
     broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/0"
+    backend="redis://localhost:6379/0",
+    include=["app.services.gemini"],
 )
 
 celery_app.conf.task_routes = {  # Optional: route tasks by name
     "app.services.gemini.process_gemini_message": {"queue": "gemini"},
 }
+
+# The outbox relay publishes Gemini tasks to a queue per tier (app/services/scheduler.py);
+# "gemini" above still takes tasks sent without a tier
+GEMINI_TIER_QUEUES = {"pro": "gemini.pro", "basic": "gemini.basic"}
+GEMINI_QUEUES = (GEMINI_TIER_QUEUES["pro"], GEMINI_TIER_QUEUES["basic"], "gemini")
+
+# Task runtime and queue wait metrics (no-op with METRICS_ENABLED=0)
+instrument_celery(celery_app)
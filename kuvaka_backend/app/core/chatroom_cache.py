@@ -0,0 +1,237 @@
+"""Write-through cache of each user's chatroom list.
+
+Layout per user:
+  chatrooms:{uid}:gen            generation counter
+  chatrooms:{uid}:{gen}          hash chatroom_id -> orjson entry ('_' marks a populated list)
+  chatrooms:{uid}:{gen}:order    zset chatroom_id scored by last activity
+
+Creating a chatroom or sending a message updates the current generation in
+place. A write that finds the list unpopulated bumps the generation instead,
+so a concurrent fill based on an older DB read lands in an orphaned key.
+Misses are filled behind a per-user lock so only one request hits the DB.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+import orjson
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.instrumentation import CACHE_REQUESTS, REDIS_LATENCY, timed
+from app.core.redis import create_redis_client
+from app.models.chatroom import Chatroom
+from app.models.message import Message
+from app.models.message_archive import MessageArchive
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = 24 * 3600
+LOCK_TTL_MS = 5000
+FILL_WAIT_SECONDS = 1.0
+
+# Binary client: entries are stored and returned as orjson bytes
+cache_client = create_redis_client(decode_responses=False)
+
+# KEYS[1] gen key; ARGV[1] key prefix. Returns entries newest-first, or nil on a miss.
+READ_SCRIPT = """
+local gen = redis.call('GET', KEYS[1]) or '0'
+local hash = ARGV[1] .. gen
+if redis.call('HEXISTS', hash, '_') == 0 then
+    return false
+end
+local ids = redis.call('ZREVRANGE', hash .. ':order', 0, -1)
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', hash, unpack(ids))
+"""
+
+# KEYS[1] gen key; ARGV: prefix, gen read before the DB query, ttl, then (id, score, entry)*.
+# Skipped when a write bumped the generation while we were reading the DB.
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[2] then
+    return 0
+end
+local hash = ARGV[1] .. ARGV[2]
+redis.call('DEL', hash, hash .. ':order')
+redis.call('HSET', hash, '_', '1')
+for i = 4, #ARGV, 3 do
+    redis.call('HSET', hash, ARGV[i], ARGV[i + 2])
+    redis.call('ZADD', hash .. ':order', ARGV[i + 1], ARGV[i])
+end
+redis.call('EXPIRE', hash, ARGV[3])
+redis.call('EXPIRE', hash .. ':order', ARGV[3])
+return 1
+"""
+
+# KEYS[1] gen key; ARGV: prefix, chatroom id, score, entry. Keeps the activity of an existing entry.
+UPSERT_SCRIPT = """
+local hash = ARGV[1] .. (redis.call('GET', KEYS[1]) or '0')
+if redis.call('HEXISTS', hash, '_') == 0 then
+    redis.call('INCR', KEYS[1])
+    return 0
+end
+local old = redis.call('HGET', hash, ARGV[2])
+if old then
+    local entry = cjson.decode(ARGV[4])
+    local previous = cjson.decode(old)
+    entry['message_count'] = previous['message_count']
+    entry['last_message_at'] = previous['last_message_at']
+    redis.call('HSET', hash, ARGV[2], cjson.encode(entry))
+    return 1
+end
+redis.call('HSET', hash, ARGV[2], ARGV[4])
+redis.call('ZADD', hash .. ':order', ARGV[3], ARGV[2])
+return 1
+"""
+
+# KEYS[1] gen key; ARGV: prefix, chatroom id, score, message created_at (iso), number of messages
+MESSAGE_SCRIPT = """
+local hash = ARGV[1] .. (redis.call('GET', KEYS[1]) or '0')
+local raw = redis.call('HGET', hash, ARGV[2])
+if not raw then
+    redis.call('INCR', KEYS[1])
+    return 0
+end
+local entry = cjson.decode(raw)
+entry['message_count'] = (entry['message_count'] or 0) + tonumber(ARGV[5])
+entry['last_message_at'] = ARGV[4]
+redis.call('HSET', hash, ARGV[2], cjson.encode(entry))
+redis.call('ZADD', hash .. ':order', ARGV[3], ARGV[2])
+return 1
+"""
+
+_read = cache_client.register_script(READ_SCRIPT)
+_fill = cache_client.register_script(FILL_SCRIPT)
+_upsert = cache_client.register_script(UPSERT_SCRIPT)
+_record_message = cache_client.register_script(MESSAGE_SCRIPT)
+
+
+def _gen_key(user_id: int) -> str:
+    return f"chatrooms:{user_id}:gen"
+
+
+def _prefix(user_id: int) -> str:
+    return f"chatrooms:{user_id}:"
+
+
+def _score(dt: Optional[datetime]) -> float:
+    return dt.timestamp() if dt else 0.0
+
+
+def serialize_chatroom(chatroom: Chatroom, message_count: int = 0, last_message_at: datetime = None) -> dict:
+    return {
+        "id": chatroom.id,
+        "user_id": chatroom.user_id,
+        "name": chatroom.name,
+        "cache_responses": chatroom.cache_responses,
+        "created_at": chatroom.created_at,
+        "updated_at": chatroom.updated_at,
+        "message_count": message_count,
+        "last_message_at": last_message_at,
+    }
+
+
+# The list response has always carried an empty ``messages`` per chatroom
+_LIST_ENTRY_TAIL = b',"messages":[]}'
+
+
+def list_payload(entries: List[bytes]) -> bytes:
+    """The ``GET /chatroom`` body, spliced from cached entries without decoding them."""
+    return b"[" + b",".join(entry[:-1] + _LIST_ENTRY_TAIL for entry in entries) + b"]"
+
+
+def _activity(entry: dict) -> Optional[datetime]:
+    return entry["last_message_at"] or entry["created_at"]
+
+
+async def get_cached(user_id: int) -> Optional[List[bytes]]:
+    """Entries (orjson bytes) newest-activity-first, or None on a miss."""
+    with timed(REDIS_LATENCY, "chatroom_list_read"):
+        result = await _read(keys=[_gen_key(user_id)], args=[_prefix(user_id)])
+    return None if result is None else [entry for entry in result if entry is not None]
+
+
+async def upsert_chatroom(chatroom: Chatroom):
+    entry = serialize_chatroom(chatroom)
+    await _upsert(
+        keys=[_gen_key(chatroom.user_id)],
+        args=[_prefix(chatroom.user_id), chatroom.id, _score(_activity(entry)), orjson.dumps(entry)],
+    )
+
+
+async def record_message(user_id: int, chatroom_id: int, created_at: datetime, count: int = 1):
+    await _record_message(
+        keys=[_gen_key(user_id)],
+        args=[_prefix(user_id), chatroom_id, _score(created_at), created_at.isoformat(), count],
+    )
+
+
+async def invalidate(user_id: int):
+    await cache_client.incr(_gen_key(user_id))
+
+
+async def load_from_db(db: AsyncSession, user_id: int) -> List[dict]:
+    stats = (
+        select(
+            Message.chatroom_id,
+            func.count(Message.id).label("message_count"),
+            func.max(Message.created_at).label("last_message_at"),
+        )
+        .where(Message.user_id == user_id)
+        .group_by(Message.chatroom_id)
+        .subquery()
+    )
+    # Messages moved to the archive (app/services/archive.py) still count
+    archived = (
+        select(MessageArchive.chatroom_id, func.sum(MessageArchive.message_count).label("message_count"))
+        .where(MessageArchive.user_id == user_id)
+        .group_by(MessageArchive.chatroom_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(Chatroom, stats.c.message_count, stats.c.last_message_at, archived.c.message_count)
+        .outerjoin(stats, stats.c.chatroom_id == Chatroom.id)
+        .outerjoin(archived, archived.c.chatroom_id == Chatroom.id)
+        .where(Chatroom.user_id == user_id)
+    )
+    entries = [
+        serialize_chatroom(
+            chatroom, (message_count or 0) + (archived_count or 0), last_message_at or chatroom.archived_until
+        )
+        for chatroom, message_count, last_message_at, archived_count in result.all()
+    ]
+    entries.sort(key=lambda entry: _score(_activity(entry)), reverse=True)
+    return entries
+
+
+async def get_or_load(db: AsyncSession, user_id: int) -> List[bytes]:
+    cached = await get_cached(user_id)
+    if cached is not None:
+        CACHE_REQUESTS.labels("chatroom_list", "hit").inc()
+        return cached
+    CACHE_REQUESTS.labels("chatroom_list", "miss").inc()
+    lock_key = f"chatrooms:{user_id}:lock"
+    if not await cache_client.set(lock_key, b"1", nx=True, px=LOCK_TTL_MS):
+        # Someone else is filling: wait briefly for their result instead of stampeding the DB
+        deadline = asyncio.get_running_loop().time() + FILL_WAIT_SECONDS
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.02)
+            cached = await get_cached(user_id)
+            if cached is not None:
+                return cached
+        return [orjson.dumps(entry) for entry in await load_from_db(db, user_id)]
+    try:
+        gen = await cache_client.get(_gen_key(user_id)) or b"0"
+        entries = await load_from_db(db, user_id)
+        payloads = [orjson.dumps(entry) for entry in entries]
+        args = [_prefix(user_id), gen, CACHE_TTL]
+        for entry, payload in zip(entries, payloads):
+            args.extend([entry["id"], _score(_activity(entry)), payload])
+        await _fill(keys=[_gen_key(user_id)], args=args)
+        return payloads
+    finally:
+        await cache_client.delete(lock_key)
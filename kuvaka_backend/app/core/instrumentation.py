@@ -0,0 +1,286 @@
+"""Prometheus metrics for the API and the workers.
+
+* ``MetricsMiddleware`` -- request latency per method, route template and status
+* ``timed(METRIC, *labels)`` -- context manager timing a block (DB statements
+  are timed by engine hooks installed in ``app.db.engine``)
+* ``instrument_celery`` -- task runtime and queue wait from Celery signals
+* ``render`` -- the text exposition served on ``GET /metrics``
+
+With ``METRICS_ENABLED=0`` (or without prometheus_client) every metric is a
+shared no-op object and no middleware or hooks are installed.
+
+Celery prefork children are separate processes: point
+``PROMETHEUS_MULTIPROC_DIR`` at a directory shared with the API process and
+its ``/metrics`` aggregates them, or set ``METRICS_PORT`` to have a worker
+serve its own ``/metrics``.
+"""
+import os
+import time
+import weakref
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+from starlette.routing import compile_path
+
+try:
+    import prometheus_client
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+METRICS_ENABLED = PROMETHEUS_AVAILABLE and os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+MULTIPROCESS = METRICS_ENABLED and bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+GEMINI_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+
+class _Noop:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def time(self):
+        return _NULL_TIMER
+
+
+_NOOP = _Noop()
+_NULL_TIMER = nullcontext()
+
+
+def _metric(kind: str, name: str, documentation: str, labels, **kwargs):
+    if not METRICS_ENABLED:
+        return _NOOP
+    return getattr(prometheus_client, kind)(name, documentation, labels, **kwargs)
+
+
+HTTP_LATENCY = _metric(
+    "Histogram", "http_request_duration_seconds", "HTTP request latency",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+DB_LATENCY = _metric(
+    "Histogram", "db_statement_duration_seconds", "SQL statement latency", ["operation"], buckets=LATENCY_BUCKETS,
+)
+REDIS_LATENCY = _metric(
+    "Histogram", "redis_operation_duration_seconds", "Redis round trips on hot paths", ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = _metric("Counter", "cache_requests_total", "Cache lookups by outcome", ["cache", "result"])
+GEMINI_LATENCY = _metric(
+    "Histogram", "gemini_request_duration_seconds", "Gemini API call latency", ["mode", "outcome"],
+    buckets=GEMINI_BUCKETS,
+)
+GEMINI_TOKENS = _metric("Counter", "gemini_tokens_total", "Tokens reported by Gemini usageMetadata", ["kind"])
+TASK_RUNTIME = _metric(
+    "Histogram", "celery_task_duration_seconds", "Task body runtime", ["task", "state"], buckets=GEMINI_BUCKETS,
+)
+TASK_QUEUE_WAIT = _metric(
+    "Histogram", "celery_task_queue_wait_seconds", "Time from publish (or ETA) to execution", ["task"],
+    buckets=LATENCY_BUCKETS,
+)
+GEMINI_QUEUE_WAIT = _metric(
+    "Histogram", "gemini_queue_wait_seconds", "Time from commit (or retry ETA) to execution of Gemini tasks",
+    ["tier"], buckets=LATENCY_BUCKETS,
+)
+OUTBOX_LAG = _metric(
+    "Histogram", "outbox_publish_lag_seconds", "Time from commit to broker publish for outbox events", ["task"],
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_DEPTH = _metric("Gauge", "celery_queue_depth", "Messages waiting in a broker queue", ["queue"],
+                      multiprocess_mode="livemax")
+
+
+def timed(metric, *labels):
+    """``with timed(REDIS_LATENCY, "chatroom_list"):`` -- observes the block's duration."""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return metric.labels(*labels).time()
+
+
+def record_usage(usage: dict):
+    """Count tokens from a Gemini ``usageMetadata`` object."""
+    if not usage or not METRICS_ENABLED:
+        return
+    for kind, key in (("prompt", "promptTokenCount"), ("completion", "candidatesTokenCount")):
+        if usage.get(key):
+            GEMINI_TOKENS.labels(kind).inc(usage[key])
+
+
+# app -> [(path regex, methods, path template)], from the OpenAPI paths
+_route_patterns = weakref.WeakKeyDictionary()
+
+def _match_route(scope) -> str:
+    # Requests rejected by a middleware (429 from RateLimitMiddleware) never reach the router; match them here.
+    # The OpenAPI paths carry the router prefixes, which included routers may not expose as route objects.
+    app = scope.get("app")
+    if not hasattr(app, "openapi"):
+        return "unmatched"
+    patterns = _route_patterns.get(app)
+    if patterns is None:
+        patterns = _route_patterns[app] = [
+            (compile_path(path)[0], {method.upper() for method in operations}, path)
+            for path, operations in app.openapi().get("paths", {}).items()
+        ]
+    partial = None
+    for regex, methods, path in patterns:
+        if regex.match(scope["path"]):
+            if scope["method"] in methods:
+                return path
+            partial = partial or path
+    return partial or "unmatched"
+
+
+def route_template(scope) -> str:
+    """``/chatroom/{id}`` for ``/chatroom/42``; raw paths would give every id its own series."""
+    if "route" not in scope:
+        return _match_route(scope)
+    # Put the parameter names back into the full path (the route object may lack the router prefix)
+    names = {str(value): f"{{{name}}}" for name, value in scope.get("path_params", {}).items()}
+    return "/".join(names.get(segment, segment) for segment in scope["path"].split("/"))
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_LATENCY.labels(scope["method"], route_template(scope), str(status)).observe(
+                time.perf_counter() - started
+            )
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    target = engine.sync_engine
+
+    @event.listens_for(target, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+    @event.listens_for(target, "handle_error")
+    def handle_error(context):
+        stack = context.connection.info.get("metrics_started") if context.connection is not None else None
+        if stack:
+            stack.pop()
+
+
+def ready_at(headers: dict, since: float = None) -> float:
+    """When a published task became runnable: ``since`` or its publish time, or its ETA if later."""
+    ready = since or headers.get("published_at") or time.time()
+    eta = headers.get("eta")
+    if eta:
+        try:
+            eta_at = datetime.fromisoformat(eta)
+            if eta_at.tzinfo is None:
+                eta_at = eta_at.replace(tzinfo=timezone.utc)
+            ready = max(ready, eta_at.timestamp())
+        except (TypeError, ValueError):
+            pass
+    return ready
+
+
+def observe_queue_wait(task_name: str, headers: dict):
+    if METRICS_ENABLED and headers.get("published_at"):
+        TASK_QUEUE_WAIT.labels(task_name).observe(max(0.0, time.time() - ready_at(headers)))
+    # Outbox-relayed Gemini tasks: the whole wait the user sees, time in the outbox included
+    if METRICS_ENABLED and headers.get("enqueued_at"):
+        wait = time.time() - ready_at(headers, since=headers["enqueued_at"])
+        GEMINI_QUEUE_WAIT.labels(headers.get("tier") or "basic").observe(max(0.0, wait))
+
+
+def instrument_celery(celery_app):
+    if not METRICS_ENABLED:
+        return
+    from celery import signals
+
+    started = {}
+
+    @signals.before_task_publish.connect(weak=False)
+    def stamp_publish(headers=None, **kwargs):
+        if headers is not None:
+            headers["published_at"] = time.time()
+
+    @signals.task_prerun.connect(weak=False)
+    def on_prerun(task_id=None, task=None, **kwargs):
+        started[task_id] = time.perf_counter()
+        observe_queue_wait(task.name, vars(task.request))
+
+    @signals.task_postrun.connect(weak=False)
+    def on_postrun(task_id=None, task=None, state=None, **kwargs):
+        began = started.pop(task_id, None)
+        if began is not None:
+            TASK_RUNTIME.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - began)
+
+    @signals.worker_process_shutdown.connect(weak=False)
+    def mark_dead(pid=None, **kwargs):
+        if MULTIPROCESS:
+            multiprocess.mark_process_dead(pid or os.getpid())
+
+    @signals.worker_init.connect(weak=False)
+    def serve_worker_metrics(**kwargs):
+        # Prefork children only show up here in multiprocess mode; the solo pool runs tasks in this process
+        start_metrics_server()
+
+
+_broker_redis = None
+
+
+async def update_queue_depths(broker_url: str, queues=("gemini.pro", "gemini.basic", "gemini")):
+    global _broker_redis
+    if not METRICS_ENABLED or not broker_url.startswith(("redis://", "rediss://")):
+        return
+    if _broker_redis is None:
+        import redis.asyncio as redis
+        _broker_redis = redis.from_url(broker_url)
+    for queue in queues:
+        QUEUE_DEPTH.labels(queue).set(await _broker_redis.llen(queue))
+
+
+def registry():
+    if MULTIPROCESS:
+        collector = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector)
+        return collector
+    return prometheus_client.REGISTRY
+
+
+def render():
+    """(body, content type) in the Prometheus text format."""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int = None):
+    port = port or METRICS_PORT
+    if METRICS_ENABLED and port:
+        prometheus_client.start_http_server(port, registry=registry())
@@ -0,0 +1,54 @@
+import asyncio
+import json
+from typing import Optional
+
+from app.core.redis import redis_client
+
+# Channels the worker publishes to when a Gemini reply lands
+def user_channel(user_id: int) -> str:
+    return f"messages:user:{user_id}"
+
+def chatroom_channel(chatroom_id: int) -> str:
+    return f"messages:chatroom:{chatroom_id}"
+
+def completion_event(message) -> dict:
+    return {
+        "type": "message.completed",
+        "id": message.id,
+        "chatroom_id": message.chatroom_id,
+        "user_id": message.user_id,
+        "content": message.content,
+        "gemini_response": message.gemini_response,
+        "status": getattr(message.status, "value", message.status),
+        "error": message.error,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+    }
+
+async def publish_message_completed(message, client=None):
+    client = client or redis_client
+    payload = json.dumps(completion_event(message))
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.publish(user_channel(message.user_id), payload)
+        pipe.publish(chatroom_channel(message.chatroom_id), payload)
+        await pipe.execute()
+
+async def subscribe(channel: str, client=None):
+    pubsub = (client or redis_client).pubsub()
+    await pubsub.subscribe(channel)
+    return pubsub
+
+async def wait_for_completion(pubsub, message_id: int, timeout: float) -> Optional[dict]:
+    """Block on an already-subscribed pubsub until ``message_id`` completes or ``timeout`` elapses."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        # Wait in short slices so the deadline holds even if a wakeup is missed
+        item = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 1.0))
+        if item is None:
+            continue
+        event = json.loads(item["data"])
+        if event.get("id") == message_id:
+            return event
@@ -0,0 +1,114 @@
+"""Password hashing off the event loop.
+
+bcrypt takes 100-300 ms of CPU per call; running it inside an async handler
+stalls every other request on the worker. ``PasswordHasher`` runs it in a
+bounded thread pool (bcrypt releases the GIL) or, with
+``PASSWORD_HASHER_MODE=process``, a process pool. Callers beyond
+``PASSWORD_HASHER_MAX_PENDING`` queued jobs get a 503 instead of piling up.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from app.core.security import pwd_context
+
+
+# Module-level so they can be pickled for the process pool
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class PasswordHasher:
+    def __init__(self, mode: str = None, workers: int = None, max_pending: int = None):
+        self.mode = mode or os.getenv("PASSWORD_HASHER_MODE", "thread")
+        self.workers = workers or int(os.getenv("PASSWORD_HASHER_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.max_pending = max_pending or int(os.getenv("PASSWORD_HASHER_MAX_PENDING", "64"))
+        self._executor = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        queued_at = time.perf_counter()
+        try:
+            run_seconds, result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _timed_call, fn, args
+            )
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.run_seconds += run_seconds
+        self.wait_seconds += max(time.perf_counter() - queued_at - run_seconds, 0.0)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_hash, password)
+
+    async def verify(self, password: str, hashed: Optional[str]) -> bool:
+        valid, _ = await self.verify_and_update(password, hashed)
+        return valid
+
+    async def verify_and_update(self, password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """Verify ``password``; also return a new hash if ``hashed`` uses outdated parameters."""
+        if not hashed:
+            return False, None
+        valid, new_hash = await self._submit(_verify_and_update, password, hashed)
+        if new_hash:
+            self.rehashed += 1
+        return valid, new_hash
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "wait_seconds_total": round(self.wait_seconds, 6),
+            "run_seconds_total": round(self.run_seconds, 6),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _timed_call(fn, args):
+    # Runs in the pool; the duration lets the caller split queue wait from run time
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+password_hasher = PasswordHasher()
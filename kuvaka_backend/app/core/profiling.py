@@ -0,0 +1,261 @@
+"""Opt-in profiling of individual requests and Gemini tasks.
+
+With ``PROFILING_ENABLED=1`` a ``PROFILE_SAMPLE_RATE`` fraction of requests
+(``PROFILE_TASK_SAMPLE_RATE`` for tasks) is profiled. An admin can also force
+a profile by sending ``X-Profile: 1`` along with a valid ``X-Admin-Token``;
+the response then carries ``X-Profile-Id``.
+
+A profile holds:
+
+* the call tree -- pyinstrument when it is installed, otherwise the top
+  ``PROFILE_TOP_N`` functions from cProfile by cumulative time
+* every SQL statement run while it was active, with its duration, from
+  SQLAlchemy cursor events on engines made by ``app.db.engine``
+
+Only one profile runs at a time per process, since both profilers hook the
+whole thread; requests sampled while one is active are skipped. Profiles go
+to a Redis ring buffer of the last ``PROFILE_RING_SIZE`` entries, or to JSON
+files in ``PROFILE_DIR`` when that is set, and are read back through
+``/admin/profiles``.
+"""
+import asyncio
+import contextvars
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
+from uuid import uuid4
+
+import orjson
+
+from app.core import security
+
+try:
+    import pyinstrument
+    PYINSTRUMENT_AVAILABLE = True
+except ImportError:  # falls back to cProfile
+    PYINSTRUMENT_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_TASK_SAMPLE_RATE = float(os.getenv("PROFILE_TASK_SAMPLE_RATE", str(PROFILE_SAMPLE_RATE)))
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "100"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "40"))
+MAX_SQL_STATEMENTS = 500
+MAX_STATEMENT_CHARS = 1000
+
+RING_KEY = "profiles"
+
+_current = contextvars.ContextVar("profile", default=None)
+_active = False
+skipped = 0
+
+
+class Profile:
+    def __init__(self, kind: str, name: str, meta: dict = None):
+        self.id = uuid4().hex[:16]
+        self.kind = kind
+        self.name = name
+        self.meta = meta or {}
+        self.sql = []
+        self.started_at = None
+        self.duration = None
+        self.tree = None
+        self._profiler = None
+        self._started = None
+        self._token = None
+
+    def start(self):
+        self.started_at = time.time()
+        if PYINSTRUMENT_AVAILABLE:
+            self._profiler = pyinstrument.Profiler(async_mode="enabled")
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._token = _current.set(self)
+        self._started = time.perf_counter()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self._started
+        _current.reset(self._token)
+        if PYINSTRUMENT_AVAILABLE:
+            self._profiler.stop()
+            self.tree = self._profiler.output_text(unicode=False, color=False, show_all=False)
+        else:
+            self._profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            self.tree = out.getvalue()
+        self._profiler = None
+
+    def record_sql(self, statement: str, seconds: float):
+        if len(self.sql) < MAX_SQL_STATEMENTS:
+            self.sql.append({"statement": statement[:MAX_STATEMENT_CHARS], "ms": round(seconds * 1000, 3)})
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "sql_count": len(self.sql),
+            "sql_ms": round(sum(item["ms"] for item in self.sql), 3),
+            **self.meta,
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "profiler": "pyinstrument" if PYINSTRUMENT_AVAILABLE else "cProfile",
+            "sql": self.sql,
+            "tree": self.tree,
+        }
+
+
+def should_sample(rate: float) -> bool:
+    return PROFILING_ENABLED and rate > 0 and random.random() < rate
+
+
+def is_forced(headers: dict) -> bool:
+    """``X-Profile: 1`` from a caller holding the admin token."""
+    token = headers.get("x-admin-token")
+    return (
+        PROFILING_ENABLED
+        and headers.get("x-profile") == "1"
+        and bool(security.ADMIN_API_TOKEN and token)
+        and hmac.compare_digest(token, security.ADMIN_API_TOKEN)
+    )
+
+
+def begin(kind: str, name: str, meta: dict = None) -> Optional[Profile]:
+    global _active, skipped
+    if _active:
+        skipped += 1
+        return None
+    _active = True
+    profile = Profile(kind, name, meta)
+    try:
+        profile.start()
+    except Exception:
+        _active = False
+        logger.warning("Could not start profiler", exc_info=True)
+        return None
+    return profile
+
+
+def end(profile: Profile):
+    global _active
+    try:
+        profile.stop()
+    finally:
+        _active = False
+
+
+async def save(profile: Profile, redis=None):
+    payload = orjson.dumps(profile.to_dict())
+    try:
+        if PROFILE_DIR:
+            path = Path(PROFILE_DIR) / f"{profile.id}.json"
+            await asyncio.to_thread(_write_file, path, payload)
+        elif redis is not None:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.lpush(RING_KEY, payload)
+                pipe.ltrim(RING_KEY, 0, PROFILE_RING_SIZE - 1)
+                await pipe.execute()
+    except Exception:
+        logger.warning("Could not store profile %s", profile.id, exc_info=True)
+
+
+def _write_file(path: Path, payload: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(payload)
+    # Keep the directory to the same size as the Redis ring
+    files = sorted(path.parent.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in files[PROFILE_RING_SIZE:]:
+        old.unlink(missing_ok=True)
+
+
+async def load_all(redis) -> List[dict]:
+    """Stored profiles, newest first."""
+    if PROFILE_DIR:
+        def read():
+            files = sorted(Path(PROFILE_DIR).glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+            return [orjson.loads(path.read_bytes()) for path in files]
+        return await asyncio.to_thread(read) if Path(PROFILE_DIR).is_dir() else []
+    return [orjson.loads(item) for item in await redis.lrange(RING_KEY, 0, -1)]
+
+
+@asynccontextmanager
+async def maybe_profile(kind: str, name: str, redis=None, meta: dict = None, force: bool = False):
+    """Profile the block if it is sampled (or ``force``d); yields the Profile or None."""
+    profile = None
+    if force or should_sample(PROFILE_TASK_SAMPLE_RATE if kind == "task" else PROFILE_SAMPLE_RATE):
+        profile = begin(kind, name, meta)
+    if profile is None:
+        yield None
+        return
+    try:
+        yield profile
+    finally:
+        end(profile)
+        await save(profile, redis)
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    target = engine.sync_engine
+
+    @event.listens_for(target, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info["profile_started"] = time.perf_counter()
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        started = conn.info.pop("profile_started", None)
+        if profile is not None and started is not None:
+            profile.record_sql(statement, time.perf_counter() - started)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, redis=None):
+        self.app = app
+        self.redis = redis
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        force = is_forced(headers)
+        if not force and not should_sample(PROFILE_SAMPLE_RATE):
+            return await self.app(scope, receive, send)
+        profile = begin("request", f"{scope['method']} {scope['path']}")
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.meta["status"] = message["status"]
+                if force:
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end(profile)
+            await save(profile, self.redis)
@@ -0,0 +1,139 @@
+"""Daily message quota per user, counted atomically in Redis.
+
+One counter per user per UTC day (``quota:messages:{user_id}:{YYYYMMDD}``),
+expiring at the next UTC midnight. A Lua script checks and increments in a
+single round-trip so concurrent sends cannot overshoot the limit. On a cache
+miss the counter is seeded from the messages table.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.instrumentation import REDIS_LATENCY, timed
+from app.core.redis import redis_client
+from app.models.message import Message
+
+logger = logging.getLogger(__name__)
+
+# Daily message limits per tier; 0 means unlimited
+TIER_LIMITS = {
+    "basic": int(os.getenv("QUOTA_DAILY_LIMIT_BASIC", "10")),
+    "pro": int(os.getenv("QUOTA_DAILY_LIMIT_PRO", "0")),
+}
+
+# KEYS[1] counter; ARGV: limit, expire-at (epoch), seed ('' = none), amount.
+# Returns {granted, used} or {-1, 0} when the counter is missing and no seed was given.
+CONSUME_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if not used then
+    if ARGV[3] == '' then
+        return {-1, 0}
+    end
+    redis.call('SET', KEYS[1], ARGV[3])
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+    used = ARGV[3]
+end
+used = tonumber(used)
+local granted = math.min(tonumber(ARGV[4]), tonumber(ARGV[1]) - used)
+if granted <= 0 then
+    return {0, used}
+end
+return {granted, redis.call('INCRBY', KEYS[1], granted)}
+"""
+
+REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('DECRBY', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+_consume = redis_client.register_script(CONSUME_SCRIPT)
+_refund = redis_client.register_script(REFUND_SCRIPT)
+
+
+class QuotaResult:
+    def __init__(self, granted: int, used: int, limit: int, reset_at: datetime):
+        self.granted = granted
+        self.used = used
+        self.limit = limit
+        self.reset_at = reset_at
+
+    @property
+    def remaining(self) -> int:
+        return max(self.limit - self.used, 0)
+
+    def headers(self) -> dict:
+        return {
+            "X-Quota-Limit": str(self.limit),
+            "X-Quota-Remaining": str(self.remaining),
+            "X-Quota-Reset": str(_epoch(self.reset_at)),
+        }
+
+
+def _epoch(dt: datetime) -> int:
+    # Naive datetimes here are UTC
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def tier_for(is_pro: bool) -> str:
+    return "pro" if is_pro else "basic"
+
+
+def _day_window(now: datetime = None):
+    now = now or datetime.utcnow()
+    start = datetime.combine(now.date(), datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def _counter_key(user_id: int, day_start: datetime) -> str:
+    return f"quota:messages:{user_id}:{day_start:%Y%m%d}"
+
+
+async def count_messages_today(db: AsyncSession, user_id: int) -> int:
+    start, end = _day_window()
+    result = await db.execute(
+        select(func.count()).select_from(Message).where(
+            Message.user_id == user_id,
+            Message.created_at >= start,
+            Message.created_at < end,
+        )
+    )
+    return result.scalar_one()
+
+
+async def consume(db: AsyncSession, user_id: int, tier: str, amount: int = 1) -> Optional[QuotaResult]:
+    """Reserve up to ``amount`` sends for today. Returns None for unlimited tiers."""
+    limit = TIER_LIMITS.get(tier, 0)
+    if not limit:
+        return None
+    start, end = _day_window()
+    key = _counter_key(user_id, start)
+    expire_at = _epoch(end)
+    try:
+        with timed(REDIS_LATENCY, "quota_consume"):
+            granted, used = await _consume(keys=[key], args=[limit, expire_at, "", amount])
+        if granted == -1:
+            seed = await count_messages_today(db, user_id)
+            granted, used = await _consume(keys=[key], args=[limit, expire_at, seed, amount])
+    except Exception:
+        # Redis unavailable: fall back to counting in the DB (not race-free)
+        logger.exception("Quota counter unavailable, falling back to DB count")
+        used = await count_messages_today(db, user_id)
+        granted = max(min(amount, limit - used), 0)
+        used += granted
+    return QuotaResult(granted, used, limit, end)
+
+
+async def refund(user_id: int, amount: int = 1):
+    # Give reserved sends back when the insert they were reserved for failed
+    start, _ = _day_window()
+    try:
+        await _refund(keys=[_counter_key(user_id, start)], args=[amount])
+    except Exception:
+        logger.exception("Could not refund quota for user %s", user_id)
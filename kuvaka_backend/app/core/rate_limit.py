@@ -0,0 +1,286 @@
+"""Request rate limiting for auth and chat endpoints.
+
+Two algorithms, each implemented as a Redis Lua script (one round-trip per
+decision) with an in-process twin used while Redis is unreachable:
+
+* token bucket -- steady refill with bursts up to ``capacity``
+* sliding window log -- at most ``limit`` hits in any ``window`` seconds
+
+``RateLimitMiddleware`` matches requests against ``RULES`` and keys them by
+JWT subject (with a per-tier policy) or, for anonymous calls, client IP.
+"""
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import jwt
+import orjson
+
+from app.core.instrumentation import REDIS_LATENCY, timed
+from app.core.redis import redis_client
+from app.core.security import SECRET_KEY, resolve_is_pro
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+
+# KEYS[1] bucket hash; ARGV: capacity, refill per second, now (ms), cost.
+# A cost above the capacity is admitted from a full bucket and leaves it in debt.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+local needed = math.min(cost, capacity)
+local allowed = 0
+local retry_ms = 0
+if tokens >= needed then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_ms = math.ceil((needed - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) * 1000 / rate) + 1000)
+return {allowed, retry_ms, math.max(0, math.floor(tokens))}
+"""
+
+# KEYS[1] zset of hit timestamps; ARGV: limit, window (ms), now (ms), member
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return {1, 0, limit - count - 1}
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {0, tonumber(oldest[2]) + window - now, 0}
+"""
+
+
+class TokenBucket:
+    algorithm = "token_bucket"
+
+    def __init__(self, capacity: int, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+
+
+class SlidingWindow:
+    algorithm = "sliding_window"
+
+    def __init__(self, limit: int, window_seconds: float):
+        self.limit = limit
+        self.window_seconds = window_seconds
+
+
+class Decision:
+    __slots__ = ("allowed", "retry_after", "remaining")
+
+    def __init__(self, allowed: bool, retry_after: float, remaining: int):
+        self.allowed = allowed
+        self.retry_after = retry_after
+        self.remaining = remaining
+
+
+class LocalLimiter:
+    """In-process fallback with the same semantics, bounded to ``max_keys`` keys (LRU)."""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._state = OrderedDict()
+
+    def _get(self, key, factory):
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = factory()
+            if len(self._state) > self.max_keys:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(key)
+        return state
+
+    def hit(self, key: str, policy, now: float = None, cost: int = 1) -> Decision:
+        now = time.monotonic() if now is None else now
+        if policy.algorithm == "token_bucket":
+            state = self._get(key, lambda: [float(policy.capacity), now])
+            state[0] = min(policy.capacity, state[0] + (now - state[1]) * policy.refill_per_second)
+            state[1] = now
+            needed = min(cost, policy.capacity)
+            if state[0] >= needed:
+                state[0] -= cost
+                return Decision(True, 0.0, max(0, int(state[0])))
+            return Decision(False, (needed - state[0]) / policy.refill_per_second, 0)
+        hits = self._get(key, deque)
+        while hits and hits[0] <= now - policy.window_seconds:
+            hits.popleft()
+        if len(hits) < policy.limit:
+            hits.append(now)
+            return Decision(True, 0.0, policy.limit - len(hits))
+        return Decision(False, hits[0] + policy.window_seconds - now, 0)
+
+
+class RateLimiter:
+    def __init__(self, client=None, retry_redis_after: float = 5.0):
+        self.client = client or redis_client
+        self.local = LocalLimiter()
+        self.retry_redis_after = retry_redis_after
+        self._redis_down_until = 0.0
+        self._token_bucket = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._sliding_window = self.client.register_script(SLIDING_WINDOW_SCRIPT)
+
+    async def hit(self, key: str, policy, cost: int = 1) -> Decision:
+        """Take ``cost`` tokens from a token bucket; a sliding window always counts one hit."""
+        if time.monotonic() < self._redis_down_until:
+            return self.local.hit(key, policy, cost=cost)
+        now_ms = int(time.time() * 1000)
+        try:
+            with timed(REDIS_LATENCY, "rate_limit"):
+                if policy.algorithm == "token_bucket":
+                    allowed, retry_ms, remaining = await self._token_bucket(
+                        keys=[f"ratelimit:{key}"], args=[policy.capacity, policy.refill_per_second, now_ms, cost]
+                    )
+                else:
+                    allowed, retry_ms, remaining = await self._sliding_window(
+                        keys=[f"ratelimit:{key}"],
+                        args=[policy.limit, int(policy.window_seconds * 1000), now_ms, f"{now_ms}-{uuid.uuid4().hex[:8]}"],
+                    )
+        except Exception:
+            # Don't pay a connection timeout on every request while Redis is away
+            logger.warning("Rate limiter falling back to in-process state", exc_info=True)
+            self._redis_down_until = time.monotonic() + self.retry_redis_after
+            return self.local.hit(key, policy, cost=cost)
+        return Decision(bool(allowed), retry_ms / 1000, int(remaining))
+
+
+class Rule:
+    """Limit ``method`` requests whose path matches ``pattern``; ``policies`` maps tier -> policy.
+
+    Rules with the same ``name`` share a limit. ``cost``, if given, maps the
+    request body to the number of tokens the request takes.
+    """
+
+    def __init__(self, name: str, method: str, pattern: str, policies: dict, cost=None):
+        self.name = name
+        self.method = method
+        self.pattern = re.compile(pattern)
+        self.policies = policies
+        self.cost = cost
+
+    def policy_for(self, tier: str):
+        return self.policies.get(tier) or self.policies["anonymous"]
+
+
+def batch_size(body: bytes) -> int:
+    """Messages in a ``messages:batch`` body; malformed bodies cost one and fail validation later."""
+    try:
+        messages = orjson.loads(body).get("messages")
+    except (orjson.JSONDecodeError, AttributeError):
+        return 1
+    return max(1, len(messages)) if isinstance(messages, list) else 1
+
+
+SEND_MESSAGE_POLICIES = {
+    "anonymous": TokenBucket(capacity=5, refill_per_second=0.5),
+    "basic": TokenBucket(capacity=10, refill_per_second=1),
+    "pro": TokenBucket(capacity=30, refill_per_second=5),
+}
+
+RULES = [
+    Rule("send_otp", "POST", r"^/auth/(send-otp|forgot-password)$", {
+        "anonymous": SlidingWindow(limit=5, window_seconds=60),
+    }),
+    Rule("verify_otp", "POST", r"^/auth/verify-otp$", {
+        "anonymous": SlidingWindow(limit=10, window_seconds=300),
+    }),
+    Rule("send_message", "POST", r"^/chatroom/\d+/message(/stream)?$", SEND_MESSAGE_POLICIES),
+    # Same bucket, one token per message in the batch
+    Rule("send_message", "POST", r"^/chatroom/\d+/messages:batch$", SEND_MESSAGE_POLICIES, cost=batch_size),
+]
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def identify(scope) -> tuple:
+    """Return (identity, tier) from the bearer token, or the client IP when anonymous.
+
+    The tier goes through the same Redis override as ``get_current_user``, so
+    an upgrade or downgrade applies before the user's next token.
+    """
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization" and value[:7].lower() == b"bearer ":
+            try:
+                claims = jwt.decode(value[7:].decode(), SECRET_KEY, algorithms=["HS256"])
+                user_id = int(claims["sub"])
+            except (jwt.PyJWTError, KeyError, ValueError, UnicodeDecodeError):
+                break
+            is_pro = await resolve_is_pro(user_id, bool(claims.get("is_pro")))
+            return f"user:{user_id}", "pro" if is_pro else "basic"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}", "anonymous"
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, rules=None, limiter: RateLimiter = None):
+        self.app = app
+        self.rules = RULES if rules is None else rules
+        self.limiter = limiter or RateLimiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        rule = next(
+            (r for r in self.rules if r.method == scope["method"] and r.pattern.match(scope["path"])),
+            None,
+        )
+        if rule is None:
+            return await self.app(scope, receive, send)
+        identity, tier = await identify(scope)
+        cost = 1
+        if rule.cost is not None:
+            body = await read_body(receive)
+            cost = rule.cost(body)
+            replayed = False
+
+            async def receive_again(receive=receive):
+                nonlocal replayed
+                if replayed:
+                    return await receive()
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            receive = receive_again
+        decision = await self.limiter.hit(f"{rule.name}:{identity}", rule.policy_for(tier), cost=cost)
+        if decision.allowed:
+            return await self.app(scope, receive, send)
+        body = json.dumps({"detail": "Too many requests"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, int(decision.retry_after + 0.999))).encode()),
+                (b"x-ratelimit-remaining", b"0"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
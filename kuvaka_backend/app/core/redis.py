@@ -3,4 +3,10 @@ import redis.asyncio as redis
 import os
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+def create_redis_client(**kwargs):
+    # Connections are bound to the event loop that opened them, so long-lived
+    # loops outside the API process (Celery worker runtime) build their own client.
+    kwargs.setdefault("decode_responses", True)
+    return redis.from_url(REDIS_URL, **kwargs)
+
+redis_client = create_redis_client()
@@ -1,14 +1,25 @@
 import jwt
+import hashlib
+import hmac
+import logging
+import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Header
 from fastapi.security import OAuth2PasswordBearer
 from typing import Optional
+from app.core.redis import redis_client
+from app.schemas.auth import JWTUser
 
 SECRET_KEY = "your-secret-key"  # Change in production
 token_expire_minutes = 60 * 24  # 24 hours
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Raising BCRYPT_ROUNDS upgrades existing hashes on the next successful verify
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", "12"))
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/verify-otp")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -17,7 +28,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=token_expire_minutes)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm="HS256")
     return encoded_jwt
 
@@ -35,3 +46,60 @@ def get_password_hash(password: str):
 
 def verify_password(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
+
+# Verified token -> claims, keyed by token hash; entries die with the token's exp
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+_token_cache = OrderedDict()
+
+def verify_access_token_cached(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    entry = _token_cache.get(key)
+    if entry is not None:
+        claims, exp = entry
+        if exp > time.time():
+            _token_cache.move_to_end(key)
+            return claims
+        del _token_cache[key]
+    claims = verify_access_token(token)
+    _token_cache[key] = (claims, claims["exp"])
+    if len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return claims
+
+# Claims can go stale after issue (e.g. the Stripe webhook upgrades a user to Pro).
+# Changes are recorded in Redis and applied over the token's claims.
+def _user_state_key(user_id: int) -> str:
+    return f"auth:user:{user_id}"
+
+async def set_user_tier(user_id: int, is_pro: bool):
+    key = _user_state_key(user_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, "is_pro", "1" if is_pro else "0")
+        # Older tokens are all expired by then, and new ones carry the fresh claim
+        pipe.expire(key, token_expire_minutes * 60)
+        await pipe.execute()
+
+async def resolve_is_pro(user_id: int, claimed: bool) -> bool:
+    """The user's current tier: the Redis override if one is set, else the token's claim."""
+    try:
+        override = await redis_client.hget(_user_state_key(user_id), "is_pro")
+    except Exception:
+        logging.getLogger(__name__).warning("Auth state lookup failed; using token claims", exc_info=True)
+        return claimed
+    return claimed if override is None else override == "1"
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> JWTUser:
+    claims = verify_access_token_cached(token)
+    user_id = int(claims["sub"])
+    is_pro = await resolve_is_pro(user_id, bool(claims.get("is_pro")))
+    return JWTUser(id=user_id, mobile_number=claims.get("mobile_number", ""), is_pro=is_pro)
+
+async def get_current_user_id(user: JWTUser = Depends(get_current_user)) -> int:
+    return user.id
+
+# Operator-only endpoints; disabled unless ADMIN_API_TOKEN is set
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_API_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin token required")
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+
+import httpx
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app.core.redis import create_redis_client
+from app.db.engine import create_engine
+from app.services.gemini_client import GeminiClient, GeminiDispatcher, gemini_timeout
+from app.services.writeback import WriteBackBuffer
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def build_http_client(max_connections: int = None) -> httpx.AsyncClient:
+    # One keep-alive pool per process: Gemini connections are reused across tasks
+    limits = httpx.Limits(
+        max_connections=max_connections or int(os.getenv("GEMINI_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("GEMINI_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "60")),
+    )
+    http2 = HTTP2_AVAILABLE and os.getenv("GEMINI_HTTP2", "1") == "1"
+    return httpx.AsyncClient(limits=limits, http2=http2, timeout=gemini_timeout())
+
+
+class WorkerRuntime:
+    """Event loop, pooled DB engine, HTTP/Redis/Gemini clients and reply write-back buffer shared by one worker process."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, max_connections: int = None):
+        self.pid = os.getpid()
+        self.owns_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        self.engine = create_engine()
+        self.sessionmaker = sessionmaker(
+            bind=self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.http_client = build_http_client(max_connections)
+        # Circuit breaker and adaptive concurrency limit for Gemini calls from this process
+        self.gemini = GeminiClient()
+        self.redis = create_redis_client()
+        # Single-flight and the API key pool (per-key quotas live in Redis, shared by all workers)
+        self.dispatcher = GeminiDispatcher(self.gemini, redis=self.redis)
+        # Batching needs a loop that keeps running between tasks; prefork task bodies flush immediately
+        self.writeback = WriteBackBuffer(self.sessionmaker, self.redis, flush_ms=0 if self.owns_loop else None)
+
+    def run(self, coro):
+        # Only valid when the runtime owns its loop (Celery prefork/solo task bodies)
+        return self.loop.run_until_complete(coro)
+
+    async def aclose(self):
+        await self.writeback.close()
+        await self.http_client.aclose()
+        await self.redis.aclose()
+        await self.engine.dispose()
+
+    def close(self):
+        if self.owns_loop:
+            try:
+                self.loop.run_until_complete(self.aclose())
+            finally:
+                self.loop.close()
+
+
+_runtime = None
+
+
+def get_runtime() -> WorkerRuntime:
+    # Lazily created so solo/threads pools (no worker_process_init) work too;
+    # a runtime inherited across fork is never reused.
+    global _runtime
+    if _runtime is None or _runtime.pid != os.getpid():
+        _runtime = WorkerRuntime()
+    return _runtime
+
+
+def set_runtime(runtime: WorkerRuntime):
+    # Used by the asyncio consumer, which owns its loop and installs its own runtime
+    global _runtime
+    _runtime = runtime
+
+
+def shutdown_runtime():
+    global _runtime
+    runtime, _runtime = _runtime, None
+    if runtime is None or runtime.pid != os.getpid():
+        return
+    try:
+        runtime.close()
+    except Exception:
+        logger.exception("Error shutting down worker runtime")
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs):
+    get_runtime()
+
+
+@worker_process_shutdown.connect
+def _shutdown_worker_process(**kwargs):
+    shutdown_runtime()
+
+
+@worker_shutdown.connect
+def _shutdown_worker(**kwargs):
+    shutdown_runtime()
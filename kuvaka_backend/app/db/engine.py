@@ -0,0 +1,126 @@
+"""Async engine factory shared by the API process and the workers.
+
+Pool behaviour comes from the environment:
+
+* ``DB_POOL_SIZE`` / ``DB_MAX_OVERFLOW`` -- persistent connections, and how
+  many extra may be opened during a burst
+* ``DB_POOL_TIMEOUT`` -- seconds to wait for a free connection before failing
+* ``DB_POOL_RECYCLE`` -- replace connections older than this many seconds,
+  before the server or a load balancer drops them
+* ``DB_POOL_PRE_PING`` -- test each connection on checkout (default on)
+* ``DB_STATEMENT_CACHE_SIZE`` -- asyncpg prepared statement cache per connection
+* ``DB_PGBOUNCER=1`` -- for PgBouncer in transaction mode: no client-side pool,
+  no statement caches and unique prepared statement names
+"""
+import os
+import time
+from uuid import uuid4
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+from app.core import profiling
+from app.core.instrumentation import METRICS_ENABLED, instrument_engine
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_CACHE_SIZE = os.getenv("DB_STATEMENT_CACHE_SIZE")
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def recreate(self):
+        # Keep the counters when the engine is disposed and the pool rebuilt
+        pool = super().recreate()
+        pool.waits, pool.wait_seconds = self.waits, self.wait_seconds
+        pool.max_wait_seconds, pool.timeouts = self.max_wait_seconds, self.timeouts
+        return pool
+
+
+def engine_options(url: str) -> dict:
+    parsed = make_url(url)
+    options = {"echo": False, "pool_pre_ping": DB_POOL_PRE_PING}
+    connect_args = {}
+    if parsed.get_backend_name() == "postgresql" and parsed.get_driver_name() == "asyncpg":
+        if DB_PGBOUNCER:
+            # PgBouncer owns the pool, and a server connection may change between statements
+            connect_args.update(
+                statement_cache_size=0,
+                prepared_statement_cache_size=0,
+                prepared_statement_name_func=lambda: f"__asyncpg_{uuid4()}__",
+            )
+        elif DB_STATEMENT_CACHE_SIZE is not None:
+            connect_args["prepared_statement_cache_size"] = int(DB_STATEMENT_CACHE_SIZE)
+    if connect_args:
+        options["connect_args"] = connect_args
+
+    if DB_PGBOUNCER:
+        options["poolclass"] = NullPool
+    elif parsed.get_backend_name() != "sqlite" or parsed.database not in (None, "", ":memory:"):
+        # In-memory SQLite keeps its single static connection
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    return options
+
+
+def create_engine(url: str = None, **overrides) -> AsyncEngine:
+    url = url or os.getenv("DATABASE_URL")
+    engine = create_async_engine(url, **{**engine_options(url), **overrides})
+    if METRICS_ENABLED:
+        instrument_engine(engine)
+    if profiling.PROFILING_ENABLED:
+        profiling.instrument_engine(engine)
+    return engine
+
+
+def pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__, "pgbouncer_mode": DB_PGBOUNCER}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            checkouts=pool.waits,
+            avg_wait_ms=round(pool.wait_seconds / pool.waits * 1000, 3) if pool.waits else 0.0,
+            max_wait_ms=round(pool.max_wait_seconds * 1000, 3),
+            timeouts=pool.timeouts,
+        )
+    return stats
@@ -10,6 +10,8 @@ from app.db.session import engine
 from app.models.user import Base
 from app.models.chatroom import Chatroom
 from app.models.message import Message
+from app.models.message_archive import MessageArchive
+from app.models.outbox import OutboxEvent
 
 async def init_db():
     async with engine.begin() as conn:
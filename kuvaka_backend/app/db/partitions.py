@@ -0,0 +1,316 @@
+"""Monthly range partitions of ``messages`` (PostgreSQL) and archival of old months.
+
+    python -m app.db.partitions convert           # once: partition the existing table
+    python -m app.db.partitions create --ahead 3  # this month's partition and the next three
+    python -m app.db.partitions archive           # detach, archive and drop months past MESSAGE_HOT_MONTHS
+    python -m app.db.partitions maintain          # create, then archive; run it daily
+    python -m app.db.partitions list
+
+``convert`` renames the table to ``messages_legacy`` and creates ``messages``
+partitioned by range of ``created_at``, with primary key (id, created_at).
+No rows are copied: the old table is attached as the partition for
+everything before next month, and is archived as a whole once that month
+ages out. The index and constraint checks that need a scan are done
+beforehand without blocking the table, so the swap only changes the
+catalog. New partitions are named ``messages_pYYYYMM``. An insert into a
+month without a partition fails, so keep ``--ahead`` above zero and run
+``maintain`` daily.
+
+``archive`` detaches every partition whose range ends before the cutoff,
+writes its rows to archive files (``app.services.archive``) and drops it.
+On SQLite, or on a PostgreSQL table that was never converted, rows older
+than the cutoff are archived and deleted instead.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import column, delete, table, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.future import select
+
+from app.core.redis import redis_client
+from app.models.message import Message
+from app.models.message_archive import MessageArchive
+from app.services import archive, context
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_HOT_MONTHS = int(os.getenv("MESSAGE_HOT_MONTHS", "6"))
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "3"))
+PARTITION_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+
+LEGACY_PARTITION = "messages_legacy"
+RANGE_CHECK = f"{LEGACY_PARTITION}_range"
+BOUND_PATTERN = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    year, month = divmod(moment.month - 1 + months, 12)
+    return datetime(moment.year + year, month + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"messages_p{month:%Y%m}"
+
+
+def _parse_bound(value: str) -> Optional[datetime]:
+    return None if value == "MINVALUE" else datetime.fromisoformat(value.strip("'"))
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    # Compared in SQL: drivers disagree on how to return the "char" type
+    result = await conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('messages')"))
+    return bool(result.scalar())
+
+
+async def list_partitions(conn: AsyncConnection) -> List[Tuple[str, Optional[datetime], datetime]]:
+    """(name, lower bound or None for MINVALUE, upper bound) of each partition, oldest first."""
+    result = await conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass"
+    ))
+    partitions = []
+    for name, bound in result.all():
+        match = BOUND_PATTERN.search(bound)
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+async def _prepare(engine: AsyncEngine, boundary: datetime):
+    """Everything ``convert`` needs that scans or builds, done while reads and writes go on."""
+    async with engine.connect() as conn:
+        # CONCURRENTLY cannot run in a transaction block
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        # The future primary key, adopted as is instead of built under the lock. A failed run leaves it invalid.
+        valid = (await conn.execute(text(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('messages_legacy_pkey')"
+        ))).scalar()
+        if valid is False:
+            await conn.execute(text("DROP INDEX CONCURRENTLY messages_legacy_pkey"))
+        if not valid:
+            await conn.execute(text(
+                "CREATE UNIQUE INDEX CONCURRENTLY messages_legacy_pkey ON messages (id, created_at)"
+            ))
+    async with engine.begin() as conn:
+        # The partition key cannot be NULL; such rows predate the column default, so they count as oldest
+        await conn.execute(text("UPDATE messages SET created_at = '1970-01-01' WHERE created_at IS NULL"))
+    # Added NOT VALID (a brief lock, no scan), then validated without blocking writes. The first lets
+    # SET NOT NULL skip its scan, the second ATTACH PARTITION.
+    for name, check in (
+        ("messages_created_at_not_null", "created_at IS NOT NULL"),
+        (RANGE_CHECK, f"created_at < '{boundary.isoformat()}'"),
+    ):
+        async with engine.begin() as conn:
+            await conn.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+            await conn.execute(text(
+                f"ALTER TABLE messages DROP CONSTRAINT IF EXISTS {name}, "
+                f"ADD CONSTRAINT {name} CHECK ({check}) NOT VALID"
+            ))
+        async with engine.begin() as conn:
+            await conn.execute(text(f"ALTER TABLE messages VALIDATE CONSTRAINT {name}"))
+
+
+async def _swap(conn: AsyncConnection, boundary: datetime):
+    sequence = (await conn.execute(text("SELECT pg_get_serial_sequence('messages', 'id')"))).scalar()
+    await conn.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+    await conn.execute(text(f"ALTER TABLE messages RENAME TO {LEGACY_PARTITION}"))
+    for index in Message.__table__.indexes:
+        # Free the names for the partitioned table; the legacy indexes get attached to its indexes below
+        await conn.execute(text(f"ALTER INDEX IF EXISTS {index.name} RENAME TO {index.name}_legacy"))
+    # No scan: the validated check already proves it
+    await conn.execute(text(f"ALTER TABLE {LEGACY_PARTITION} ALTER COLUMN created_at SET NOT NULL"))
+    await conn.execute(text(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT messages_created_at_not_null"))
+    # The partition's primary key has to match the parent's, so the prebuilt index replaces the one on id alone.
+    # Ids stay unique: they all come from the sequence.
+    await conn.execute(text(
+        f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT messages_pkey, "
+        "ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY USING INDEX messages_legacy_pkey"
+    ))
+    await conn.execute(text(
+        f"CREATE TABLE messages (LIKE {LEGACY_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+    ))
+    await conn.execute(text("ALTER TABLE messages ADD PRIMARY KEY (id, created_at)"))
+    # Same definitions as the legacy table's foreign keys, which are adopted rather than validated again
+    await conn.execute(text("ALTER TABLE messages ADD FOREIGN KEY (chatroom_id) REFERENCES chatrooms (id)"))
+    await conn.execute(text("ALTER TABLE messages ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+    if sequence:
+        await conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY messages.id"))
+    # No scan thanks to the range check; messages_legacy_pkey becomes the partition's primary key index
+    await conn.execute(text(
+        f"ALTER TABLE messages ATTACH PARTITION {LEGACY_PARTITION} "
+        f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+    ))
+    for index in Message.__table__.indexes:
+        # Each adopts the matching renamed legacy index instead of building one
+        await conn.run_sync(index.create)
+
+
+async def convert(engine: AsyncEngine, now: datetime = None):
+    """Turn a plain ``messages`` table into a partitioned one.
+
+    Scans and the index build run first, without blocking the table. The swap
+    is then one transaction of catalog changes under ACCESS EXCLUSIVE, given
+    up after ``PARTITION_LOCK_TIMEOUT`` rather than queueing traffic behind it.
+    """
+    boundary = add_months(month_start(now or datetime.utcnow()), 1)
+    try:
+        await _prepare(engine, boundary)
+        async with engine.begin() as conn:
+            await _swap(conn, boundary)
+    except Exception:
+        # Left in place, the range check would reject every insert once the boundary passes
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+                await conn.execute(text(f"ALTER TABLE messages DROP CONSTRAINT IF EXISTS {RANGE_CHECK}"))
+        except Exception:
+            logger.error(
+                "Could not drop %s; run ALTER TABLE messages DROP CONSTRAINT %s before %s or retry convert",
+                RANGE_CHECK, RANGE_CHECK, boundary.date(),
+            )
+        raise
+
+
+async def create_partitions(conn: AsyncConnection, ahead: int = MESSAGE_PARTITIONS_AHEAD, now: datetime = None):
+    """Create the monthly partitions up to ``ahead`` months past the current one; returns their names."""
+    partitions = await list_partitions(conn)
+    month = month_start(now or datetime.utcnow())
+    if partitions:
+        month = max(month, partitions[-1][2])
+    last = add_months(month_start(now or datetime.utcnow()), ahead)
+    created = []
+    while month <= last:
+        name = partition_name(month)
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        ))
+        created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+async def _archive_table(engine: AsyncEngine, name: str) -> int:
+    columns = table(name, *[column(c.name) for c in Message.__table__.columns])
+    async with engine.begin() as conn:
+        archived = await archive.export_messages(
+            conn,
+            select(*columns.c).order_by(columns.c.chatroom_id, columns.c.created_at, columns.c.id),
+            period=name,
+        )
+        # asyncpg keeps the export's cursor open until commit, and an open cursor blocks the DROP
+        await conn.execute(text("CLOSE ALL"))
+        await conn.execute(text(f"DROP TABLE {name}"))
+    return archived
+
+
+async def _forget_archived(engine: AsyncEngine, periods: List[str]):
+    """Drop the context windows of the chatrooms that had messages archived under ``periods``."""
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(MessageArchive.chatroom_id).where(MessageArchive.period.in_(periods)).distinct()
+        )
+        chatrooms = result.scalars().all()
+    await context.forget(redis_client, chatrooms)
+
+
+async def archive_old(engine: AsyncEngine, hot_months: int = MESSAGE_HOT_MONTHS, now: datetime = None) -> int:
+    """Move messages older than ``hot_months`` whole months into the archive; returns how many."""
+    cutoff = add_months(month_start(now or datetime.utcnow()), -hot_months)
+    async with engine.begin() as conn:
+        partitioned = await is_partitioned(conn)
+        if partitioned:
+            old = [name for name, _, upper in await list_partitions(conn) if upper <= cutoff]
+            # Left behind by a run that stopped between detaching and dropping
+            result = await conn.execute(text(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+                "AND relnamespace = to_regnamespace(current_schema()) "
+                f"AND (relname LIKE 'messages\\_p%' OR relname = '{LEGACY_PARTITION}') ORDER BY relname"
+            ))
+            detached = result.scalars().all()
+    if not partitioned:
+        source = (
+            select(*Message.__table__.c)
+            .where(Message.created_at < cutoff)
+            .order_by(Message.chatroom_id, Message.created_at, Message.id)
+        )
+        period = f"messages_before_{cutoff:%Y%m}"
+        async with engine.begin() as conn:
+            archived = await archive.export_messages(conn, source, period=period)
+            await conn.execute(delete(Message.__table__).where(Message.created_at < cutoff))
+        if archived:
+            await _forget_archived(engine, [period])
+        logger.info("Archived %d messages from before %s", archived, cutoff.date())
+        return archived
+
+    total = 0
+    # The legacy partition sorts after messages_p*, but it holds the oldest rows
+    for name in sorted(detached, key=lambda name: name != LEGACY_PARTITION):
+        total += await _archive_table(engine, name)
+        logger.info("Archived previously detached %s", name)
+    for name in old:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+            await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        archived = await _archive_table(engine, name)
+        logger.info("Archived partition %s: %d messages", name, archived)
+        total += archived
+    if detached or old:
+        await _forget_archived(engine, detached + old)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage messages partitions and the message archive")
+    parser.add_argument("command", choices=["convert", "create", "archive", "maintain", "list"])
+    parser.add_argument("--ahead", type=int, default=MESSAGE_PARTITIONS_AHEAD)
+    parser.add_argument("--hot-months", type=int, default=MESSAGE_HOT_MONTHS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    async def partition(conn):
+        if not await is_partitioned(conn):
+            # maintain still archives an unpartitioned table
+            if args.command != "maintain":
+                raise SystemExit("messages is not partitioned; run convert first (PostgreSQL only)")
+            return
+        if args.command == "list":
+            for name, lower, upper in await list_partitions(conn):
+                print(f"{name:<20} {lower or 'MINVALUE'} .. {upper}")
+            return
+        logger.info("Partitions ensured: %s", ", ".join(await create_partitions(conn, args.ahead)))
+
+    async def run():
+        from app.db.engine import create_engine
+        engine = create_engine()
+        try:
+            if args.command == "convert":
+                async with engine.connect() as conn:
+                    if await is_partitioned(conn):
+                        raise SystemExit("messages is already partitioned")
+                await convert(engine)
+            if args.command != "archive":
+                async with engine.begin() as conn:
+                    await partition(conn)
+            if args.command in ("archive", "maintain"):
+                logger.info("Archived %d messages", await archive_old(engine, args.hot_months))
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
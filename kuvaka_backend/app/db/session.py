@@ -1,12 +1,13 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
+from app.db.engine import create_engine
 
 import os
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL environment variable is not set! Check your .env and working directory.")
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+engine = create_engine(DATABASE_URL)
 AsyncSessionLocal = sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
 )
@@ -6,17 +6,37 @@ env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "
 load_dotenv(dotenv_path=env_path)
 
 from fastapi import FastAPI
-from app.api.v1 import auth, user, chatroom, subscription, messages_cleanup
+from app.api.v1 import auth, user, chatroom, subscription, messages_cleanup, metrics, profiles
 from app.core.error_handling import setup_error_handlers
+from app.core.instrumentation import METRICS_ENABLED, MetricsMiddleware
+from app.core.profiling import PROFILING_ENABLED, ProfilingMiddleware
+from app.core.redis import redis_client
+from app.core.rate_limit import RATE_LIMIT_ENABLED, RateLimitMiddleware
+from app.core.password_hasher import password_hasher
+from app.services.gemini import close_api_client
 
 app = FastAPI()
 setup_error_handlers(app)
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware, redis=redis_client)
+# Outermost, so rate-limited requests are measured too
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_api_client()
+    password_hasher.shutdown()
 
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(user.router, prefix="/user", tags=["user"])
 app.include_router(chatroom.router, tags=["chatroom"])
 app.include_router(subscription.router, tags=["subscription"])
 app.include_router(messages_cleanup.router)
+app.include_router(metrics.router, tags=["metrics"])
+app.include_router(profiles.router, tags=["admin"])
 
 # Render free tier: auto-initialize DB if env var set
 if os.environ.get("RENDER_DB_INIT") == "1":
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, DateTime, true
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 from app.models.user import Base
@@ -8,6 +8,10 @@ class Chatroom(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     name = Column(String, nullable=False)
+    # Opt-out of the shared Gemini response cache (app/services/response_cache.py)
+    cache_responses = Column(Boolean, nullable=False, default=True, server_default=true())
+    # Newest archived message (app/services/archive.py); history reads only look at archives when set
+    archived_until = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     messages = relationship("Message", back_populates="chatroom")
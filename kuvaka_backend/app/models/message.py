@@ -1,9 +1,15 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+import enum
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, Enum
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.models.user import Base
 # Do NOT import Chatroom here; use string references in relationships only.
 
+class MessageStatus(str, enum.Enum):
+    pending = "pending"
+    done = "done"
+    error = "error"
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -11,5 +17,24 @@ class Message(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
     gemini_response = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set by the worker: done with gemini_response, or error with the failure in ``error``
+    status = Column(
+        Enum(MessageStatus, name="message_status", native_enum=False, length=16,
+             values_callable=lambda statuses: [s.value for s in statuses]),
+        nullable=False, default=MessageStatus.pending, server_default=MessageStatus.pending.value,
+    )
+    error = Column(Text, nullable=True)
+    # Partition key on PostgreSQL (app/db/partitions.py), so never NULL
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     chatroom = relationship("Chatroom", back_populates="messages")
+
+    __table_args__ = (
+        # Keyset pagination of chatroom history: WHERE chatroom_id = ? ORDER BY created_at, id
+        Index("ix_messages_chatroom_created_id", "chatroom_id", "created_at", "id"),
+        # Cleanup only ever looks at unfinished messages, a small slice of the table
+        Index(
+            "ix_messages_user_not_done", "user_id",
+            postgresql_where=status != MessageStatus.done.value,
+            sqlite_where=status != MessageStatus.done.value,
+        ),
+    )
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
+from datetime import datetime
+from app.models.user import Base
+
+class MessageArchive(Base):
+    """One archive file: a chatroom's messages from one archived period.
+
+    Written by ``app.services.archive`` when old messages leave the
+    ``messages`` table; history reads use it to find the files to open.
+    """
+    __tablename__ = "message_archives"
+    id = Column(Integer, primary_key=True)
+    chatroom_id = Column(Integer, ForeignKey("chatrooms.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    period = Column(String(64), nullable=False)
+    path = Column(String(512), nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_created_at = Column(DateTime, nullable=False)
+    last_created_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_message_archives_chatroom_last", "chatroom_id", "last_created_at"),
+    )
@@ -0,0 +1,28 @@
+from sqlalchemy import JSON, Column, DateTime, Index, Integer, String, or_
+from datetime import datetime
+from app.models.user import Base
+
+class OutboxEvent(Base):
+    """A Celery task to publish, written in the same transaction as the row it is about.
+
+    ``app.services.outbox`` relays pending events to the broker and deletes them.
+    ``user_id`` and ``tier`` let ``app.services.scheduler`` share the relay fairly.
+    An event with ``available_at`` set is held back until then.
+    """
+    __tablename__ = "outbox"
+    # Ids become task ids, so SQLite must not reuse them either
+    __table_args__ = (
+        Index("ix_outbox_user_id_id", "user_id", "id"),
+        {"sqlite_autoincrement": True},
+    )
+    id = Column(Integer, primary_key=True)
+    task = Column(String(255), nullable=False)
+    args = Column(JSON, nullable=False)
+    user_id = Column(Integer, nullable=True)
+    tier = Column(String(16), nullable=True)
+    available_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def claimable(cls, now: datetime):
+        return or_(cls.available_at.is_(None), cls.available_at <= now)
@@ -12,22 +12,49 @@ class MessageResponse(MessageBase):
     id: int
     user_id: int
     gemini_response: Optional[str]
+    status: str = "pending"
+    error: Optional[str] = None
     created_at: datetime
 
     class Config:
         orm_mode = True
 
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    next_cursor: Optional[str] = None
+
+class MessageBatchCreate(BaseModel):
+    messages: List[MessageCreate]
+
+class MessageBatchItem(BaseModel):
+    index: int
+    status: str
+    message: Optional[MessageResponse] = None
+    error: Optional[str] = None
+
+class MessageBatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[MessageBatchItem]
+
 class ChatroomBase(BaseModel):
     name: str
 
 class ChatroomCreate(ChatroomBase):
-    pass
+    cache_responses: bool = True
+
+class ChatroomUpdate(BaseModel):
+    name: Optional[str] = None
+    cache_responses: Optional[bool] = None
 
 class ChatroomResponse(ChatroomBase):
     id: int
     user_id: int
+    cache_responses: bool = True
     created_at: datetime
     updated_at: datetime
+    message_count: int = 0
+    last_message_at: Optional[datetime] = None
     messages: List[MessageResponse] = []
 
     class Config:
@@ -0,0 +1,145 @@
+"""Archive of old messages, as gzip-compressed JSON Lines files.
+
+Messages older than ``MESSAGE_HOT_MONTHS`` leave the ``messages`` table
+(``python -m app.db.partitions archive``). They are written to
+``MESSAGE_ARCHIVE_DIR/<period>/<chatroom_id>.jsonl.gz``, one JSON object per
+message in (created_at, id) order. Each file gets a ``MessageArchive`` row,
+and ``Chatroom.archived_until`` records the newest archived message.
+
+Nothing is read back until someone pages past the start of a chatroom's live
+history. ``read_page`` then opens only the files that page needs, in a
+thread, and keeps the last ``MESSAGE_ARCHIVE_CACHE_FILES`` of them decoded.
+"""
+import asyncio
+import gzip
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import orjson
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import Select
+
+from app.models.chatroom import Chatroom
+from app.models.message import Message
+from app.models.message_archive import MessageArchive
+
+MESSAGE_ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "message_archive")
+MESSAGE_ARCHIVE_CACHE_FILES = int(os.getenv("MESSAGE_ARCHIVE_CACHE_FILES", "32"))
+
+ARCHIVE_COLUMNS = tuple(column.name for column in Message.__table__.columns)
+
+_files: "OrderedDict[str, List[dict]]" = OrderedDict()
+
+
+def _write_file(path: str, records: List[dict]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.partial"
+    with gzip.open(partial, "wb") as out:
+        for record in records:
+            out.write(orjson.dumps(record) + b"\n")
+    os.replace(partial, path)
+
+
+def _read_file(path: str) -> List[dict]:
+    with gzip.open(path, "rb") as archived:
+        records = [orjson.loads(line) for line in archived]
+    for record in records:
+        record["created_at"] = datetime.fromisoformat(record["created_at"])
+    return records
+
+
+async def export_messages(conn: AsyncConnection, source: Select, period: str) -> int:
+    """Write the messages ``source`` selects to archive files and index them (no commit).
+
+    ``source`` must return every ``messages`` column, ordered by chatroom_id,
+    created_at and id. Returns how many messages were archived.
+    """
+    entries = []
+
+    async def flush(records):
+        relative = os.path.join(period, f"{records[0]['chatroom_id']}.jsonl.gz")
+        await asyncio.to_thread(_write_file, os.path.join(MESSAGE_ARCHIVE_DIR, relative), records)
+        entries.append({
+            "chatroom_id": records[0]["chatroom_id"],
+            "user_id": records[0]["user_id"],
+            "period": period,
+            "path": relative,
+            "message_count": len(records),
+            "first_created_at": records[0]["created_at"],
+            "last_created_at": records[-1]["created_at"],
+            "created_at": datetime.utcnow(),
+        })
+
+    records = []
+    result = await conn.stream(source)
+    async for row in result:
+        record = dict(zip(ARCHIVE_COLUMNS, row))
+        if records and record["chatroom_id"] != records[0]["chatroom_id"]:
+            await flush(records)
+            records = []
+        records.append(record)
+    if records:
+        await flush(records)
+    if not entries:
+        return 0
+    await conn.execute(insert(MessageArchive), entries)
+    # Periods are archived oldest first, so the last file of a chatroom holds its newest archived message
+    await conn.execute(
+        update(Chatroom.__table__)
+        .where(Chatroom.__table__.c.id == bindparam("chatroom"))
+        .values(archived_until=bindparam("until")),
+        [{"chatroom": entry["chatroom_id"], "until": entry["last_created_at"]} for entry in entries],
+    )
+    return sum(entry["message_count"] for entry in entries)
+
+
+async def load_file(path: str) -> List[dict]:
+    """Decoded records of one archive file (``MessageArchive.path``), oldest first."""
+    records = _files.get(path)
+    if records is not None:
+        _files.move_to_end(path)
+        return records
+    records = await asyncio.to_thread(_read_file, os.path.join(MESSAGE_ARCHIVE_DIR, path))
+    _files[path] = records
+    while len(_files) > MESSAGE_ARCHIVE_CACHE_FILES:
+        _files.popitem(last=False)
+    return records
+
+
+async def read_page(
+    db: AsyncSession,
+    chatroom_id: int,
+    limit: int,
+    before: Optional[Tuple[datetime, int]] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+) -> List[dict]:
+    """Up to ``limit`` archived messages of a chatroom, keyset-paged on (created_at, id).
+
+    Newest first below ``before`` (or from the newest archived message), or
+    oldest first above ``after`` -- the order of the live history query.
+    """
+    q = select(MessageArchive.path).where(MessageArchive.chatroom_id == chatroom_id)
+    if after:
+        q = q.where(MessageArchive.last_created_at >= after[0]).order_by(MessageArchive.first_created_at)
+    else:
+        if before:
+            q = q.where(MessageArchive.first_created_at <= before[0])
+        q = q.order_by(MessageArchive.last_created_at.desc())
+    paths = (await db.execute(q)).scalars().all()
+    page = []
+    for path in paths:
+        records = await load_file(path)
+        if after:
+            page.extend(record for record in records if (record["created_at"], record["id"]) > after)
+        else:
+            page.extend(
+                record for record in reversed(records)
+                if before is None or (record["created_at"], record["id"]) < before
+            )
+        if len(page) >= limit:
+            break
+    return page[:limit]
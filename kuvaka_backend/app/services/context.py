@@ -0,0 +1,189 @@
+"""Conversation history for Gemini calls.
+
+Each chatroom keeps a rolling window of its last ``CONTEXT_WINDOW_TURNS``
+completed turns in a Redis list (``context:chatroom:{id}``). A turn is
+added when its reply is saved, so building the prompt for a new message
+is one LRANGE instead of a SELECT over the whole chatroom. Replies finish
+out of order, so each turn goes in at its message's (created_at, id)
+position. A missing window (first use, expiry, Redis flush) is seeded from
+the newest turns in the DB. Deleting or archiving messages drops the
+window (``forget``), and the next prompt seeds it again.
+
+``build_contents`` then walks the window newest-first and keeps as many
+turns as fit in ``CONTEXT_TOKEN_BUDGET`` together with the new message.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.instrumentation import CACHE_REQUESTS, REDIS_LATENCY, timed
+from app.core.redis import redis_client
+from app.models.message import Message
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+CONTEXT_WINDOW_TURNS = int(os.getenv("CONTEXT_WINDOW_TURNS", "50"))
+CONTEXT_TTL = int(os.getenv("CONTEXT_TTL", str(24 * 3600)))
+
+ERROR_PREFIX = "[Gemini API Error]"
+
+# KEYS[1] window list; ARGV: max turns, ttl, turn, its "at", its id. Only extends an existing window,
+# inserting after the newest turn that sorts before it; a turn already in the window is skipped.
+APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local at = ARGV[4]
+local id = tonumber(ARGV[5])
+local turns = redis.call('LRANGE', KEYS[1], 0, -1)
+local pivot = nil
+for i = #turns, 1, -1 do
+    local turn = cjson.decode(turns[i])
+    if turn.id == id then
+        return 0
+    end
+    local turn_at = turn.at or ''
+    if turn_at < at or (turn_at == at and turn.id < id) then
+        pivot = turns[i]
+        break
+    end
+end
+if pivot then
+    redis.call('LINSERT', KEYS[1], 'AFTER', pivot, ARGV[3])
+else
+    redis.call('LPUSH', KEYS[1], ARGV[3])
+end
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS[1] window list; ARGV: ttl, then turns oldest-first. Loses to a concurrent seed.
+SEED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Registered once; callers pass the client to run them on (the worker has its own)
+_append = redis_client.register_script(APPEND_SCRIPT)
+_seed = redis_client.register_script(SEED_SCRIPT)
+
+
+def window_key(chatroom_id: int) -> str:
+    return f"context:chatroom:{chatroom_id}"
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for Gemini's tokenizer on English text
+    return max(1, len(text or "") // 4)
+
+
+def make_turn(message_id: int, content: str, reply: str, created_at: datetime = None) -> dict:
+    return {
+        "id": message_id,
+        # Fixed width, so the append script can order turns by comparing strings
+        "at": created_at.isoformat(timespec="microseconds") if created_at else "",
+        "user": content,
+        "model": reply,
+        "tokens": estimate_tokens(content) + estimate_tokens(reply),
+    }
+
+
+def is_complete(reply: Optional[str]) -> bool:
+    return bool(reply) and not reply.startswith(ERROR_PREFIX)
+
+
+def build_contents(turns: List[dict], user_message: str, budget: int = None) -> List[dict]:
+    """Gemini ``contents``: the newest turns that fit ``budget`` followed by ``user_message``."""
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    remaining = budget - estimate_tokens(user_message)
+    kept = []
+    for turn in reversed(turns):
+        if turn["tokens"] > remaining:
+            break
+        remaining -= turn["tokens"]
+        kept.append(turn)
+    contents = []
+    for turn in reversed(kept):
+        contents.append({"role": "user", "parts": [{"text": turn["user"]}]})
+        contents.append({"role": "model", "parts": [{"text": turn["model"]}]})
+    contents.append({"role": "user", "parts": [{"text": user_message}]})
+    return contents
+
+
+async def load_turns_from_db(db: AsyncSession, chatroom_id: int, limit: int = None) -> List[dict]:
+    """Newest ``limit`` completed turns, oldest-first. Bounded by the window, not the history."""
+    limit = limit or CONTEXT_WINDOW_TURNS
+    result = await db.execute(
+        select(Message.id, Message.content, Message.gemini_response, Message.created_at)
+        .where(Message.chatroom_id == chatroom_id, Message.gemini_response.isnot(None))
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit)
+    )
+    rows = [row for row in result.all() if is_complete(row.gemini_response)]
+    return [make_turn(row.id, row.content, row.gemini_response, row.created_at) for row in reversed(rows)]
+
+
+async def get_window(redis, db: AsyncSession, chatroom_id: int) -> List[dict]:
+    key = window_key(chatroom_id)
+    try:
+        with timed(REDIS_LATENCY, "context_window_read"):
+            raw = await redis.lrange(key, 0, -1)
+    except Exception:
+        logger.warning("Context window unavailable for chatroom %s", chatroom_id, exc_info=True)
+        return await load_turns_from_db(db, chatroom_id)
+    if raw:
+        CACHE_REQUESTS.labels("context_window", "hit").inc()
+        return [orjson.loads(item) for item in raw]
+    CACHE_REQUESTS.labels("context_window", "miss").inc()
+    turns = await load_turns_from_db(db, chatroom_id)
+    if turns:
+        try:
+            await _seed(keys=[key], args=[CONTEXT_TTL] + [orjson.dumps(turn) for turn in turns], client=redis)
+        except Exception:
+            logger.warning("Could not seed context window for chatroom %s", chatroom_id, exc_info=True)
+    return turns
+
+
+async def build_context(
+    redis, db: AsyncSession, chatroom_id: int, message_id: int, user_message: str, budget: int = None
+) -> List[dict]:
+    turns = await get_window(redis, db, chatroom_id)
+    # A retried task may find its own turn already in the window
+    turns = [turn for turn in turns if turn["id"] != message_id]
+    return build_contents(turns, user_message, budget)
+
+
+async def record_turn(redis, chatroom_id: int, message_id: int, content: str, reply: str, created_at: datetime):
+    """Add a finished turn to the chatroom's window in message order (no-op until the window is seeded)."""
+    if not is_complete(reply):
+        return
+    turn = make_turn(message_id, content, reply, created_at)
+    try:
+        await _append(
+            keys=[window_key(chatroom_id)],
+            args=[CONTEXT_WINDOW_TURNS, CONTEXT_TTL, orjson.dumps(turn), turn["at"], message_id],
+            client=redis,
+        )
+    except Exception:
+        logger.warning("Could not extend context window for chatroom %s", chatroom_id, exc_info=True)
+
+
+async def forget(redis, chatroom_ids: Iterable[int]):
+    """Drop the windows of chatrooms that lost messages; each is seeded from the DB again on its next prompt."""
+    keys = [window_key(chatroom_id) for chatroom_id in set(chatroom_ids)]
+    try:
+        for start in range(0, len(keys), 1000):
+            await redis.delete(*keys[start:start + 1000])
+    except Exception:
+        logger.warning("Could not drop %d context windows", len(keys), exc_info=True)
@@ -9,73 +9,229 @@ load_dotenv(dotenv_path=env_path)
 
 
 # Force import all models to ensure SQLAlchemy relationships are registered
-from app.models import chatroom, message, user
+from app.models import chatroom, message, outbox, user
+from app.models.message import Message, MessageStatus
 
-import asyncio
+import json
 import logging
-from app.core.celery_app import celery_app
-import asyncio
 import os
+import re
+import time
 import httpx
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.future import select
-from app.models.message import Message
+from app.core import profiling
+from app.core.celery_app import celery_app
+from app.core.instrumentation import GEMINI_LATENCY, record_usage
+from app.core.notifications import publish_message_completed
+from app.core.worker_runtime import WorkerRuntime, build_http_client, get_runtime
+from app.services import context
+from app.services.gemini_client import (
+    GEMINI_MAX_RETRIES, GEMINI_RETRY_BACKOFF, GEMINI_RETRY_BACKOFF_MAX,
+    GeminiClient, GeminiRetryableError, gemini_timeout, retry_countdown,
+)
+from app.services.response_cache import RESPONSE_CACHE_ENABLED, cache_scope, chatroom_opted_in, response_cache
 
-DATABASE_URL = os.getenv("DATABASE_URL")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_API_URL = os.getenv(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent",
+)
+GEMINI_STREAM_URL = os.getenv(
+    "GEMINI_STREAM_URL", GEMINI_API_URL.replace(":generateContent", ":streamGenerateContent")
+)
 
-async def call_gemini_api(user_message: str, api_key: str) -> str:
-    headers = {"x-goog-api-key": api_key, "Content-Type": "application/json"}
-    payload = {
-        "contents": [
+def build_payload(user_message: str, contents: list = None) -> dict:
+    # ``contents`` is the full conversation from context.build_context, ending with user_message
+    return {
+        "contents": contents or [
             {"role": "user", "parts": [{"text": user_message}]}
         ]
     }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(GEMINI_API_URL, headers=headers, json=payload)
+
+class UnparsedReply(str):
+    """The raw response body, saved when no reply text could be extracted; never cached."""
+
+def extract_text(data: dict):
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def model_url(model: str = None) -> str:
+    """GEMINI_API_URL, pointed at ``model`` when one is given."""
+    if not model:
+        return GEMINI_API_URL
+    return re.sub(r"/models/[^/:]+:", f"/models/{model}:", GEMINI_API_URL)
+
+async def call_gemini_api(
+    user_message: str, api_key: str, client: httpx.AsyncClient = None, contents: list = None, url: str = None
+) -> str:
+    if client is None:
+        async with httpx.AsyncClient(timeout=gemini_timeout()) as own_client:
+            return await call_gemini_api(user_message, api_key, own_client, contents, url)
+    headers = {"x-goog-api-key": api_key, "Content-Type": "application/json"}
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        resp = await client.post(url or GEMINI_API_URL, headers=headers, json=build_payload(user_message, contents))
         resp.raise_for_status()
         data = resp.json()
-        # Debug: log full Gemini API response
-                # Try to extract the text response robustly
-        try:
-            return data["candidates"][0]["content"]["parts"][0]["text"]
-        except Exception as parse_exc:
-                        return str(data)  # Save raw response if parsing fails
+        outcome = "ok"
+    finally:
+        GEMINI_LATENCY.labels("call", outcome).observe(time.perf_counter() - started)
+    record_usage(data.get("usageMetadata") if isinstance(data, dict) else None)
+    # Try to extract the text response robustly
+    text = extract_text(data)
+    if text is None:
+        return UnparsedReply(data)  # Save raw response if parsing fails
+    return text
 
-import logging
+async def stream_gemini_api(user_message: str, api_key: str, client: httpx.AsyncClient, contents: list = None):
+    """Yield reply text chunks from streamGenerateContent (SSE framing) as they arrive."""
+    headers = {"x-goog-api-key": api_key, "Content-Type": "application/json"}
+    started = time.perf_counter()
+    outcome = "error"
+    usage = None
+    try:
+        async with client.stream(
+            "POST", GEMINI_STREAM_URL, params={"alt": "sse"}, headers=headers,
+            json=build_payload(user_message, contents),
+        ) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[5:])
+                # Each chunk carries the running totals; the last one wins
+                usage = data.get("usageMetadata") or usage
+                text = extract_text(data)
+                if text:
+                    yield text
+        outcome = "ok"
+    finally:
+        GEMINI_LATENCY.labels("stream", outcome).observe(time.perf_counter() - started)
+        record_usage(usage)
 
-@celery_app.task
-def process_gemini_message(message_id: int, user_message: str):
-    async def do_work():
+# Shared client for streaming from the API process; closed on app shutdown
+_api_client = None
+# Breaker and concurrency limit for streaming calls made by the API process
+api_gemini = GeminiClient()
+
+def get_api_client() -> httpx.AsyncClient:
+    global _api_client
+    if _api_client is None:
+        _api_client = build_http_client()
+    return _api_client
+
+async def close_api_client():
+    global _api_client
+    client, _api_client = _api_client, None
+    if client is not None:
+        await client.aclose()
+
+async def handle_gemini_message(
+    runtime: WorkerRuntime, message_id: int, user_message: str, chatroom_id: int = None, final_attempt: bool = True
+):
+    """Generate and save the reply for ``message_id``.
+
+    Transient Gemini failures raise ``GeminiRetryableError`` so the caller can
+    retry later; on the ``final_attempt`` (and for fatal errors) the message is
+    marked ``error`` instead.
+    """
+    # Sampled with PROFILE_TASK_SAMPLE_RATE when PROFILING_ENABLED=1; a no-op otherwise
+    async with profiling.maybe_profile(
+        "task", "process_gemini_message", runtime.redis, {"message_id": message_id, "chatroom_id": chatroom_id}
+    ):
+        return await _handle_gemini_message(runtime, message_id, user_message, chatroom_id, final_attempt)
+
+async def _handle_gemini_message(
+    runtime: WorkerRuntime, message_id: int, user_message: str, chatroom_id: int, final_attempt: bool
+):
+    # Serve repeated prompts from the response cache unless the chatroom opted out
+    contents = None
+    cached = None
+    use_cache = RESPONSE_CACHE_ENABLED
+    try:
+        async with runtime.sessionmaker() as session:
+            # Delivery is at least once: a redelivered or republished task finds its message already answered
+            status = (await session.execute(select(Message.status).where(Message.id == message_id))).scalar()
+            if status != MessageStatus.pending:
+                logging.info("Skipping message %s: %s", message_id, status.value if status else "deleted")
+                return True
+            if use_cache and chatroom_id is not None:
+                use_cache = await chatroom_opted_in(session, chatroom_id)
+            # Prior turns of the chatroom, from its rolling window (tasks queued before chatroom_id existed get none)
+            if chatroom_id is not None:
+                contents = await context.build_context(runtime.redis, session, chatroom_id, message_id, user_message)
+    except Exception:
+        logging.exception("Error building context for message %s", message_id)
+    # A reply to a conversation is only reused by that same conversation
+    scope = cache_scope(chatroom_id, contents)
+    if use_cache:
+        cached = await response_cache.lookup(runtime.redis, user_message, scope)
+
+    gemini_response = cached
+    error = None
+    if cached is None:
+        # Through the runtime's dispatcher: identical in-flight requests share one call, the rest are
+        # spread over the key pool, each behind the breaker and concurrency limit
+        started = time.perf_counter()
         try:
-            # Call Gemini API
-            try:
-                gemini_response = await call_gemini_api(user_message, GEMINI_API_KEY)
-            except Exception as e:
-                logging.exception("Error calling Gemini API")
-                gemini_response = f"[Gemini API Error] {str(e)}"
-
-            # Update the message in DB
-            try:
-                engine = create_async_engine(DATABASE_URL, echo=False)
-                async with AsyncSession(engine) as session:
-                    result = await session.execute(select(Message).where(Message.id == message_id))
-                    message = result.scalar_one_or_none()
-                    if message:
-                        message.gemini_response = gemini_response
-                        await session.commit()
-                await engine.dispose()
-            except Exception as db_exc:
-                logging.exception("Error updating Gemini response in DB")
-                return f"DB Error: {db_exc}"
-            return True
+            gemini_response = await runtime.dispatcher.dispatch(
+                build_payload(user_message, contents),
+                lambda slot: call_gemini_api(
+                    user_message, slot.api_key, runtime.http_client, contents, model_url(slot.model)
+                ),
+            )
+            if use_cache and not isinstance(gemini_response, UnparsedReply):
+                await response_cache.store(
+                    runtime.redis, user_message, gemini_response, time.perf_counter() - started, scope
+                )
+        except GeminiRetryableError as exc:
+            if not final_attempt:
+                raise
+            logging.error("Giving up on Gemini for message %s: %s", message_id, exc)
+            error = str(exc)
         except Exception as exc:
-            logging.exception("process_gemini_message failed")
-            return f"Task Error: {exc}"
+            logging.exception("Error calling Gemini API")
+            error = str(exc)
+
+    # Hand the reply to the runtime's write-back buffer; returns once the batch is committed
     try:
-        return asyncio.run(do_work())
-    except Exception as exc:
-        logging.exception("asyncio.run failed in process_gemini_message")
-        return f"asyncio.run Error: {exc}"
+        message = await runtime.writeback.submit(message_id, gemini_response, error)
+    except Exception as db_exc:
+        logging.exception("Error updating Gemini response in DB")
+        return f"DB Error: {db_exc}"
+
+    # Tell long-polling clients the reply has landed
+    if message:
+        await context.record_turn(
+            runtime.redis, message.chatroom_id, message.id, message.content, gemini_response, message.created_at
+        )
+        try:
+            await publish_message_completed(message, runtime.redis)
+        except Exception:
+            logging.exception("Error publishing completion for message %s", message_id)
+    return True
 
+@celery_app.task(
+    bind=True,
+    autoretry_for=(GeminiRetryableError,),
+    retry_backoff=GEMINI_RETRY_BACKOFF,
+    retry_backoff_max=GEMINI_RETRY_BACKOFF_MAX,
+    retry_jitter=True,
+    max_retries=GEMINI_MAX_RETRIES,
+)
+def process_gemini_message(self, message_id: int, user_message: str, chatroom_id: int = None):
+    final_attempt = self.request.retries >= self.max_retries
+    try:
+        runtime = get_runtime()
+        return runtime.run(handle_gemini_message(runtime, message_id, user_message, chatroom_id, final_attempt))
+    except GeminiRetryableError as exc:
+        if exc.retry_after:
+            # The provider said when to come back; autoretry's backoff alone could be shorter
+            raise self.retry(exc=exc, countdown=retry_countdown(self.request.retries, exc.retry_after))
+        raise
+    except Exception as exc:
+        logging.exception("process_gemini_message failed")
+        return f"Task Error: {exc}"
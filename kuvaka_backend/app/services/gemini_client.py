@@ -0,0 +1,427 @@
+"""Failure handling around Gemini calls.
+
+``GeminiClient.call`` (or ``guard`` for streaming) wraps a request with:
+
+* error classification -- 429, 5xx, timeouts and connection errors raise
+  ``GeminiRetryableError`` (carrying ``Retry-After`` when the provider sent
+  one); other failures raise ``GeminiFatalError``
+* a circuit breaker -- after ``GEMINI_BREAKER_FAILURES`` consecutive
+  retryable failures calls fast-fail for ``GEMINI_BREAKER_RESET`` seconds,
+  then a single probe decides whether to close it again
+* an AIMD concurrency limit -- each success raises the limit by about one
+  per window of requests, each overload (429/503/timeout) halves it, so the
+  number of in-flight calls settles near what the provider sustains
+
+Retries themselves are left to the caller: the Celery task retries with
+``retry_countdown``, which is exponential backoff with full jitter but never
+shorter than ``Retry-After``.
+
+Workers send their calls through a ``GeminiDispatcher``. It makes a single
+upstream request for identical payloads that are in flight at the same time,
+and shares the reply. Other calls are spread round-robin over the keys in
+``GEMINI_API_KEYS`` (``key`` or ``key@model``, comma separated). With
+``GEMINI_KEY_RPM`` set, each key is held to a token bucket in Redis, so
+every worker shares the same per-key quota. A key that gets a 429 rests for
+its ``Retry-After`` and the call moves on to the next key. Each key has its
+own circuit breaker, so one exhausted key does not stop the others, and all
+keys share the process's AIMD limit.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+import httpx
+import orjson
+from celery.utils.time import get_exponential_backoff_interval
+
+from app.core.instrumentation import CACHE_REQUESTS
+from app.core.rate_limit import LocalLimiter, RateLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_RETRY_BACKOFF = int(os.getenv("GEMINI_RETRY_BACKOFF", "2"))
+GEMINI_RETRY_BACKOFF_MAX = int(os.getenv("GEMINI_RETRY_BACKOFF_MAX", "120"))
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+GEMINI_AIMD_INITIAL = int(os.getenv("GEMINI_AIMD_INITIAL", "10"))
+GEMINI_AIMD_MIN = int(os.getenv("GEMINI_AIMD_MIN", "1"))
+GEMINI_AIMD_MAX = int(os.getenv("GEMINI_AIMD_MAX", "200"))
+GEMINI_AIMD_BACKOFF = float(os.getenv("GEMINI_AIMD_BACKOFF", "0.5"))
+GEMINI_STREAM_SLOT_WAIT = float(os.getenv("GEMINI_STREAM_SLOT_WAIT", "1"))
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS") or os.getenv("GEMINI_API_KEY", "")
+GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", "0"))  # 0: no client-side quota
+GEMINI_KEY_BURST = int(os.getenv("GEMINI_KEY_BURST", "10"))
+GEMINI_KEY_MAX_WAIT = float(os.getenv("GEMINI_KEY_MAX_WAIT", "5"))
+GEMINI_SINGLE_FLIGHT = os.getenv("GEMINI_SINGLE_FLIGHT", "1") == "1"
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+OVERLOAD_STATUS = {429, 503}
+
+
+def gemini_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        float(os.getenv("GEMINI_READ_TIMEOUT", "30")),
+        connect=float(os.getenv("GEMINI_CONNECT_TIMEOUT", "5")),
+        pool=float(os.getenv("GEMINI_POOL_TIMEOUT", "10")),
+    )
+
+
+class GeminiError(Exception):
+    pass
+
+
+class GeminiFatalError(GeminiError):
+    """The request itself is bad (4xx other than 408/429): retrying won't help."""
+
+
+class GeminiRetryableError(GeminiError):
+    def __init__(
+        self, message: str, retry_after: Optional[float] = None, overload: bool = False, status: Optional[int] = None
+    ):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.overload = overload
+        self.status = status
+
+
+class CircuitOpenError(GeminiRetryableError):
+    """Fast failure while the breaker is open; ``retry_after`` is when it will let a probe through."""
+
+
+class ConcurrencyLimitError(GeminiRetryableError):
+    """No slot under the AIMD limit freed up in time; the call was not made."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(exc: Exception) -> GeminiError:
+    if isinstance(exc, GeminiError):
+        return exc
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        message = f"Gemini API returned {code}"
+        if code in RETRYABLE_STATUS:
+            return GeminiRetryableError(
+                message,
+                retry_after=parse_retry_after(exc.response.headers.get("retry-after")),
+                overload=code in OVERLOAD_STATUS,
+                status=code,
+            )
+        return GeminiFatalError(message)
+    if isinstance(exc, httpx.TimeoutException):
+        return GeminiRetryableError(f"Gemini API timed out: {exc!r}", overload=True)
+    if isinstance(exc, httpx.TransportError):
+        return GeminiRetryableError(f"Gemini API connection failed: {exc!r}")
+    return GeminiFatalError(str(exc))
+
+
+def retry_countdown(retries: int, retry_after: Optional[float] = None) -> float:
+    backoff = get_exponential_backoff_interval(
+        GEMINI_RETRY_BACKOFF, retries, GEMINI_RETRY_BACKOFF_MAX, full_jitter=True
+    )
+    return max(backoff, retry_after or 0)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or GEMINI_BREAKER_FAILURES
+        self.reset_timeout = GEMINI_BREAKER_RESET if reset_timeout is None else reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+
+    def before_call(self):
+        if self.state == "closed":
+            return
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == "open" and remaining <= 0:
+            # Let exactly one probe through; everyone else keeps failing fast until it reports back
+            self.state = "half_open"
+            return
+        self.rejected += 1
+        raise CircuitOpenError("Gemini circuit breaker is open", retry_after=max(remaining, 1.0))
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def abandon_probe(self):
+        # The probe never reached the provider; the next call gets to probe instead
+        if self.state == "half_open":
+            self.state = "open"
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("Gemini circuit breaker opened (%d consecutive failures)", self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class AIMDLimiter:
+    def __init__(self, initial: int = None, min_limit: int = None, max_limit: int = None, backoff: float = None):
+        self.min_limit = min_limit or GEMINI_AIMD_MIN
+        self.max_limit = max_limit or GEMINI_AIMD_MAX
+        self.backoff = backoff or GEMINI_AIMD_BACKOFF
+        self.limit = float(initial or GEMINI_AIMD_INITIAL)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created on first use so it binds to the loop that actually runs the calls
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, timeout: Optional[float] = None):
+        """Wait for a slot; with ``timeout`` (seconds) raise ``ConcurrencyLimitError`` instead of waiting longer."""
+        async with self.condition:
+            has_room = lambda: self.in_flight < int(self.limit)
+            if timeout is None or has_room():
+                await self.condition.wait_for(has_room)
+            else:
+                try:
+                    await asyncio.wait_for(self.condition.wait_for(has_room), timeout)
+                except asyncio.TimeoutError:
+                    raise ConcurrencyLimitError("Gemini concurrency limit reached", retry_after=timeout) from None
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        # Only grow while the limit is actually being used, or it drifts far above real demand
+        if self.in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self, latency: float):
+        # Requests already in flight when the provider pushed back will fail too; count that as one signal
+        now = time.monotonic()
+        if now - self._last_decrease < max(latency, 0.1):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+
+class GeminiClient:
+    def __init__(self, breaker: CircuitBreaker = None, limiter: AIMDLimiter = None):
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AIMDLimiter()
+
+    @asynccontextmanager
+    async def guard(self, acquire_timeout: Optional[float] = None):
+        """Run the body under the breaker and limiter; ``acquire_timeout`` bounds the wait for a slot."""
+        self.breaker.before_call()
+        try:
+            await self.limiter.acquire(acquire_timeout)
+        except BaseException:
+            self.breaker.abandon_probe()
+            raise
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as exc:
+            error = classify(exc)
+            if isinstance(error, GeminiRetryableError):
+                self.breaker.record_failure()
+                if error.overload:
+                    self.limiter.on_overload(time.monotonic() - started)
+            else:
+                # The provider answered; the request was the problem
+                self.breaker.record_success()
+            if error is exc:
+                raise
+            raise error from exc
+        else:
+            self.breaker.record_success()
+            self.limiter.on_success()
+        finally:
+            await self.limiter.release()
+
+    async def call(self, request):
+        """Await ``request()`` (a zero-argument coroutine factory) under the breaker and limiter."""
+        async with self.guard():
+            return await request()
+
+    def stats(self) -> dict:
+        return {
+            "breaker_state": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+            "breaker_rejected": self.breaker.rejected,
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+        }
+
+
+def parse_api_keys(value: str) -> List[Tuple[str, Optional[str]]]:
+    """``"k1,k2@gemini-2.0-flash-lite"`` -> [("k1", None), ("k2", "gemini-2.0-flash-lite")]"""
+    keys = []
+    for item in value.split(","):
+        key, _, model = item.strip().partition("@")
+        if key:
+            keys.append((key, model or None))
+    return keys
+
+
+class KeySlot:
+    def __init__(self, api_key: str, model: Optional[str] = None, client: GeminiClient = None):
+        self.api_key = api_key
+        self.model = model
+        self.client = client or GeminiClient()
+        # Names the key in Redis and in stats without exposing it
+        self.name = hashlib.sha256(api_key.encode()).hexdigest()[:12] + (f"@{model}" if model else "")
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.throttled = 0
+
+    def resting_for(self, now: float) -> float:
+        """Seconds until this key may be used again (0 if it can be used now)."""
+        wait = self.cooldown_until - now
+        breaker = self.client.breaker
+        if breaker.state == "open":
+            wait = max(wait, breaker.opened_at + breaker.reset_timeout - now)
+        elif breaker.state == "half_open":
+            # Its probe is in flight
+            wait = max(wait, 1.0)
+        return max(wait, 0.0)
+
+
+class GeminiDispatcher:
+    def __init__(
+        self, client: GeminiClient, keys: List[Tuple[str, Optional[str]]] = None, redis=None,
+        rpm: float = None, burst: int = None, single_flight: bool = None, max_wait: float = None,
+    ):
+        self.client = client
+        self.slots = [
+            KeySlot(key, model, GeminiClient(limiter=client.limiter))
+            for key, model in (parse_api_keys(GEMINI_API_KEYS) if keys is None else keys)
+        ]
+        rpm = GEMINI_KEY_RPM if rpm is None else rpm
+        self.policy = TokenBucket(capacity=burst or GEMINI_KEY_BURST, refill_per_second=rpm / 60) if rpm else None
+        self.limiter = RateLimiter(redis) if redis is not None else LocalLimiter()
+        self.single_flight = GEMINI_SINGLE_FLIGHT if single_flight is None else single_flight
+        self.max_wait = GEMINI_KEY_MAX_WAIT if max_wait is None else max_wait
+        self.coalesced = 0
+        self._next = 0
+        self._in_flight = {}
+
+    async def dispatch(self, payload: dict, request):
+        """Await ``request(slot)`` for ``payload``; concurrent identical payloads share one call."""
+        if not self.single_flight:
+            return await self._call(request)
+        key = hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).digest()
+        leader = self._in_flight.get(key)
+        if leader is not None:
+            self.coalesced += 1
+            CACHE_REQUESTS.labels("gemini_single_flight", "hit").inc()
+            try:
+                return await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                if not leader.cancelled():
+                    raise
+                # The leading task was cancelled, not us: make the call ourselves
+                return await self._call(request)
+        CACHE_REQUESTS.labels("gemini_single_flight", "miss").inc()
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await self._call(request)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # followers re-raise it; don't warn when there are none
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def _call(self, request):
+        tried = set()
+        while True:
+            slot = await self._acquire(tried)
+            slot.calls += 1
+            try:
+                return await slot.client.call(lambda: request(slot))
+            except GeminiRetryableError as exc:
+                if exc.status == 429:
+                    # Quota on this key: rest it and try the others before giving up
+                    slot.throttled += 1
+                    slot.cooldown_until = time.monotonic() + (exc.retry_after or 1.0)
+                elif not isinstance(exc, CircuitOpenError):
+                    raise
+                tried.add(slot)
+                if len(tried) == len(self.slots):
+                    raise
+
+    async def _acquire(self, exclude=()) -> KeySlot:
+        if not self.slots:
+            raise GeminiFatalError("No Gemini API key configured")
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            waits = []
+            for offset in range(len(self.slots)):
+                slot = self.slots[(self._next + offset) % len(self.slots)]
+                if slot in exclude:
+                    continue
+                resting = slot.resting_for(now)
+                if resting:
+                    waits.append(resting)
+                    continue
+                if self.policy is not None:
+                    decision = await self._hit(slot)
+                    if not decision.allowed:
+                        waits.append(decision.retry_after)
+                        continue
+                self._next = (self._next + offset + 1) % len(self.slots)
+                return slot
+            wait = min(waits, default=None)
+            if wait is None or now + wait > deadline:
+                # Every key is spent for longer than we're willing to hold the task: let the caller retry later
+                raise GeminiRetryableError("Gemini API key quota exhausted", retry_after=wait)
+            await asyncio.sleep(wait)
+
+    async def _hit(self, slot: KeySlot):
+        key = f"gemini_key:{slot.name}"
+        if isinstance(self.limiter, LocalLimiter):
+            return self.limiter.hit(key, self.policy)
+        return await self.limiter.hit(key, self.policy)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "coalesced": self.coalesced,
+            "in_flight_payloads": len(self._in_flight),
+            "keys": [
+                {"key": slot.name, "calls": slot.calls, "throttled": slot.throttled,
+                 "resting_seconds": round(slot.resting_for(now), 3), "breaker_state": slot.client.breaker.state}
+                for slot in self.slots
+            ],
+        }
@@ -0,0 +1,219 @@
+"""Asyncio consumer for the Gemini queues (``gemini.pro``, ``gemini.basic`` and ``gemini``).
+
+Alternative to the prefork Celery worker: a single process keeps up to
+``--concurrency`` Gemini calls in flight on one event loop. Messages are read
+by a kombu consumer on a background thread and acknowledged only after the
+task body finished (late ack), so a crashed process hands its work back to the
+broker. Broker QoS (prefetch == concurrency) provides backpressure.
+
+    python celery_worker.py asyncio --concurrency 300
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import queue
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from kombu import Connection, Queue
+
+from app.core.celery_app import GEMINI_QUEUES, celery_app
+from app.core.instrumentation import TASK_RUNTIME, observe_queue_wait, start_metrics_server
+from app.core.worker_runtime import WorkerRuntime, set_runtime
+from app.services.gemini import handle_gemini_message, process_gemini_message
+from app.services.gemini_client import GeminiRetryableError, retry_countdown
+from app.services.outbox import RELAYED_HEADERS
+
+logger = logging.getLogger(__name__)
+
+
+def decode_task_message(body, message):
+    # Celery protocol v2 sends (args, kwargs, embed); protocol v1 sends a dict
+    if isinstance(body, dict):
+        return message.headers.get("task") or body.get("task"), body.get("args", ()), body.get("kwargs", {})
+    args, kwargs = body[0], body[1]
+    return message.headers.get("task"), args, kwargs
+
+
+def retry_state(body, message):
+    """(retries so far, seconds until the task's ETA) from a Celery message."""
+    source = body if isinstance(body, dict) else message.headers
+    retries = source.get("retries") or 0
+    eta = source.get("eta")
+    delay = 0.0
+    if eta:
+        try:
+            eta_at = datetime.fromisoformat(eta)
+            if eta_at.tzinfo is None:
+                eta_at = eta_at.replace(tzinfo=timezone.utc)
+            delay = max(0.0, (eta_at - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            logger.warning("Ignoring unparseable eta %r", eta)
+    return retries, delay
+
+
+class GeminiConsumer:
+    def __init__(
+        self, concurrency: int = 200, queues=GEMINI_QUEUES, broker_url: str = None, shutdown_timeout: float = 30.0
+    ):
+        self.concurrency = concurrency
+        self.queue_names = list(queues)
+        self.broker_url = broker_url or celery_app.conf.broker_url
+        self.shutdown_timeout = shutdown_timeout
+        self.in_flight = 0
+        self.processed = 0
+        self._settled = queue.SimpleQueue()  # (action, message) handed back to the broker thread
+        self._stopping = threading.Event()
+        self._drained = threading.Event()
+        self._tasks = set()
+        self._loop = None
+        self._slots = None
+        self.runtime = None
+
+    def stop(self):
+        self._stopping.set()
+
+    # --- broker thread -------------------------------------------------
+    def _on_message(self, body, message):
+        try:
+            task_name, args, kwargs = decode_task_message(body, message)
+        except Exception:
+            logger.exception("Malformed message on gemini queue, rejecting")
+            message.reject(requeue=False)
+            return
+        if task_name != process_gemini_message.name:
+            logger.error("Unexpected task %s on gemini queue, rejecting", task_name)
+            message.reject(requeue=False)
+            return
+        retries, delay = retry_state(body, message)
+        asyncio.run_coroutine_threadsafe(self._execute(message, args, kwargs, retries, delay), self._loop)
+
+    def _settle_pending(self):
+        while True:
+            try:
+                action, message = self._settled.get_nowait()
+            except queue.Empty:
+                return
+            if action == "ack":
+                message.ack()
+            else:
+                message.requeue()
+
+    def _consume(self):
+        queues = [Queue(name) for name in self.queue_names]
+        with Connection(self.broker_url) as conn:
+            with conn.Consumer(queues, callbacks=[self._on_message], accept=["json"], prefetch_count=self.concurrency):
+                while not self._stopping.is_set():
+                    self._settle_pending()
+                    try:
+                        conn.drain_events(timeout=0.1)
+                    except socket.timeout:
+                        pass
+            # Stopped consuming; keep settling until the event loop drained in-flight work.
+            # Anything still unacked when the connection closes is restored by the broker.
+            while not (self._drained.is_set() and self._settled.empty()):
+                self._settle_pending()
+                self._drained.wait(0.05)
+
+    # --- event loop ----------------------------------------------------
+    async def _execute(self, message, args, kwargs, retries=0, delay=0.0):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.in_flight += 1
+        try:
+            if delay:
+                # A retry scheduled with a countdown: hold it (unacked) until its ETA, like the Celery worker does
+                await asyncio.sleep(delay)
+            final_attempt = retries >= process_gemini_message.max_retries
+            state = "SUCCESS"
+            try:
+                async with self._slots:
+                    observe_queue_wait(process_gemini_message.name, message.headers)
+                    started = time.perf_counter()
+                    try:
+                        await handle_gemini_message(self.runtime, *args, final_attempt=final_attempt, **kwargs)
+                    except GeminiRetryableError:
+                        state = "RETRY"
+                        raise
+                    except Exception:
+                        state = "FAILURE"
+                        raise
+                    finally:
+                        TASK_RUNTIME.labels(process_gemini_message.name, state).observe(time.perf_counter() - started)
+            except GeminiRetryableError as exc:
+                countdown = retry_countdown(retries, exc.retry_after)
+                logger.warning("Gemini unavailable (%s), retry %d in %.1fs", exc, retries + 1, countdown)
+                await self._loop.run_in_executor(None, functools.partial(
+                    process_gemini_message.apply_async,
+                    args=args, kwargs=kwargs, countdown=countdown, retries=retries + 1,
+                    queue=message.delivery_info.get("routing_key"),  # back to its tier's queue
+                    # Keep the tier and commit time, or the retry drops out of gemini_queue_wait_seconds
+                    headers={name: message.headers[name] for name in RELAYED_HEADERS if name in message.headers},
+                ))
+            self._settled.put(("ack", message))
+            self.processed += 1
+        except asyncio.CancelledError:
+            # Shutdown deadline hit: give the message back to the broker
+            self._settled.put(("requeue", message))
+        except Exception:
+            logger.exception("process_gemini_message failed")
+            self._settled.put(("ack", message))
+        finally:
+            self.in_flight -= 1
+            self._tasks.discard(task)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self.runtime = WorkerRuntime(loop=self._loop, max_connections=self.concurrency)
+        set_runtime(self.runtime)
+        consumer_thread = threading.Thread(target=self._consume, name="gemini-consumer", daemon=True)
+        consumer_thread.start()
+        logger.info("Gemini consumer started: queues=%s concurrency=%d", self.queue_names, self.concurrency)
+        try:
+            while not self._stopping.is_set():
+                await asyncio.sleep(0.1)
+            # Graceful shutdown: let in-flight calls finish, then cancel stragglers
+            if self._tasks:
+                _, pending = await asyncio.wait(set(self._tasks), timeout=self.shutdown_timeout)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+            self._drained.set()
+            await self._loop.run_in_executor(None, consumer_thread.join)
+        finally:
+            await self.runtime.aclose()
+            set_runtime(None)
+        logger.info("Gemini consumer stopped after %d messages", self.processed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Asyncio consumer for the Gemini queues")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--queues", default=",".join(GEMINI_QUEUES), help="comma separated queue names")
+    parser.add_argument("--shutdown-timeout", type=float, default=30.0)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    start_metrics_server()
+    consumer = GeminiConsumer(
+        concurrency=args.concurrency,
+        queues=args.queues.split(","),
+        shutdown_timeout=args.shutdown_timeout,
+    )
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, consumer.stop)
+        await consumer.run()
+
+    asyncio.run(runner())
+
+
+if __name__ == "__main__":
+    main()
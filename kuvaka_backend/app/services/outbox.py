@@ -0,0 +1,228 @@
+"""Transactional outbox for Celery tasks queued by the API.
+
+Request handlers never talk to the broker. They add an ``OutboxEvent`` in
+the same transaction as the row the task is about (``add_gemini_task``), so
+a task exists exactly when its message was committed. The relay drains the
+table and publishes to the broker:
+
+    python celery_worker.py relay --batch-size 500
+
+Each pass locks up to ``OUTBOX_BATCH_SIZE`` of the oldest events with
+``FOR UPDATE SKIP LOCKED``, publishes them over a single producer
+connection, and deletes them in the same transaction. Several relays can
+therefore run side by side without publishing an event twice. A full batch
+is followed straight away by the next one; otherwise the relay sleeps
+``OUTBOX_POLL_INTERVAL`` seconds.
+
+A streamed reply is generated by the API itself, but its event is written
+with the message all the same, held back for ``OUTBOX_STREAM_DELAY`` seconds.
+The endpoint deletes it with the saved reply (``discard_event``), or
+releases it at once when streaming fails (``release_event``). If the API
+process dies mid-stream, the relay picks the event up after the delay.
+
+Gemini tasks go to the queue of the sender's tier. With ``SCHEDULER_ENABLED``
+the relay publishes only as much as those queues have room for, picking
+events fairly across users (``app.services.scheduler``); the rest waits here.
+
+An event is only deleted after the broker accepted it. A relay that dies
+between publishing and committing leaves its batch to be published again.
+Each task id is ``outbox-<event id>``, so such duplicates can be recognised.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List
+
+from sqlalchemy import delete, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+from app.core.celery_app import celery_app
+from app.core.instrumentation import OUTBOX_LAG, start_metrics_server
+from app.models.outbox import OutboxEvent
+from app.services.scheduler import SCHEDULER_ENABLED, FairScheduler, queue_for
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.1"))
+OUTBOX_STREAM_DELAY = float(os.getenv("OUTBOX_STREAM_DELAY", "120"))
+
+GEMINI_TASK = "app.services.gemini.process_gemini_message"
+# Headers the relay adds to Gemini tasks; a retry has to carry them along
+RELAYED_HEADERS = ("tier", "enqueued_at")
+
+
+def add_gemini_task(
+    session: AsyncSession, message_id: int, content: str, chatroom_id: int, user_id: int = None, tier: str = None,
+    delay: float = None,
+) -> OutboxEvent:
+    """Queue ``process_gemini_message`` with the caller's transaction (no commit here).
+
+    With ``delay`` (seconds) the relay leaves the event alone until then.
+    """
+    event = OutboxEvent(
+        task=GEMINI_TASK, args=[message_id, content, chatroom_id], user_id=user_id, tier=tier,
+        available_at=datetime.utcnow() + timedelta(seconds=delay) if delay else None,
+    )
+    session.add(event)
+    return event
+
+
+async def add_gemini_tasks(session: AsyncSession, tasks: List[tuple], user_id: int = None, tier: str = None):
+    """Queue one ``process_gemini_message`` per (message_id, content, chatroom_id), as one INSERT."""
+    await session.execute(insert(OutboxEvent), [
+        {"task": GEMINI_TASK, "args": list(task), "user_id": user_id, "tier": tier} for task in tasks
+    ])
+
+
+async def release_event(session_factory, event_id: int):
+    """Make a held-back event claimable now."""
+    async with session_factory() as session:
+        await session.execute(update(OutboxEvent).where(OutboxEvent.id == event_id).values(available_at=None))
+        await session.commit()
+
+
+async def discard_event(session: AsyncSession, event_id: int):
+    """Delete an event whose work was done without it, with the caller's transaction (no commit here)."""
+    await session.execute(delete(OutboxEvent).where(OutboxEvent.id == event_id))
+
+
+def publish_to_broker(events: List[OutboxEvent]):
+    # One connection for the whole batch. Nobody waits on these results, so skip
+    # subscribing to the result backend for each one.
+    with celery_app.producer_or_acquire() as producer:
+        for event in events:
+            options = {}
+            if event.task == GEMINI_TASK:
+                # Tier queue, plus what the worker needs to report queue wait per tier from commit time
+                enqueued_at = event.created_at.replace(tzinfo=timezone.utc).timestamp()
+                options = {
+                    "queue": queue_for(event.tier),
+                    "headers": {"tier": event.tier or "basic", "enqueued_at": enqueued_at},
+                }
+            celery_app.send_task(
+                event.task, args=event.args, task_id=f"outbox-{event.id}", producer=producer, ignore_result=True,
+                **options,
+            )
+
+
+async def publish_in_thread(events: List[OutboxEvent]):
+    await asyncio.to_thread(publish_to_broker, events)
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        session_factory=None,
+        publish: Callable[[List[OutboxEvent]], Awaitable[None]] = publish_in_thread,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        scheduler: FairScheduler = None,
+    ):
+        self.session_factory = session_factory
+        self.publish = publish
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.published = 0
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def relay_batch(self) -> int:
+        """Publish and delete one batch of pending events; returns how many."""
+        async with self.session_factory() as session:
+            if self.scheduler is None:
+                result = await session.execute(
+                    select(OutboxEvent)
+                    .where(OutboxEvent.claimable(datetime.utcnow()))
+                    .order_by(OutboxEvent.id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                )
+                events = result.scalars().all()
+            else:
+                ids = await self.scheduler.select(session, self.batch_size)
+                if not ids:
+                    return 0
+                result = await session.execute(
+                    select(OutboxEvent).where(OutboxEvent.id.in_(ids)).with_for_update(skip_locked=True)
+                )
+                # Publish in the scheduler's order; events another relay holds are skipped
+                position = {event_id: index for index, event_id in enumerate(ids)}
+                events = sorted(result.scalars().all(), key=lambda event: position[event.id])
+            if not events:
+                return 0
+            await self.publish(events)
+            await session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_([event.id for event in events])))
+            await session.commit()
+        now = datetime.utcnow()
+        for event in events:
+            OUTBOX_LAG.labels(event.task).observe(max(0.0, (now - event.created_at).total_seconds()))
+        self.published += len(events)
+        return len(events)
+
+    async def drain(self) -> int:
+        """Relay until the outbox is empty."""
+        total = 0
+        while True:
+            relayed = await self.relay_batch()
+            total += relayed
+            if relayed < self.batch_size:
+                return total
+
+    async def run(self):
+        engine = None
+        if self.session_factory is None:
+            from app.db.engine import create_engine
+            engine = create_engine()
+            self.session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        logger.info("Outbox relay started: batch_size=%d fair=%s", self.batch_size, self.scheduler is not None)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    relayed = await self.relay_batch()
+                except Exception:
+                    logger.exception("Outbox relay pass failed")
+                    relayed = 0
+                if relayed < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if engine is not None:
+                await engine.dispose()
+        logger.info("Outbox relay stopped after %d events", self.published)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish outbox events to the broker")
+    parser.add_argument("--batch-size", type=int, default=OUTBOX_BATCH_SIZE)
+    parser.add_argument("--poll-interval", type=float, default=OUTBOX_POLL_INTERVAL)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    start_metrics_server()
+
+    async def runner():
+        relay = OutboxRelay(
+            batch_size=args.batch_size,
+            poll_interval=args.poll_interval,
+            scheduler=FairScheduler() if SCHEDULER_ENABLED else None,
+        )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, relay.stop)
+        await relay.run()
+
+    asyncio.run(runner())
+
+
+if __name__ == "__main__":
+    main()
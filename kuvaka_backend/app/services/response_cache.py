@@ -0,0 +1,348 @@
+"""Cache of Gemini replies keyed on the normalized prompt.
+
+Greetings and FAQ-style prompts repeat across users, so a reply is stored
+under ``rcache:entry:{sha256(normalized prompt)}`` with a TTL and tracked in
+the ``rcache:index`` sorted set, scored by last access (``lru``) or hit count
+(``lfu``). Once the index holds more than ``RESPONSE_CACHE_MAX_ENTRIES`` the
+lowest-scored entries are evicted. A small in-process LRU sits in front of
+Redis (``RESPONSE_CACHE_LOCAL_SIZE``, 0 disables it).
+
+With ``RESPONSE_CACHE_SIMILARITY`` set to a cosine threshold (e.g. 0.92)
+and NumPy installed, a prompt without an exact entry is matched against the
+cached prompts embedded as hashed character n-gram vectors, so "how can I
+reset my password" can reuse the reply to "how do I reset my password". The index is rebuilt from
+``rcache:prompts`` every ``RESPONSE_CACHE_INDEX_REFRESH`` seconds.
+
+Only a prompt sent without earlier turns is shared this way. A reply that
+depends on a conversation is cached under ``cache_scope``: the chatroom and a
+hash of those turns go into the digest, so it is only reused by the same
+conversation, and it never enters the similarity index.
+
+Hit/miss counters, lookup time and Gemini call time are kept in the
+``rcache:stats`` hash so all workers report into one place.
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.instrumentation import CACHE_REQUESTS, REDIS_LATENCY, timed
+from app.core.redis import redis_client
+from app.models.chatroom import Chatroom
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:  # similarity mode needs numpy
+    np = None
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_POLICY = os.getenv("RESPONSE_CACHE_POLICY", "lru")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_MAX_PROMPT_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_PROMPT_CHARS", "500"))
+RESPONSE_CACHE_LOCAL_SIZE = int(os.getenv("RESPONSE_CACHE_LOCAL_SIZE", "1024"))
+RESPONSE_CACHE_LOCAL_TTL = float(os.getenv("RESPONSE_CACHE_LOCAL_TTL", "60"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+RESPONSE_CACHE_INDEX_REFRESH = float(os.getenv("RESPONSE_CACHE_INDEX_REFRESH", "30"))
+EMBEDDING_DIM = int(os.getenv("RESPONSE_CACHE_EMBEDDING_DIM", "512"))
+
+ENTRY_PREFIX = "rcache:entry:"
+INDEX_KEY = "rcache:index"
+PROMPTS_KEY = "rcache:prompts"
+STATS_KEY = "rcache:stats"
+
+# KEYS: entry, index, stats; ARGV: digest, policy, now, hit field
+GET_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HINCRBY', KEYS[3], 'misses', 1)
+    return false
+end
+if ARGV[2] == 'lfu' then
+    redis.call('ZINCRBY', KEYS[2], 1, ARGV[1])
+else
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+end
+redis.call('HINCRBY', KEYS[3], ARGV[4], 1)
+return value
+"""
+
+# KEYS: entry, index, prompts, stats
+# ARGV: digest, reply, normalized prompt, ttl, policy, now, max entries, entry prefix, '1' to index the prompt
+SET_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+if ARGV[5] == 'lfu' then
+    redis.call('ZADD', KEYS[2], 'NX', 1, ARGV[1])
+else
+    redis.call('ZADD', KEYS[2], ARGV[6], ARGV[1])
+end
+if ARGV[9] == '1' then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+end
+redis.call('HINCRBY', KEYS[4], 'stores', 1)
+local overflow = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[7])
+if overflow > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], overflow)
+    for i = 1, #evicted, 2 do
+        redis.call('DEL', ARGV[8] .. evicted[i])
+        redis.call('HDEL', KEYS[3], evicted[i])
+    end
+    redis.call('HINCRBY', KEYS[4], 'evictions', overflow)
+end
+return 1
+"""
+
+# Registered once; callers pass the client to run them on (the worker has its own)
+_get = redis_client.register_script(GET_SCRIPT)
+_set = redis_client.register_script(SET_SCRIPT)
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def prompt_digest(normalized: str, scope: Optional[str] = None) -> str:
+    if scope:
+        normalized = f"{scope}\n{normalized}"
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def cache_scope(chatroom_id: Optional[int], contents: Optional[List[dict]]) -> Optional[str]:
+    """Scope for a prompt sent with ``contents`` (context.build_context); None when it has no earlier turns."""
+    if not contents or len(contents) <= 1:
+        return None
+    history = hashlib.sha256(orjson.dumps(contents[:-1])).hexdigest()
+    return f"chatroom:{chatroom_id}:{history}"
+
+
+def embed(normalized: str, dim: int = None):
+    """L2-normalized hashed character-trigram vector (signed feature hashing)."""
+    dim = dim or EMBEDDING_DIM
+    padded = f" {normalized} "
+    vector = np.zeros(dim, dtype=np.float32)
+    for i in range(max(1, len(padded) - 2)):
+        h = zlib.crc32(padded[i:i + 3].encode())
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SimilarityIndex:
+    """Cosine index over cached prompts, rebuilt from Redis periodically."""
+
+    def __init__(self, dim: int = None):
+        self.dim = dim or EMBEDDING_DIM
+        self.digests = []
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.loaded_at = 0.0
+
+    def rebuild(self, prompts: dict):
+        self.digests = list(prompts)
+        if self.digests:
+            self.matrix = np.stack([embed(prompts[d], self.dim) for d in self.digests])
+        else:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.loaded_at = time.monotonic()
+
+    def add(self, digest: str, normalized: str):
+        self.digests.append(digest)
+        self.matrix = np.vstack([self.matrix, embed(normalized, self.dim)[None, :]])
+
+    def discard(self, digest: str):
+        if digest in self.digests:
+            i = self.digests.index(digest)
+            del self.digests[i]
+            self.matrix = np.delete(self.matrix, i, axis=0)
+
+    def nearest(self, normalized: str):
+        if not self.digests:
+            return None, 0.0
+        scores = self.matrix @ embed(normalized, self.dim)
+        best = int(np.argmax(scores))
+        return self.digests[best], float(scores[best])
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        local_size: int = None,
+        similarity: float = None,
+        policy: str = None,
+        ttl: int = None,
+        max_entries: int = None,
+    ):
+        self.local_size = RESPONSE_CACHE_LOCAL_SIZE if local_size is None else local_size
+        self.similarity = RESPONSE_CACHE_SIMILARITY if similarity is None else similarity
+        self.policy = policy or RESPONSE_CACHE_POLICY
+        self.ttl = ttl or RESPONSE_CACHE_TTL
+        self.max_entries = max_entries or RESPONSE_CACHE_MAX_ENTRIES
+        self._local = OrderedDict()
+        self.index = SimilarityIndex() if self.similarity > 0 and NUMPY_AVAILABLE else None
+        self.local_hits = 0
+        self._unreported_local_hits = 0
+
+    def _local_get(self, digest: str) -> Optional[str]:
+        item = self._local.get(digest)
+        if item is None:
+            return None
+        reply, expires_at = item
+        if expires_at < time.monotonic():
+            del self._local[digest]
+            return None
+        self._local.move_to_end(digest)
+        return reply
+
+    def _local_put(self, digest: str, reply: str):
+        if not self.local_size:
+            return
+        self._local[digest] = (reply, time.monotonic() + RESPONSE_CACHE_LOCAL_TTL)
+        self._local.move_to_end(digest)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    async def _redis_get(self, redis, digest: str, hit_field: str) -> Optional[str]:
+        return await _get(
+            keys=[ENTRY_PREFIX + digest, INDEX_KEY, STATS_KEY],
+            args=[digest, self.policy, time.time(), hit_field],
+            client=redis,
+        )
+
+    async def _refresh_index(self, redis):
+        if time.monotonic() - self.index.loaded_at < RESPONSE_CACHE_INDEX_REFRESH:
+            return
+        prompts = await redis.hgetall(PROMPTS_KEY)
+        self.index.rebuild({_text(k): _text(v) for k, v in prompts.items()})
+
+    async def lookup(self, redis, prompt: str, scope: Optional[str] = None) -> Optional[str]:
+        """Cached reply for ``prompt`` from the local tier, Redis, or the nearest similar prompt.
+
+        ``scope`` comes from ``cache_scope``; scoped prompts are matched exactly only.
+        """
+        if len(prompt) > RESPONSE_CACHE_MAX_PROMPT_CHARS:
+            return None
+        started = time.perf_counter()
+        normalized = normalize_prompt(prompt)
+        digest = prompt_digest(normalized, scope)
+        reply = self._local_get(digest)
+        if reply is not None:
+            # Reported to Redis with the next store so a local hit costs no round-trip
+            self.local_hits += 1
+            self._unreported_local_hits += 1
+            CACHE_REQUESTS.labels("gemini_response", "local_hit").inc()
+            return reply
+        try:
+            with timed(REDIS_LATENCY, "response_cache_get"):
+                reply = await self._redis_get(redis, digest, "hits")
+            if reply is None and scope is None and self.index is not None:
+                await self._refresh_index(redis)
+                match, score = self.index.nearest(normalized)
+                if match is not None and score >= self.similarity:
+                    reply = await self._redis_get(redis, match, "similar_hits")
+                    if reply is None:
+                        self.index.discard(match)
+            if reply is not None:
+                reply = _text(reply)
+                self._local_put(digest, reply)
+            await redis.hincrbyfloat(STATS_KEY, "lookup_seconds", time.perf_counter() - started)
+        except Exception:
+            logger.warning("Response cache lookup failed", exc_info=True)
+            CACHE_REQUESTS.labels("gemini_response", "error").inc()
+            return None
+        CACHE_REQUESTS.labels("gemini_response", "miss" if reply is None else "hit").inc()
+        return reply
+
+    async def store(
+        self, redis, prompt: str, reply: str, gemini_seconds: float = None, scope: Optional[str] = None
+    ):
+        """Cache ``reply``; ``gemini_seconds`` (the call it came from) feeds the latency-saved estimate."""
+        local_hits, self._unreported_local_hits = self._unreported_local_hits, 0
+        try:
+            pipe = redis.pipeline(transaction=False)
+            if local_hits:
+                pipe.hincrby(STATS_KEY, "local_hits", local_hits)
+            if gemini_seconds is not None:
+                pipe.hincrby(STATS_KEY, "gemini_calls", 1)
+                pipe.hincrbyfloat(STATS_KEY, "gemini_seconds", gemini_seconds)
+            await pipe.execute()
+        except Exception:
+            logger.warning("Could not record response cache stats", exc_info=True)
+        if len(prompt) > RESPONSE_CACHE_MAX_PROMPT_CHARS or not reply:
+            return
+        normalized = normalize_prompt(prompt)
+        if not normalized:
+            return
+        digest = prompt_digest(normalized, scope)
+        try:
+            await _set(
+                keys=[ENTRY_PREFIX + digest, INDEX_KEY, PROMPTS_KEY, STATS_KEY],
+                args=[
+                    digest, reply, normalized, self.ttl, self.policy, time.time(),
+                    self.max_entries, ENTRY_PREFIX, "0" if scope else "1",
+                ],
+                client=redis,
+            )
+        except Exception:
+            logger.warning("Response cache store failed", exc_info=True)
+            return
+        self._local_put(digest, reply)
+        if scope is None and self.index is not None and digest not in self.index.digests:
+            self.index.add(digest, normalized)
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def chatroom_opted_in(db: AsyncSession, chatroom_id: int) -> bool:
+    if not RESPONSE_CACHE_ENABLED:
+        return False
+    result = await db.execute(select(Chatroom.cache_responses).where(Chatroom.id == chatroom_id))
+    return result.scalar_one_or_none() is not False
+
+
+async def get_stats(redis) -> dict:
+    raw = {_text(k): float(v) for k, v in (await redis.hgetall(STATS_KEY)).items()}
+    hits = raw.get("hits", 0) + raw.get("similar_hits", 0) + raw.get("local_hits", 0)
+    # "misses" counts Redis misses, including ones later served by the similarity index
+    misses = max(raw.get("misses", 0) - raw.get("similar_hits", 0), 0)
+    lookups = hits + misses
+    gemini_calls = raw.get("gemini_calls", 0)
+    avg_gemini = raw.get("gemini_seconds", 0) / gemini_calls if gemini_calls else 0.0
+    avg_lookup = raw.get("lookup_seconds", 0) / lookups if lookups else 0.0
+    return {
+        "hits": int(raw.get("hits", 0)),
+        "similar_hits": int(raw.get("similar_hits", 0)),
+        "local_hits": int(raw.get("local_hits", 0)),
+        "misses": int(misses),
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "stores": int(raw.get("stores", 0)),
+        "evictions": int(raw.get("evictions", 0)),
+        "entries": await redis.zcard(INDEX_KEY),
+        "avg_lookup_ms": round(avg_lookup * 1000, 3),
+        "avg_gemini_ms": round(avg_gemini * 1000, 3),
+        "estimated_seconds_saved": round(hits * max(avg_gemini - avg_lookup, 0.0), 3),
+        "policy": RESPONSE_CACHE_POLICY,
+        "similarity_threshold": RESPONSE_CACHE_SIMILARITY if NUMPY_AVAILABLE else 0.0,
+    }
+
+
+response_cache = ResponseCache()
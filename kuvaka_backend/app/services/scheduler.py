@@ -0,0 +1,198 @@
+"""Fair scheduling of queued Gemini tasks, applied by the outbox relay.
+
+Tiers: each tier has its own broker queue (``GEMINI_TIER_QUEUES``), so a
+Basic backlog never sits in front of Pro work. Workers consuming several
+queues take from them in turn, and capacity can be reserved for a tier by
+running workers on its queue alone (``-Q gemini.pro``).
+
+Users: the backlog stays in the outbox, where it can still be reordered,
+instead of piling up in the broker. Before each pass the relay reads the
+depth of every tier queue and only tops it up to ``SCHEDULER_QUEUE_TARGET``
+waiting messages. The events that fill that room are picked by deficit
+round robin across the users of the tier. Each visit credits a user with
+``SCHEDULER_QUANTUM`` estimated tokens, which is spent on their oldest
+events. A user with thousands of queued messages thus gets the same share
+as a user with one, and that one message goes out within a round.
+"""
+import asyncio
+import os
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Hashable, List, Sequence, Tuple
+
+from kombu.exceptions import ChannelError
+from sqlalchemy import func, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.celery_app import GEMINI_TIER_QUEUES, celery_app
+from app.models.outbox import OutboxEvent
+from app.services.context import estimate_tokens
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_QUEUE_TARGET = int(os.getenv("SCHEDULER_QUEUE_TARGET", "100"))
+SCHEDULER_QUANTUM = int(os.getenv("SCHEDULER_QUANTUM", "500"))
+SCHEDULER_REPLY_TOKENS = int(os.getenv("SCHEDULER_REPLY_TOKENS", "250"))
+SCHEDULER_USER_WINDOW = int(os.getenv("SCHEDULER_USER_WINDOW", "20"))
+
+
+def queue_for(tier: str) -> str:
+    # Events from before tiers were recorded go with Basic
+    return GEMINI_TIER_QUEUES.get(tier) or GEMINI_TIER_QUEUES["basic"]
+
+
+def task_cost(args: Sequence) -> int:
+    """Estimated tokens a ``process_gemini_message`` call will handle: its prompt plus a typical reply."""
+    content = args[1] if len(args) > 1 else ""
+    return SCHEDULER_REPLY_TOKENS + estimate_tokens(content)
+
+
+def broker_depths(queues: Sequence[str]) -> Dict[str, int]:
+    """Messages waiting in each broker queue (0 for a queue the broker has not seen yet)."""
+    depths = {}
+    with celery_app.pool.acquire(block=True) as conn:
+        channel = conn.default_channel
+        for queue in queues:
+            try:
+                depths[queue] = channel.queue_declare(queue, passive=True).message_count
+            except ChannelError:
+                depths[queue] = 0
+    return depths
+
+
+async def broker_depths_in_thread(queues: Sequence[str]) -> Dict[str, int]:
+    return await asyncio.to_thread(broker_depths, queues)
+
+
+class DeficitRoundRobin:
+    """Deficit round robin (Shreedhar & Varghese) over per-user backlogs.
+
+    Deficits and the visiting order carry over between ``schedule`` calls, so
+    a user whose turn was cut short by ``limit`` resumes it on the next one.
+    """
+
+    def __init__(self, quantum: int = SCHEDULER_QUANTUM):
+        self.quantum = quantum
+        self.deficits: Dict[Hashable, int] = {}
+        self.order: deque = deque()
+        self._resume = None
+
+    def schedule(self, backlogs: Dict[Hashable, List[Tuple[Any, int]]], limit: int) -> list:
+        """Pick up to ``limit`` items from ``{user: [(item, cost), ...]}``, each list oldest first."""
+        known = set()
+        order = []
+        for user in self.order:
+            if user in backlogs:
+                known.add(user)
+                order.append(user)
+        order.extend(user for user in backlogs if user not in known)
+        self.order = deque(order)
+        self.deficits = {user: deficit for user, deficit in self.deficits.items() if user in backlogs}
+        if self._resume not in backlogs:
+            self._resume = None
+
+        chosen = []
+        heads = dict.fromkeys(backlogs, 0)
+        while self.order and len(chosen) < limit:
+            user = self.order[0]
+            items = backlogs[user]
+            deficit = self.deficits.get(user, 0)
+            if self._resume != user:
+                deficit += self.quantum
+            self._resume = None
+            head = heads[user]
+            while head < len(items) and items[head][1] <= deficit and len(chosen) < limit:
+                deficit -= items[head][1]
+                chosen.append(items[head][0])
+                head += 1
+            heads[user] = head
+            if head == len(items):
+                # Backlog emptied: the user leaves the round and its credit lapses
+                self.order.popleft()
+                self.deficits.pop(user, None)
+            elif items[head][1] <= deficit:
+                # Stopped by the limit with credit left: the turn continues next call
+                self.deficits[user] = deficit
+                self._resume = user
+            else:
+                self.deficits[user] = deficit
+                self.order.rotate(-1)
+        return chosen
+
+
+class FairScheduler:
+    """Chooses which outbox events the relay publishes, per tier and per user."""
+
+    def __init__(
+        self,
+        depths=broker_depths_in_thread,
+        queue_target: int = SCHEDULER_QUEUE_TARGET,
+        quantum: int = SCHEDULER_QUANTUM,
+        user_window: int = SCHEDULER_USER_WINDOW,
+    ):
+        self.depths = depths
+        self.queue_target = queue_target
+        self.user_window = user_window
+        # Dict order is publish priority when a batch cannot fill every queue
+        self.rounds = {tier: DeficitRoundRobin(quantum) for tier in GEMINI_TIER_QUEUES}
+
+    async def room(self) -> Dict[str, int]:
+        """How many more tasks each tier's queue takes before it reaches the target depth."""
+        depths = await self.depths([queue_for(tier) for tier in self.rounds])
+        return {tier: max(0, self.queue_target - depths.get(queue_for(tier), 0)) for tier in self.rounds}
+
+    def candidates(self, dialect: str, now: datetime):
+        """The oldest ``user_window`` claimable events of each user, so one backlog cannot hide the others."""
+        columns = (OutboxEvent.id, OutboxEvent.user_id, OutboxEvent.tier, OutboxEvent.args)
+        if dialect != "postgresql":
+            ranked = select(
+                *columns,
+                func.row_number().over(partition_by=OutboxEvent.user_id, order_by=OutboxEvent.id).label("rank"),
+            ).where(OutboxEvent.claimable(now)).subquery()
+            return [
+                select(ranked.c.id, ranked.c.user_id, ranked.c.tier, ranked.c.args)
+                .where(ranked.c.rank <= self.user_window)
+            ]
+        # A window over the whole outbox would read every queued row on every pass. Instead, walk the distinct
+        # users along ix_outbox_user_id_id (one index probe each) and read a few rows per user from there.
+        users = select(func.min(OutboxEvent.user_id).label("user_id")).cte("outbox_users", recursive=True)
+        users = users.union_all(
+            select(
+                select(func.min(OutboxEvent.user_id)).where(OutboxEvent.user_id > users.c.user_id).scalar_subquery()
+            ).where(users.c.user_id.is_not(None))
+        )
+        oldest = (
+            select(*columns)
+            .where(OutboxEvent.user_id == users.c.user_id, OutboxEvent.claimable(now))
+            .order_by(OutboxEvent.id)
+            .limit(self.user_window)
+            .lateral()
+        )
+        return [
+            select(*oldest.c).select_from(users).join(oldest, true()),
+            # Events from before user ids were recorded
+            select(*columns)
+            .where(OutboxEvent.user_id.is_(None), OutboxEvent.claimable(now))
+            .order_by(OutboxEvent.id)
+            .limit(self.user_window),
+        ]
+
+    async def select(self, session: AsyncSession, limit: int) -> List[int]:
+        """Ids of the outbox events to publish next, in publish order."""
+        room = await self.room()
+        if not any(room.values()):
+            return []
+        rows = []
+        for query in self.candidates(session.bind.dialect.name, datetime.utcnow()):
+            rows.extend((await session.execute(query)).all())
+        rows.sort(key=lambda row: row.id)
+        backlogs = {tier: {} for tier in self.rounds}
+        for row in rows:
+            tier = row.tier if row.tier in backlogs else "basic"
+            backlogs[tier].setdefault(row.user_id, []).append((row.id, task_cost(row.args)))
+        ids = []
+        for tier, round_robin in self.rounds.items():
+            take = min(room[tier], limit - len(ids))
+            if take > 0 and backlogs[tier]:
+                ids.extend(round_robin.schedule(backlogs[tier], take))
+        return ids
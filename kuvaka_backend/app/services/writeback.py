@@ -0,0 +1,266 @@
+"""Batched write-back of Gemini replies to ``messages``.
+
+Instead of one SELECT + UPDATE + COMMIT per reply, workers hand replies to a
+``WriteBackBuffer`` which flushes every ``WRITEBACK_BATCH_SIZE`` items or
+``WRITEBACK_FLUSH_MS`` milliseconds, whichever comes first, as one
+statement and one commit:
+
+* PostgreSQL: ``UPDATE messages SET gemini_response = v.gemini_response, ...
+  FROM (VALUES ...) AS v (id, gemini_response, status, error)
+  WHERE messages.id = v.id RETURNING ...``
+* other dialects: an executemany UPDATE followed by a SELECT of the batch
+
+``submit`` only returns once the reply is durable, so callers (and the late
+acking consumer) never acknowledge work that could still be lost. A failed
+flush is retried ``WRITEBACK_MAX_RETRIES`` times with exponential backoff;
+after that the batch is spilled to the ``writeback:spill`` Redis list and
+replayed by whichever worker next flushes successfully.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import orjson
+from sqlalchemy import Integer, String, Text, bindparam, column, update, values
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.notifications import publish_message_completed
+from app.models.message import Message, MessageStatus
+from app.services.context import record_turn
+
+logger = logging.getLogger(__name__)
+
+WRITEBACK_BATCH_SIZE = int(os.getenv("WRITEBACK_BATCH_SIZE", "100"))
+WRITEBACK_FLUSH_MS = float(os.getenv("WRITEBACK_FLUSH_MS", "50"))
+WRITEBACK_MAX_RETRIES = int(os.getenv("WRITEBACK_MAX_RETRIES", "3"))
+WRITEBACK_RETRY_BACKOFF = float(os.getenv("WRITEBACK_RETRY_BACKOFF", "0.1"))
+SPILL_CHECK_INTERVAL = 5.0
+
+SPILL_KEY = "writeback:spill"
+SPILL_LOCK_KEY = "writeback:spill:lock"
+
+messages = Message.__table__
+RETURNED_COLUMNS = (
+    messages.c.id,
+    messages.c.chatroom_id,
+    messages.c.user_id,
+    messages.c.content,
+    messages.c.gemini_response,
+    messages.c.status,
+    messages.c.error,
+    messages.c.created_at,
+)
+
+
+class WriteBackError(Exception):
+    """A reply could neither be written to the DB nor spilled to Redis."""
+
+
+def _status(error: Optional[str]) -> str:
+    return (MessageStatus.done if error is None else MessageStatus.error).value
+
+
+async def write_replies(session: AsyncSession, replies: Sequence[Tuple[int, Optional[str], Optional[str]]]) -> list:
+    """Record each (message_id, reply, error) and commit; returns the updated rows.
+
+    A reply marks the message ``done``; an error marks it ``error`` and leaves ``gemini_response`` empty.
+    Only ``pending`` messages are updated, so a duplicate task cannot overwrite the first result; the rows
+    it skipped are not returned.
+    """
+    # A retried task may submit the same message twice in one batch: last result wins
+    replies = list({message_id: (message_id, reply, error) for message_id, reply, error in replies}.values())
+    if session.bind.dialect.name == "postgresql":
+        batch = values(
+            column("id", Integer), column("gemini_response", Text),
+            column("status", String), column("error", Text), name="v",
+        ).data([(message_id, reply, _status(error), error) for message_id, reply, error in replies])
+        result = await session.execute(
+            update(messages)
+            .where(messages.c.id == batch.c.id, messages.c.status == MessageStatus.pending.value)
+            .values(gemini_response=batch.c.gemini_response, status=batch.c.status, error=batch.c.error)
+            .returning(*RETURNED_COLUMNS)
+        )
+        rows = result.all()
+    else:
+        result = await session.execute(
+            select(messages.c.id).where(
+                messages.c.id.in_([message_id for message_id, _, _ in replies]),
+                messages.c.status == MessageStatus.pending.value,
+            )
+        )
+        pending = set(result.scalars())
+        replies = [reply for reply in replies if reply[0] in pending]
+        if not replies:
+            await session.commit()
+            return []
+        await session.execute(
+            update(messages)
+            .where(messages.c.id == bindparam("b_id"), messages.c.status == MessageStatus.pending.value)
+            .values(gemini_response=bindparam("b_reply"), status=bindparam("b_status"), error=bindparam("b_error")),
+            [
+                {"b_id": message_id, "b_reply": reply, "b_status": _status(error), "b_error": error}
+                for message_id, reply, error in replies
+            ],
+        )
+        result = await session.execute(
+            select(*RETURNED_COLUMNS).where(messages.c.id.in_([message_id for message_id, _, _ in replies]))
+        )
+        rows = result.all()
+    await session.commit()
+    return rows
+
+
+class WriteBackBuffer:
+    def __init__(
+        self,
+        sessionmaker,
+        redis=None,
+        batch_size: int = None,
+        flush_ms: float = None,
+        max_retries: int = None,
+        retry_backoff: float = None,
+    ):
+        self.sessionmaker = sessionmaker
+        self.redis = redis
+        self.batch_size = batch_size or WRITEBACK_BATCH_SIZE
+        self.flush_ms = WRITEBACK_FLUSH_MS if flush_ms is None else flush_ms
+        self.max_retries = WRITEBACK_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_backoff = WRITEBACK_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self._pending = []  # (message_id, reply, error, future)
+        self._timer = None
+        self._flushes = set()
+        self._spill_checked_at = 0.0
+        self.flushed_batches = 0
+        self.flushed_rows = 0
+        self.retries = 0
+        self.spilled_rows = 0
+        self.replayed_rows = 0
+
+    async def submit(self, message_id: int, reply: Optional[str], error: Optional[str] = None):
+        """Queue a reply (or error); returns the updated message row once committed (None if missing or spilled)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message_id, reply, error, future))
+        if len(self._pending) >= self.batch_size or self.flush_ms <= 0:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_ms / 1000, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            task = asyncio.ensure_future(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[tuple]):
+        replies = [(message_id, reply, error) for message_id, reply, error, _ in batch]
+        rows = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.sessionmaker() as session:
+                    rows = await write_replies(session, replies)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception("Write-back of %d replies failed, spilling to Redis", len(batch))
+                    break
+                self.retries += 1
+                logger.warning("Write-back of %d replies failed, retrying", len(batch), exc_info=True)
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+        if rows is None:
+            error = await self._spill(replies)
+            for *_, future in batch:
+                if not future.done():
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(WriteBackError(str(error)))
+            return
+
+        self.flushed_batches += 1
+        self.flushed_rows += len(rows)
+        by_id = {row.id: row for row in rows}
+        for message_id, *_, future in batch:
+            if not future.done():
+                future.set_result(by_id.get(message_id))
+        await self._maybe_replay()
+
+    async def _spill(self, replies) -> Optional[Exception]:
+        if self.redis is None:
+            return WriteBackError("no Redis client to spill to")
+        try:
+            await self.redis.rpush(
+                SPILL_KEY,
+                *[
+                    orjson.dumps({"id": message_id, "gemini_response": reply, "error": error})
+                    for message_id, reply, error in replies
+                ],
+            )
+        except Exception as exc:
+            logger.exception("Could not spill %d replies to Redis", len(replies))
+            return exc
+        self.spilled_rows += len(replies)
+        return None
+
+    async def _maybe_replay(self):
+        # The DB is healthy again: write back anything a failed flush left in Redis
+        now = time.monotonic()
+        if self.redis is None or now - self._spill_checked_at < SPILL_CHECK_INTERVAL:
+            return
+        self._spill_checked_at = now
+        try:
+            await self.replay_spilled()
+        except Exception:
+            logger.exception("Replaying spilled write-backs failed")
+
+    async def replay_spilled(self) -> int:
+        if not await self.redis.set(SPILL_LOCK_KEY, "1", nx=True, ex=60):
+            return 0
+        replayed = 0
+        try:
+            while True:
+                # Read, write, then trim: a crash in between replays the batch again, which is idempotent
+                raw = await self.redis.lrange(SPILL_KEY, 0, self.batch_size - 1)
+                if not raw:
+                    break
+                items = [orjson.loads(item) for item in raw]
+                async with self.sessionmaker() as session:
+                    rows = await write_replies(
+                        session, [(item["id"], item["gemini_response"], item.get("error")) for item in items]
+                    )
+                await self.redis.ltrim(SPILL_KEY, len(raw), -1)
+                replayed += len(raw)
+                for row in rows:
+                    await record_turn(
+                        self.redis, row.chatroom_id, row.id, row.content, row.gemini_response, row.created_at
+                    )
+                    await publish_message_completed(row, self.redis)
+        finally:
+            await self.redis.delete(SPILL_LOCK_KEY)
+        self.replayed_rows += replayed
+        return replayed
+
+    async def close(self):
+        """Flush everything still buffered; used on worker shutdown."""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "flushed_batches": self.flushed_batches,
+            "flushed_rows": self.flushed_rows,
+            "retries": self.retries,
+            "spilled_rows": self.spilled_rows,
+            "replayed_rows": self.replayed_rows,
+        }
@@ -0,0 +1,105 @@
+"""Throughput of the asyncio gemini consumer vs one sequential prefork child.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_async_consumer --tasks 1000 --latency 0.2 --concurrency 200
+
+Uses kombu's in-memory transport so no broker is needed; the stub Gemini
+server adds ``--latency`` seconds to every call to model provider wait time.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_gemini import StubGeminiServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--sequential-tasks", type=int, default=20, help="sample size for the sequential baseline")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stub = StubGeminiServer(latency=args.latency).start()
+    os.environ["GEMINI_API_URL"] = stub.url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    # Every task sends the same prompt; measure the worker, not the response cache
+    os.environ.setdefault("RESPONSE_CACHE_ENABLED", "0")
+    # The stub never throttles, so start the AIMD limit at the consumer concurrency
+    os.environ.setdefault("GEMINI_AIMD_INITIAL", str(args.concurrency))
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from app.core.celery_app import celery_app
+    from app.core.worker_runtime import WorkerRuntime
+    from app.models.user import Base, User
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.services import gemini
+    from app.services.gemini_consumer import GeminiConsumer
+
+    celery_app.conf.broker_url = "memory://"
+    celery_app.conf.result_backend = "cache+memory://"
+
+    async def seed(count):
+        engine = create_async_engine(os.environ["DATABASE_URL"])
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            user = User(mobile_number=str(time.time_ns())[-12:])
+            session.add(user)
+            await session.flush()
+            room = Chatroom(user_id=user.id, name="bench")
+            session.add(room)
+            await session.flush()
+            messages = [Message(chatroom_id=room.id, user_id=user.id, content=f"m{i}") for i in range(count)]
+            session.add_all(messages)
+            await session.flush()
+            ids = [m.id for m in messages]
+            await session.commit()
+        await engine.dispose()
+        return ids
+
+    ids = asyncio.run(seed(args.tasks))
+
+    # Baseline: one prefork child runs task bodies back to back
+    runtime = WorkerRuntime()
+    started = time.perf_counter()
+    for message_id in ids[: args.sequential_tasks]:
+        runtime.run(gemini.handle_gemini_message(runtime, message_id, "hello"))
+    sequential_rate = args.sequential_tasks / (time.perf_counter() - started)
+    runtime.close()
+
+    for message_id in ids:
+        gemini.process_gemini_message.apply_async((message_id, "hello"), queue="gemini")
+
+    consumer = GeminiConsumer(concurrency=args.concurrency)
+
+    async def run_consumer():
+        async def stop_when_done():
+            while consumer.processed < len(ids):
+                await asyncio.sleep(0.01)
+            consumer.stop()
+
+        watcher = asyncio.create_task(stop_when_done())
+        await consumer.run()
+        await watcher
+
+    started = time.perf_counter()
+    asyncio.run(run_consumer())
+    consumer_rate = len(ids) / (time.perf_counter() - started)
+    stub.stop()
+
+    print(f"sequential prefork child   {sequential_rate:8.1f} tasks/s")
+    print(f"asyncio consumer (c={args.concurrency:<4}) {consumer_rate:8.1f} tasks/s")
+    print(f"speedup per process: {consumer_rate / sequential_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Cost of assembling Gemini context as chatroom history grows.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_context_builder --max-messages 100000
+
+Seeds one chatroom in steps up to ``--max-messages`` and times, per new
+turn, the naive approach (SELECT the whole history, then trim to the token
+budget) against ``context.build_context`` with a warm rolling window and
+with a cold window that has to be seeded from the DB. Uses DATABASE_URL
+(default: throwaway SQLite file) and REDIS_URL, or fakeredis with
+``--fakeredis``.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-messages", type=int, default=100_000)
+    parser.add_argument("--budget", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--fakeredis", action="store_true")
+    return parser.parse_args()
+
+
+async def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+async def run(args):
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.future import select
+    from app.models.user import Base, User
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.services import context
+
+    if args.fakeredis:
+        import fakeredis
+        redis = fakeredis.FakeAsyncRedis()
+    else:
+        from app.core.redis import create_redis_client
+        redis = create_redis_client()
+
+    engine = create_async_engine(os.environ["DATABASE_URL"])
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        user = User(mobile_number=str(time.time_ns())[-12:])
+        session.add(user)
+        await session.flush()
+        room = Chatroom(user_id=user.id, name="bench")
+        session.add(room)
+        await session.flush()
+        user_id, room_id = user.id, room.id
+        await session.commit()
+
+    start = datetime(2024, 1, 1)
+    seeded = 0
+    sizes = [size for size in (100, 1_000, 10_000, 100_000, 1_000_000) if size <= args.max_messages]
+    print(f"{'messages':>10} {'full history ms':>16} {'warm window ms':>15} {'cold window ms':>15} {'turns sent':>11}")
+    for size in sizes:
+        async with engine.begin() as conn:
+            rows = [
+                {
+                    "chatroom_id": room_id,
+                    "user_id": user_id,
+                    "content": f"question {i} " * 8,
+                    "gemini_response": f"answer {i} " * 24,
+                    "created_at": start + timedelta(seconds=i),
+                }
+                for i in range(seeded, size)
+            ]
+            for chunk in range(0, len(rows), 10_000):
+                await conn.execute(insert(Message), rows[chunk:chunk + 10_000])
+        seeded = size
+
+        async with AsyncSession(engine) as session:
+            async def full_history():
+                result = await session.execute(
+                    select(Message.id, Message.content, Message.gemini_response)
+                    .where(Message.chatroom_id == room_id)
+                    .order_by(Message.created_at, Message.id)
+                )
+                turns = [context.make_turn(*row) for row in result.all() if context.is_complete(row[2])]
+                session.expunge_all()
+                return context.build_contents(turns, "next question", args.budget)
+
+            async def warm_window():
+                return await context.build_context(redis, session, room_id, 0, "next question", args.budget)
+
+            async def cold_window():
+                await redis.delete(context.window_key(room_id))
+                return await context.build_context(redis, session, room_id, 0, "next question", args.budget)
+
+            full = await timed(full_history, max(1, args.repeat // 10))
+            cold = await timed(cold_window, args.repeat)
+            warm = await timed(warm_window, args.repeat)
+            assert await full_history() == await warm_window()
+            sent = (len(await warm_window()) - 1) // 2
+        print(f"{size:>10} {full:>16.2f} {warm:>15.2f} {cold:>15.2f} {sent:>11}")
+    await redis.delete(context.window_key(room_id))
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
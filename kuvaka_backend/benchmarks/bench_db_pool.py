@@ -0,0 +1,65 @@
+"""Checkout wait and throughput of the engine factory's pool under a burst.
+
+Usage (from kuvaka_backend/):
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_db_pool --burst 500 --sizes 5,10,20
+
+Fires ``--burst`` concurrent sessions, each running a short query while
+holding its connection for ``--hold-ms``, once per pool size, and prints the
+pool stats the ``/metrics/pool`` endpoint reports. Uses DATABASE_URL,
+defaulting to a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--burst", type=int, default=500)
+    parser.add_argument("--sizes", default="5,10,20")
+    parser.add_argument("--max-overflow", type=int, default=10)
+    parser.add_argument("--hold-ms", type=float, default=5)
+    parser.add_argument("--pool-timeout", type=float, default=30)
+    return parser.parse_args()
+
+
+async def run(args):
+    from sqlalchemy import exc, text
+    from app.db.engine import create_engine, pool_stats
+
+    print(f"{'pool_size':>9} {'seconds':>8} {'queries/s':>10} {'avg wait ms':>12} {'max wait ms':>12} {'timeouts':>9} {'peak overflow':>14}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        engine = create_engine(pool_size=size, max_overflow=args.max_overflow, pool_timeout=args.pool_timeout)
+        peak_overflow = 0
+
+        async def one():
+            nonlocal peak_overflow
+            try:
+                async with engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+                    peak_overflow = max(peak_overflow, pool_stats(engine).get("overflow", 0))
+                    await asyncio.sleep(args.hold_ms / 1000)
+            except exc.TimeoutError:
+                pass
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(args.burst)])
+        elapsed = time.perf_counter() - started
+        stats = pool_stats(engine)
+        print(
+            f"{size:>9} {elapsed:>8.2f} {args.burst / elapsed:>10.0f} {stats.get('avg_wait_ms', 0):>12.2f} "
+            f"{stats.get('max_wait_ms', 0):>12.2f} {stats.get('timeouts', 0):>9} {peak_overflow:>14}"
+        )
+        await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Delivered Gemini replies per second: plain calls vs ``GeminiDispatcher``.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_gemini_dispatch --calls 1000 --keys 4 --key-rate 50
+
+The stub answers 429 when an API key makes more than ``--key-rate`` requests
+in a second. ``--duplicate-fraction`` of the calls draw their prompt from a
+small set of hot prompts, the way a popular question arrives many times at
+once. Every call retries after a short jittered backoff until it gets a
+reply, standing in for task retries (breakers reset after 2 s rather than
+30 s, to keep the run short). Four setups are compared:
+
+* plain -- ``GeminiClient.call`` with one key (before the dispatcher)
+* single-flight -- the dispatcher with one key
+* key pool -- the dispatcher with ``--keys`` keys, no client-side quota
+* key pool + quota -- the same keys, each held to a ``--key-rate`` token bucket
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--keys", type=int, default=4)
+    parser.add_argument("--key-rate", type=int, default=50, help="stub quota, requests/s per key")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--duplicate-fraction", type=float, default=0.3)
+    parser.add_argument("--hot-prompts", type=int, default=20)
+    return parser.parse_args()
+
+
+async def run(args):
+    from benchmarks.stub_gemini import StubGeminiServer
+
+    stub = StubGeminiServer(latency=args.latency, key_rate=args.key_rate).start()
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+    os.environ["GEMINI_API_URL"] = stub.url
+    # Short breaker resets keep the single-key runs from idling for most of the benchmark
+    os.environ.setdefault("GEMINI_BREAKER_RESET", "2")
+    from app.core.worker_runtime import build_http_client
+    from app.services.gemini import build_payload, call_gemini_api
+    from app.services.gemini_client import GeminiClient, GeminiDispatcher, GeminiError, GeminiFatalError
+
+    rng = random.Random(7)
+    prompts = [
+        f"hot question {rng.randrange(args.hot_prompts)}" if rng.random() < args.duplicate_fraction else f"question {i}"
+        for i in range(args.calls)
+    ]
+    keys = [(f"bench-key-{i}", None) for i in range(args.keys)]
+    http = build_http_client(max_connections=args.concurrency)
+
+    async def drive(call):
+        slots = asyncio.Semaphore(args.concurrency)
+        retries = 0
+
+        async def one(prompt):
+            nonlocal retries
+            async with slots:
+                for attempt in range(100):
+                    try:
+                        return await call(prompt)
+                    except GeminiFatalError:
+                        raise
+                    except GeminiError as exc:
+                        retries += 1
+                        backoff = random.random() * min(2, 0.05 * 2 ** attempt)
+                        await asyncio.sleep(max(getattr(exc, "retry_after", None) or 0, backoff))
+
+        requests_before = stub.requests
+        throttled_before = stub.throttled
+        started = time.perf_counter()
+        await asyncio.gather(*[one(prompt) for prompt in prompts])
+        elapsed = time.perf_counter() - started
+        return args.calls / elapsed, stub.requests - requests_before, stub.throttled - throttled_before, retries
+
+    def plain():
+        client = GeminiClient()
+        return lambda prompt: client.call(lambda: call_gemini_api(prompt, keys[0][0], http))
+
+    def dispatched(key_pool, rpm=0):
+        dispatcher = GeminiDispatcher(
+            GeminiClient(), keys=key_pool, rpm=rpm, burst=max(1, args.key_rate // 5), max_wait=1.0
+        )
+        return lambda prompt: dispatcher.dispatch(
+            build_payload(prompt), lambda slot: call_gemini_api(prompt, slot.api_key, http)
+        )
+
+    setups = [
+        ("plain", plain()),
+        ("single-flight", dispatched(keys[:1])),
+        ("key pool", dispatched(keys)),
+        ("key pool + quota", dispatched(keys, rpm=args.key_rate * 60)),
+    ]
+    print(
+        f"{args.calls} calls, {args.duplicate_fraction:.0%} from {args.hot_prompts} hot prompts, "
+        f"{args.keys} keys at {args.key_rate} req/s each, {args.latency * 1000:.0f} ms latency"
+    )
+    print(f"{'setup':<18} {'replies/s':>10} {'upstream':>9} {'429s':>6} {'retries':>8}")
+    for label, call in setups:
+        rate, upstream, throttled, retries = await drive(call)
+        print(f"{label:<18} {rate:>10.1f} {upstream:>9} {throttled:>6} {retries:>8}")
+        await asyncio.sleep(1.1)  # let the stub's per-second key windows reset
+    await http.aclose()
+    stub.stop()
+
+
+def main():
+    args = parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Gemini client behaviour against a fault-injecting stub.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_gemini_resilience --calls 2000 --capacity 20
+
+Two scenarios, each run with and without ``GeminiClient``:
+
+* overload -- the stub answers 429 above ``--capacity`` concurrent requests.
+  Callers retry with a short backoff; the AIMD limiter should converge near
+  the capacity and waste far fewer requests on 429s.
+* outage -- the stub fails everything for ``--outage`` seconds. The circuit
+  breaker should stop hammering it after a handful of failures.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--capacity", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--outage", type=float, default=2.0)
+    return parser.parse_args()
+
+
+async def run(args):
+    from benchmarks.stub_gemini import StubGeminiServer
+
+    stub = StubGeminiServer(latency=args.latency, capacity=args.capacity).start()
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+    os.environ["GEMINI_API_URL"] = stub.url
+    from app.core.worker_runtime import build_http_client
+    from app.services.gemini import call_gemini_api
+    from app.services.gemini_client import AIMDLimiter, CircuitBreaker, GeminiClient, GeminiError, classify
+
+    http = build_http_client(max_connections=args.concurrency)
+
+    async def request():
+        return await call_gemini_api("hello", "key", http)
+
+    async def unguarded():
+        try:
+            return await request()
+        except Exception as exc:
+            raise classify(exc)
+
+    async def workload(call, calls):
+        slots = asyncio.Semaphore(args.concurrency)
+        failed = 0
+
+        async def one():
+            nonlocal failed
+            async with slots:
+                for attempt in range(20):
+                    try:
+                        return await call()
+                    except GeminiError:
+                        await asyncio.sleep(min(0.01 * 2 ** attempt, 0.5))
+                failed += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(calls)])
+        return time.perf_counter() - started, failed
+
+    print("overload: stub capacity", args.capacity, "concurrent requests")
+    print(f"{'mode':<14} {'seconds':>8} {'replies/s':>10} {'stub requests':>14} {'429s':>7} {'peak':>5} {'limit':>6}")
+    for label in ("unguarded", "aimd"):
+        client = GeminiClient(breaker=CircuitBreaker(failure_threshold=10 ** 9), limiter=AIMDLimiter(initial=10))
+        call = unguarded if label == "unguarded" else (lambda: client.call(request))
+        stub.requests = stub.throttled = stub.peak_active = 0
+        elapsed, failed = await workload(call, args.calls)
+        limit = f"{client.limiter.limit:.1f}" if label == "aimd" else "-"
+        print(
+            f"{label:<14} {elapsed:>8.2f} {(args.calls - failed) / elapsed:>10.0f} "
+            f"{stub.requests:>14} {stub.throttled:>7} {stub.peak_active:>5} {limit:>6}"
+        )
+
+    print(f"\noutage: every request fails for {args.outage}s")
+    print(f"{'mode':<14} {'stub requests during outage':>28} {'breaker rejections':>19}")
+    stub.capacity = None
+    for label in ("unguarded", "breaker"):
+        client = GeminiClient(breaker=CircuitBreaker(failure_threshold=5, reset_timeout=0.5))
+        call = unguarded if label == "unguarded" else (lambda: client.call(request))
+        stub.outage = True
+        stub.requests = 0
+        deadline = time.perf_counter() + args.outage
+
+        async def hammer():
+            while time.perf_counter() < deadline:
+                try:
+                    await call()
+                except GeminiError:
+                    await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[hammer() for _ in range(20)])
+        stub.outage = False
+        rejected = client.breaker.rejected if label == "breaker" else "-"
+        print(f"{label:<14} {stub.requests:>28} {rejected:>19}")
+
+    await http.aclose()
+    stub.stop()
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Per-request cost of the Prometheus instrumentation, enabled vs METRICS_ENABLED=0.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_instrumentation --requests 20000
+
+Drives a minimal FastAPI app (one router, one path parameter) in-process
+through ``MetricsMiddleware`` and a ``timed`` block per request. Each mode
+runs in its own interpreter because the switch is read at import time.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+async def measure(requests: int) -> float:
+    from fastapi import APIRouter, FastAPI
+    from app.core.instrumentation import METRICS_ENABLED, REDIS_LATENCY, MetricsMiddleware, timed
+
+    router = APIRouter()
+
+    @router.get("/chatroom/{id}")
+    async def chatroom(id: int):
+        with timed(REDIS_LATENCY, "bench"):
+            pass
+        return {"id": id}
+
+    app = FastAPI()
+    app.include_router(router)
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    def scope(i):
+        path = f"/chatroom/{i}"
+        return {
+            "type": "http", "http_version": "1.1", "method": "GET", "path": path, "raw_path": path.encode(),
+            "root_path": "", "scheme": "http", "query_string": b"", "headers": [], "client": ("bench", 1),
+            "server": ("bench", 80),
+        }
+
+    for i in range(200):
+        await app(scope(i), receive, send)
+    started = time.perf_counter()
+    for i in range(requests):
+        await app(scope(i), receive, send)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        print(f"{asyncio.run(measure(args.requests)):.2f}")
+        return
+    results = {}
+    for label, enabled in (("disabled", "0"), ("enabled", "1")):
+        env = {**os.environ, "METRICS_ENABLED": enabled}
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_instrumentation", "--child", "--requests", str(args.requests)],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        results[label] = float(out.stdout.strip().splitlines()[-1])
+    print(f"{'mode':<10} {'us/request':>11}")
+    for label, micros in results.items():
+        print(f"{label:<10} {micros:>11.2f}")
+    print(f"overhead: {results['enabled'] - results['disabled']:.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""POST /chatroom/{id}/messages:batch vs N sequential POST /chatroom/{id}/message.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_message_batch --messages 100 --rounds 10
+
+Drives ``app.main.app`` in-process over ASGI with an in-process fakeredis.
+The database is DATABASE_URL, defaulting to a throwaway SQLite file. The
+quota limit is raised so every send is accepted and the quota check still
+runs. The report gives wall time and SQL statements for sending
+``--messages`` messages each way.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=10)
+    return parser.parse_args()
+
+
+async def run(args):
+    import httpx
+    from sqlalchemy import event
+    from app.db.session import engine
+    from app.main import app
+    from app.models.user import Base
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    statements = [0]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_statement(*_):
+        statements[0] += 1
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        mobile = str(time.time_ns())[-10:]
+        await client.post("/auth/signup", json={"mobile_number": mobile, "password": "bench-password"})
+        otp = (await client.post("/auth/send-otp", json={"mobile_number": mobile})).json()["otp"]
+        token = (await client.post("/auth/verify-otp", json={"mobile_number": mobile, "otp": otp})).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        room = (await client.post("/chatroom", json={"name": "bench"}, headers=headers)).json()["id"]
+
+        async def sequential():
+            for i in range(args.messages):
+                response = await client.post(f"/chatroom/{room}/message", json={"content": f"m{i}"}, headers=headers)
+                response.raise_for_status()
+
+        async def batch():
+            response = await client.post(
+                f"/chatroom/{room}/messages:batch",
+                json={"messages": [{"content": f"m{i}"} for i in range(args.messages)]},
+                headers=headers,
+            )
+            response.raise_for_status()
+
+        print(f"{args.messages} messages, median of {args.rounds} rounds")
+        print(f"{'mode':<12} {'ms':>9} {'ms/message':>11} {'sql':>6}")
+        results = {}
+        for label, send in (("sequential", sequential), ("batch", batch)):
+            await send()
+            samples = []
+            for _ in range(args.rounds):
+                statements[0] = 0
+                started = time.perf_counter()
+                await send()
+                samples.append((time.perf_counter() - started) * 1000)
+            results[label] = statistics.median(samples)
+            print(f"{label:<12} {results[label]:>9.2f} {results[label] / args.messages:>11.3f} {statements[0]:>6}")
+        print(f"speedup: {results['sequential'] / results['batch']:.1f}x")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    os.environ["QUOTA_DAILY_LIMIT_BASIC"] = str(10 ** 9)
+    os.environ["MESSAGE_BATCH_MAX_SIZE"] = str(max(args.messages, 100))
+    os.environ["RATE_LIMIT_ENABLED"] = "0"
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    import fakeredis
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Latency of GET /chatroom/{id}/messages as chatroom history grows.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_message_pagination --max-messages 100000
+
+Seeds one chatroom in steps up to ``--max-messages`` and times the old
+full-history load against keyset pages (newest page and a page deep in
+history). Uses DATABASE_URL, defaulting to a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-messages", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser.parse_args()
+
+
+async def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+async def run(args):
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.future import select
+    from app.models.user import Base, User
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.api.v1.chatroom import fetch_message_page
+    from app.core.pagination import encode_cursor
+
+    engine = create_async_engine(os.environ["DATABASE_URL"])
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        user = User(mobile_number=str(time.time_ns())[-12:])
+        session.add(user)
+        await session.flush()
+        room = Chatroom(user_id=user.id, name="bench")
+        session.add(room)
+        await session.flush()
+        user_id, room_id = user.id, room.id
+        await session.commit()
+
+    start = datetime(2024, 1, 1)
+    seeded = 0
+    sizes = [size for size in (1_000, 10_000, 100_000, 1_000_000) if size <= args.max_messages]
+    print(f"{'messages':>10} {'full load ms':>14} {'newest page ms':>16} {'deep page ms':>14}")
+    for size in sizes:
+        async with engine.begin() as conn:
+            rows = [
+                {
+                    "chatroom_id": room_id,
+                    "user_id": user_id,
+                    "content": f"message {i}",
+                    "gemini_response": f"reply {i}",
+                    "created_at": start + timedelta(seconds=i),
+                }
+                for i in range(seeded, size)
+            ]
+            for chunk in range(0, len(rows), 10_000):
+                await conn.execute(insert(Message), rows[chunk:chunk + 10_000])
+        seeded = size
+        deep_cursor = encode_cursor(start + timedelta(seconds=size // 2), size // 2)
+
+        async with AsyncSession(engine) as session:
+            async def full_load():
+                result = await session.execute(select(Message).where(Message.chatroom_id == room_id))
+                result.scalars().all()
+                session.expunge_all()
+
+            async def newest_page():
+                await fetch_message_page(session, room_id, args.limit)
+                session.expunge_all()
+
+            async def deep_page():
+                await fetch_message_page(session, room_id, args.limit, before=deep_cursor)
+                session.expunge_all()
+
+            full = await timed(full_load, max(1, args.repeat // 10))
+            newest = await timed(newest_page, args.repeat)
+            deep = await timed(deep_page, args.repeat)
+        print(f"{size:>10} {full:>14.2f} {newest:>16.2f} {deep:>14.2f}")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
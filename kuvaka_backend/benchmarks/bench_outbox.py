@@ -0,0 +1,117 @@
+"""Send-path cost with the transactional outbox, and relay drain throughput.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_outbox --messages 2000 --broker-latency-ms 2
+    python -m benchmarks.bench_outbox --broker redis://localhost:6379/0
+
+The send path is measured in two ways:
+
+* direct -- the message is committed, then ``process_gemini_message.delay``
+  is called (the behaviour before the outbox)
+* outbox -- the message and its ``OutboxEvent`` are committed together
+
+Next, ``OutboxRelay`` drains the same number of events at several batch
+sizes and publishes them to ``--broker``. The default is the in-memory
+kombu transport. ``--broker-latency-ms`` adds a sleep to every publish to
+stand in for a broker round trip. The database is DATABASE_URL, defaulting
+to a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="1,50,500")
+    parser.add_argument("--broker", default="memory://")
+    parser.add_argument("--broker-latency-ms", type=float, default=1.0)
+    return parser.parse_args()
+
+
+async def run(args):
+    from kombu.messaging import Producer
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from sqlalchemy.orm import sessionmaker
+    from app.core.celery_app import celery_app
+    from app.db.engine import create_engine
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.models.outbox import OutboxEvent
+    from app.models.user import Base, User
+    from app.services import outbox
+    from app.services.gemini import process_gemini_message
+
+    celery_app.conf.broker_url = args.broker
+    if args.broker == "memory://":
+        celery_app.conf.result_backend = "cache+memory://"
+    publish = Producer.publish
+
+    def slow_publish(self, *a, **kw):
+        time.sleep(args.broker_latency_ms / 1000)
+        return publish(self, *a, **kw)
+
+    Producer.publish = slow_publish
+
+    engine = create_engine(os.environ["DATABASE_URL"])
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with factory() as session:
+        user = User(mobile_number=str(time.time_ns())[-12:])
+        session.add(user)
+        await session.flush()
+        room = Chatroom(user_id=user.id, name="bench")
+        session.add(room)
+        await session.commit()
+        user_id, room_id = user.id, room.id
+
+    async def send(use_outbox):
+        async with factory() as session:
+            message = Message(chatroom_id=room_id, user_id=user_id, content="hello")
+            session.add(message)
+            if use_outbox:
+                await session.flush()
+                outbox.add_gemini_task(session, message.id, "hello", room_id)
+            await session.commit()
+            if not use_outbox:
+                process_gemini_message.delay(message.id, "hello", room_id)
+
+    print(f"send path, {args.messages} messages, broker latency {args.broker_latency_ms} ms")
+    print(f"{'mode':<8} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, use_outbox in (("direct", False), ("outbox", True)):
+        samples = []
+        for _ in range(args.messages):
+            started = time.perf_counter()
+            await send(use_outbox)
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        print(f"{label:<8} {statistics.median(samples):>8.3f} {samples[int(len(samples) * 0.99)]:>8.3f}")
+
+    print(f"\nrelay drain of {args.messages} events")
+    print(f"{'batch':>6} {'events/s':>10}")
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        async with engine.begin() as conn:
+            await conn.execute(insert(OutboxEvent), [
+                {"task": outbox.GEMINI_TASK, "args": [i, "hello", room_id]} for i in range(args.messages)
+            ])
+        relay = outbox.OutboxRelay(factory, batch_size=batch_size)
+        started = time.perf_counter()
+        drained = await relay.drain()
+        print(f"{batch_size:>6} {drained / (time.perf_counter() - started):>10.0f}")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Hot-path query latency before and after partitioning and archiving ``messages``.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_partitioning --messages 300000 --months 24 --hot-months 3
+    DATABASE_URL=postgresql+asyncpg://localhost/bench python -m benchmarks.bench_partitioning
+
+Seeds ``--messages`` messages spread evenly over the last ``--months``
+months. The queries on the hot paths are then timed:
+
+* quota -- ``quota.count_messages_today``, the quota seed on a Redis miss
+* history -- the newest page of a chatroom, and the page before it
+* cleanup -- the unfinished messages of a user, as ``DELETE /messages/cleanup`` selects them
+* chatroom list -- ``chatroom_cache.load_from_db``, the list rebuild on a cache miss
+
+On PostgreSQL the empty table is converted before seeding, so every seeded
+month lands in its own partition, as in a deployment converted a while ago.
+The table is then maintained as ``python -m app.db.partitions maintain``
+would: every month before the last ``--hot-months`` is archived, and the
+same queries are timed again. A history page served from the archive is timed
+last, once with a cold file cache and once warm. DATABASE_URL defaults to a
+throwaway SQLite file, where only archival applies.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=300_000)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--hot-months", type=int, default=3)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms-per-user", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=200)
+    return parser.parse_args()
+
+
+async def run(args):
+    from sqlalchemy import func, insert
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from sqlalchemy.future import select
+    from app.api.v1.chatroom import fetch_message_page
+    from app.api.v1.messages_cleanup import not_done
+    from app.core import chatroom_cache, quota
+    from app.core.pagination import encode_cursor
+    from app.db import partitions
+    from app.db.session import engine
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.models.user import Base, User
+    from app.services import archive
+
+    rng = random.Random(7)
+    now = datetime.utcnow()
+    start = partitions.add_months(partitions.month_start(now), 1 - args.months)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    if engine.dialect.name == "postgresql":
+        # An empty legacy partition, then one partition per seeded month
+        await partitions.convert(engine, now=partitions.add_months(start, -1))
+        async with engine.begin() as conn:
+            await partitions.create_partitions(conn, args.months, now=start)
+    span = (now - start).total_seconds()
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        users = [User(mobile_number=f"9{i:09d}") for i in range(args.users)]
+        session.add_all(users)
+        await session.flush()
+        rooms = [Chatroom(user_id=user.id, name="bench") for user in users for _ in range(args.rooms_per_user)]
+        session.add_all(rooms)
+        await session.commit()
+        rooms = [(room.id, room.user_id) for room in rooms]
+    seeded = time.perf_counter()
+    chunk = 10_000
+    for offset in range(0, args.messages, chunk):
+        rows = []
+        for i in range(offset, min(offset + chunk, args.messages)):
+            room_id, user_id = rng.choice(rooms)
+            status = "done" if rng.random() < 0.97 else rng.choice(("pending", "error"))
+            rows.append({
+                "chatroom_id": room_id, "user_id": user_id, "content": f"question {i} " * 4,
+                "gemini_response": f"answer {i} " * 20 if status == "done" else None, "status": status,
+                "created_at": start + timedelta(seconds=span * i / args.messages),
+            })
+        async with engine.begin() as conn:
+            await conn.execute(insert(Message), rows)
+    print(
+        f"{args.messages} messages over {args.months} months ({engine.dialect.name}), "
+        f"seeded in {time.perf_counter() - seeded:.1f}s"
+    )
+
+    async def timed(query):
+        samples = []
+        for _ in range(args.repeat):
+            room_id, user_id = rng.choice(rooms)
+            async with AsyncSession(engine) as session:
+                started = time.perf_counter()
+                await query(session, room_id, user_id)
+                samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+    async def history_second_page(session, room_id, user_id):
+        _, cursor = await fetch_message_page(session, room_id, 50)
+        if cursor:
+            await fetch_message_page(session, room_id, 50, before=cursor)
+
+    async def cleanup_scan(session, room_id, user_id):
+        await session.execute(select(Message.id).where(Message.user_id == user_id, not_done))
+
+    queries = {
+        "quota": lambda session, room_id, user_id: quota.count_messages_today(session, user_id),
+        "history": lambda session, room_id, user_id: fetch_message_page(session, room_id, 50),
+        "history page 2": history_second_page,
+        "cleanup": cleanup_scan,
+        "chatroom list": lambda session, room_id, user_id: chatroom_cache.load_from_db(session, user_id),
+    }
+    before = {name: await timed(query) for name, query in queries.items()}
+
+    maintained = time.perf_counter()
+    archived = await partitions.archive_old(engine, args.hot_months)
+    async with engine.connect() as conn:
+        remaining = (await conn.execute(select(func.count()).select_from(Message))).scalar()
+    archive_bytes = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(archive.MESSAGE_ARCHIVE_DIR) for name in names
+    )
+    print(
+        f"maintenance: {archived} archived ({archive_bytes / 2 ** 20:.1f} MiB gzip), {remaining} left, "
+        f"{time.perf_counter() - maintained:.1f}s"
+    )
+    after = {name: await timed(query) for name, query in queries.items()}
+
+    print(f"\n{'query':<16} {'p50 before':>11} {'p50 after':>10} {'p99 before':>11} {'p99 after':>10}")
+    for name in queries:
+        print(f"{name:<16} {before[name][0]:>11.2f} {after[name][0]:>10.2f} {before[name][1]:>11.2f} {after[name][1]:>10.2f}")
+
+    # One page of history older than anything still live
+    room_id, _ = rooms[0]
+    cursor = encode_cursor(partitions.add_months(partitions.month_start(now), -args.hot_months), 0)
+    async with AsyncSession(engine) as session:
+        archived_until = (await session.get(Chatroom, room_id)).archived_until
+        for label in ("cold", "warm"):
+            if label == "cold":
+                archive._files.clear()
+            started = time.perf_counter()
+            page, _ = await fetch_message_page(session, room_id, 50, before=cursor, archived_until=archived_until)
+            print(f"archived page ({label}): {(time.perf_counter() - started) * 1000:.2f} ms, {len(page)} messages")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{workdir}/bench.db")
+    os.environ.setdefault("MESSAGE_ARCHIVE_DIR", os.path.join(workdir, "archive"))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
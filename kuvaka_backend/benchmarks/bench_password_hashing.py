@@ -0,0 +1,96 @@
+"""p99 latency of an unrelated endpoint while a signup storm is hashing passwords.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_password_hashing --signups 40
+
+Drives a small ASGI app in-process: ``/hash`` hashes a password the way
+``signup`` does (inline bcrypt vs the PasswordHasher pool) while ``/ping``
+is probed every few milliseconds until the storm is over. Inline hashing
+blocks the loop, so ping latency tracks bcrypt time; with the pool it stays
+near zero.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--signups", type=int, default=40)
+    parser.add_argument("--probe-interval", type=float, default=0.005)
+    parser.add_argument("--mode", default="thread", choices=["thread", "process"])
+    return parser.parse_args()
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+async def storm(app, signups, interval):
+    import httpx
+
+    latencies = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        stop = asyncio.Event()
+
+        async def probe():
+            while not stop.is_set():
+                # Measure from when the probe was due, so loop stalls are counted
+                due = time.perf_counter() + interval
+                await asyncio.sleep(interval)
+                await client.get("/ping")
+                latencies.append((time.perf_counter() - due) * 1000)
+
+        prober = asyncio.ensure_future(probe())
+        await asyncio.sleep(interval * 4)
+        started = time.perf_counter()
+        await asyncio.gather(*[client.post("/hash") for _ in range(signups)])
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await prober
+    return latencies, elapsed
+
+
+async def run(args):
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+    from fastapi import FastAPI
+    from app.core import security
+    from app.core.password_hasher import PasswordHasher
+
+    hasher = PasswordHasher(mode=args.mode, max_pending=args.signups)
+
+    def build(inline: bool):
+        app = FastAPI()
+
+        @app.get("/ping")
+        async def ping():
+            return {"ok": True}
+
+        @app.post("/hash")
+        async def hash_password():
+            if inline:
+                return {"hash": security.get_password_hash("correct horse battery staple")}
+            return {"hash": await hasher.hash("correct horse battery staple")}
+
+        return app
+
+    print(f"{'mode':<22} {'ping p50 ms':>12} {'ping p99 ms':>12} {'storm s':>9}")
+    for label, inline in (("inline bcrypt", True), (f"{args.mode} pool", False)):
+        latencies, elapsed = await storm(build(inline), args.signups, args.probe_interval)
+        print(
+            f"{label:<22} {statistics.median(latencies):>12.2f} "
+            f"{percentile(latencies, 99):>12.2f} {elapsed:>9.2f}"
+        )
+    print(hasher.stats())
+    hasher.shutdown()
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Per-request overhead of the rate limiter.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_rate_limit --iterations 20000
+
+Times a bare ASGI app with and without RateLimitMiddleware, for the
+in-process limiter and for the Redis Lua path (REDIS_URL, or fakeredis when
+``--fakeredis`` is given and installed).
+
+Then one Basic user sends ``--batch-size`` message batches through ``RULES``
+until a batch is rejected, then one single message. Batches draw on the
+same bucket as single sends, one token per message. A batch larger than the
+bucket is admitted once, from a full bucket, and leaves it in debt.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--fakeredis", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=5)
+    return parser.parse_args()
+
+
+async def noop_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def drive(app, iterations, path):
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [], "client": ("127.0.0.1", 1)}
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for i in range(iterations):
+        # Spread keys so every call is allowed and does the full bucket update
+        scope["client"] = (f"10.0.{i % 250}.{i % 200}", 1)
+        await app(scope, receive, send)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def drain_with_batches(limiter, batch_size):
+    from app.core.rate_limit import RULES, RateLimitMiddleware
+    from app.core.security import create_access_token
+
+    statuses = []
+
+    async def app(scope, receive, send):
+        # Like FastAPI, read the body the middleware already consumed
+        assert len((await receive())["body"]) > 0
+        await noop_app(scope, receive, send)
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    token = create_access_token({"sub": "424242", "is_pro": False})
+    body = ('{"messages": [%s]}' % ", ".join(['{"content": "hi"}'] * batch_size)).encode()
+    middleware = RateLimitMiddleware(app, RULES, limiter)
+
+    async def post(path, payload):
+        chunks = [{"type": "http.request", "body": payload, "more_body": False}]
+
+        async def receive():
+            return chunks.pop(0) if chunks else {"type": "http.disconnect"}
+
+        scope = {
+            "type": "http", "method": "POST", "path": path, "client": ("127.0.0.1", 1),
+            "headers": [(b"authorization", f"Bearer {token}".encode())],
+        }
+        await middleware(scope, receive, send)
+        return statuses[-1]
+
+    batches = 0
+    while await post("/chatroom/1/messages:batch", body) == 200:
+        batches += 1
+    single = await post("/chatroom/1/message", b'{"content": "hi"}')
+    return batches, single
+
+
+async def run(args):
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+    from app.core.rate_limit import RULES, RateLimiter, RateLimitMiddleware, Rule, TokenBucket, SlidingWindow
+
+    client = None
+    if args.fakeredis:
+        import fakeredis
+        client = fakeredis.FakeAsyncRedis()
+    rules = [
+        Rule("bucket", "POST", r"^/bucket$", {"anonymous": TokenBucket(capacity=1000, refill_per_second=1000)}),
+        Rule("window", "POST", r"^/window$", {"anonymous": SlidingWindow(limit=1000, window_seconds=1)}),
+    ] + RULES
+
+    baseline = await drive(noop_app, args.iterations, "/bucket")
+    print(f"{'no middleware':<34} {baseline:8.2f} us/request")
+
+    redis_limiter = RateLimiter(client)
+    local_limiter = RateLimiter(client)
+    local_limiter._redis_down_until = float("inf")  # force the in-process path
+    for label, limiter in (("redis lua", redis_limiter), ("in-process", local_limiter)):
+        app = RateLimitMiddleware(noop_app, rules, limiter)
+        for path in ("/bucket", "/window"):
+            cost = await drive(app, args.iterations, path)
+            print(f"{label + ' ' + path:<34} {cost:8.2f} us/request (+{cost - baseline:.2f})")
+        unmatched = await drive(app, args.iterations, "/user/me")
+        print(f"{label + ' unmatched route':<34} {unmatched:8.2f} us/request (+{unmatched - baseline:.2f})")
+
+    policy = RULES[-1].policy_for("basic")
+    for label, limiter in (("redis lua", redis_limiter), ("in-process", local_limiter)):
+        batches, single = await drain_with_batches(limiter, args.batch_size)
+        print(
+            f"{label}: {batches} batches of {args.batch_size} admitted ({batches * args.batch_size} messages, "
+            f"Basic bucket {policy.capacity}), then 429; single message after: {single}"
+        )
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""CPU cost of serializing large read responses: Pydantic models vs direct orjson.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_serialization --rows 10000
+
+Two bodies of ``--rows`` rows each, each built in two ways:
+
+* messages -- ORM entities, then a ``MessageResponse`` per row validated
+  against ``response_model=MessagePage``. Compared with column rows from
+  ``fetch_message_page`` passed to ``message_page_json``.
+* chatroom list -- cached entries decoded and re-validated against
+  ``List[ChatroomResponse]``. Compared with ``chatroom_cache.list_payload``
+  splicing the cached bytes.
+
+Requests go in-process through a minimal FastAPI app, so routing and
+response rendering are included. The messages are read from an in-memory
+SQLite database.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=15)
+    return parser.parse_args()
+
+
+async def run(args):
+    import orjson
+    from fastapi import FastAPI, Response
+    from typing import List
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.future import select
+    from app.api.v1.chatroom import fetch_message_page, message_page_json
+    from app.core import chatroom_cache
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.models.user import Base, User
+    from app.schemas.chatroom import ChatroomResponse, MessagePage, MessageResponse
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    start = datetime(2024, 1, 1)
+    async with AsyncSession(engine) as session:
+        user = User(mobile_number="9000000000")
+        session.add(user)
+        await session.flush()
+        room = Chatroom(user_id=user.id, name="bench")
+        session.add(room)
+        await session.flush()
+        user_id, room_id = user.id, room.id
+        await session.execute(insert(Message), [
+            {
+                "chatroom_id": room_id,
+                "user_id": user_id,
+                "content": f"question {i} " * 8,
+                "gemini_response": f"answer {i} " * 40,
+                "created_at": start + timedelta(seconds=i),
+            }
+            for i in range(args.rows)
+        ])
+        await session.commit()
+
+    entries = [
+        orjson.dumps({
+            "id": i, "user_id": user_id, "name": f"room {i}", "cache_responses": True,
+            "created_at": start, "updated_at": start, "message_count": i,
+            "last_message_at": start + timedelta(seconds=i),
+        })
+        for i in range(args.rows)
+    ]
+
+    app = FastAPI()
+
+    @app.get("/pydantic/messages", response_model=MessagePage)
+    async def pydantic_messages():
+        async with AsyncSession(engine) as session:
+            result = await session.execute(
+                select(Message).where(Message.chatroom_id == room_id)
+                .order_by(Message.created_at.desc(), Message.id.desc()).limit(args.rows)
+            )
+            messages = list(reversed(result.scalars().all()))
+            return MessagePage(messages=[
+                MessageResponse(
+                    id=msg.id, user_id=msg.user_id, content=msg.content, gemini_response=msg.gemini_response,
+                    status=msg.status, error=msg.error, created_at=msg.created_at,
+                )
+                for msg in messages
+            ])
+
+    @app.get("/orjson/messages", response_model=MessagePage)
+    async def orjson_messages():
+        async with AsyncSession(engine) as session:
+            messages, next_cursor = await fetch_message_page(session, room_id, args.rows)
+            return Response(message_page_json(messages, next_cursor), media_type="application/json")
+
+    @app.get("/pydantic/chatrooms", response_model=List[ChatroomResponse])
+    async def pydantic_chatrooms():
+        return [orjson.loads(entry) for entry in entries]
+
+    @app.get("/orjson/chatrooms", response_model=List[ChatroomResponse])
+    async def orjson_chatrooms():
+        return Response(chatroom_cache.list_payload(entries), media_type="application/json")
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def request(path):
+        body = []
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        await app({
+            "type": "http", "http_version": "1.1", "method": "GET", "path": path, "raw_path": path.encode(),
+            "root_path": "", "scheme": "http", "query_string": b"", "headers": [], "client": ("bench", 1),
+            "server": ("bench", 80),
+        }, receive, send)
+        return b"".join(body)
+
+    async def measure(path):
+        await request(path)
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            body = await request(path)
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples), len(body)
+
+    print(f"{args.rows} rows, median of {args.repeat}")
+    print(f"{'response':<10} {'path':<9} {'ms':>9} {'bytes':>11} {'speedup':>8}")
+    for name in ("messages", "chatrooms"):
+        slow, slow_bytes = await measure(f"/pydantic/{name}")
+        fast, fast_bytes = await measure(f"/orjson/{name}")
+        print(f"{name:<10} {'pydantic':<9} {slow:>9.2f} {slow_bytes:>11}")
+        print(f"{name:<10} {'orjson':<9} {fast:>9.2f} {fast_bytes:>11} {slow / fast:>7.1f}x")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
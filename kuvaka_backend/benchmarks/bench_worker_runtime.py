@@ -0,0 +1,115 @@
+"""Tasks/sec of process_gemini_message: per-task asyncio.run vs persistent worker runtime.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_worker_runtime --tasks 500 --latency 0.005
+
+Runs against a local stub Gemini server and DATABASE_URL (defaults to a
+throwaway SQLite file; point it at Postgres for realistic connection costs).
+Tasks run one after another, as they do inside a single prefork child.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_gemini import StubGeminiServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stub = StubGeminiServer(latency=args.latency).start()
+    os.environ["GEMINI_API_URL"] = stub.url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    # Every task sends the same prompt; measure the worker, not the response cache
+    os.environ.setdefault("RESPONSE_CACHE_ENABLED", "0")
+    os.environ.setdefault(
+        "DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db"
+    )
+
+    import httpx
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.future import select
+    from app.models.user import Base, User
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.services import gemini
+    from app.core.worker_runtime import WorkerRuntime
+
+    database_url = os.environ["DATABASE_URL"]
+
+    async def seed():
+        engine = create_async_engine(database_url)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            user = User(mobile_number=f"9{int(time.time() * 1000) % 10**10:010d}")
+            session.add(user)
+            await session.flush()
+            room = Chatroom(user_id=user.id, name="bench")
+            session.add(room)
+            await session.flush()
+            msg = Message(chatroom_id=room.id, user_id=user.id, content="hi")
+            session.add(msg)
+            await session.flush()
+            message_id = msg.id
+            await session.commit()
+        await engine.dispose()
+        return message_id
+
+    message_id = asyncio.run(seed())
+
+    # The pre-runtime task body: new loop, new HTTP client, new engine per task
+    def legacy_task(message_id, user_message):
+        async def do_work():
+            async with httpx.AsyncClient() as client:
+                resp = await client.post(
+                    gemini.GEMINI_API_URL,
+                    headers={"x-goog-api-key": gemini.GEMINI_API_KEY},
+                    json={"contents": [{"role": "user", "parts": [{"text": user_message}]}]},
+                )
+                text = resp.json()["candidates"][0]["content"]["parts"][0]["text"]
+            engine = create_async_engine(database_url, echo=False)
+            async with AsyncSession(engine) as session:
+                result = await session.execute(select(Message).where(Message.id == message_id))
+                message = result.scalar_one_or_none()
+                message.gemini_response = text
+                await session.commit()
+            await engine.dispose()
+        asyncio.run(do_work())
+
+    runtime = WorkerRuntime()
+
+    def runtime_task(message_id, user_message):
+        runtime.run(gemini.handle_gemini_message(runtime, message_id, user_message))
+
+    results = {}
+    for name, task in (("asyncio.run per task", legacy_task), ("worker runtime", runtime_task)):
+        task(message_id, "warmup")
+        start_requests, start_conns = stub.requests, stub.connections
+        started = time.perf_counter()
+        for i in range(args.tasks):
+            task(message_id, f"hello {i}")
+        elapsed = time.perf_counter() - started
+        results[name] = args.tasks / elapsed
+        print(
+            f"{name:<24} {results[name]:8.1f} tasks/s  "
+            f"({stub.requests - start_requests} requests over "
+            f"{stub.connections - start_conns} TCP connections)"
+        )
+
+    runtime.close()
+    stub.stop()
+    baseline = results["asyncio.run per task"]
+    print(f"speedup: {results['worker runtime'] / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
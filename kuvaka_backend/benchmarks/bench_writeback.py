@@ -0,0 +1,101 @@
+"""Rows/sec for saving Gemini replies: per-message commits vs the write-back buffer.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.bench_writeback --messages 5000 --concurrency 200
+
+Seeds ``--messages`` pending messages and writes a reply to each with
+``--concurrency`` tasks in flight, first the old way (SELECT, set, COMMIT per
+message) and then through ``WriteBackBuffer`` at several batch sizes. Uses
+DATABASE_URL, defaulting to a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--batch-sizes", default="1,10,100,500")
+    parser.add_argument("--flush-ms", type=float, default=20)
+    return parser.parse_args()
+
+
+async def run(args):
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.future import select
+    from sqlalchemy.orm import sessionmaker
+    from app.models.user import Base, User
+    from app.models.chatroom import Chatroom
+    from app.models.message import Message
+    from app.services.writeback import WriteBackBuffer
+
+    engine = create_async_engine(os.environ["DATABASE_URL"])
+    Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with Session() as session:
+        user = User(mobile_number=str(time.time_ns())[-12:])
+        session.add(user)
+        await session.flush()
+        room = Chatroom(user_id=user.id, name="bench")
+        session.add(room)
+        await session.flush()
+        user_id, room_id = user.id, room.id
+        await session.commit()
+
+    async def seed():
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                insert(Message).returning(Message.id),
+                [
+                    {"chatroom_id": room_id, "user_id": user_id, "content": f"q{i}", "created_at": datetime.utcnow()}
+                    for i in range(args.messages)
+                ],
+            )
+            return [row[0] for row in result.all()]
+
+    async def drive(save):
+        ids = await seed()
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def one(message_id):
+            async with slots:
+                await save(message_id, f"reply to {message_id}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(message_id) for message_id in ids])
+        return args.messages / (time.perf_counter() - started)
+
+    async def per_message(message_id, reply):
+        # What handle_gemini_message did before: SELECT, set, COMMIT for every reply
+        async with Session() as session:
+            result = await session.execute(select(Message).where(Message.id == message_id))
+            message = result.scalar_one_or_none()
+            message.gemini_response = reply
+            await session.commit()
+
+    print(f"{'mode':<28} {'rows/sec':>10}")
+    baseline = await drive(per_message)
+    print(f"{'per-message commit':<28} {baseline:>10.0f}")
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        buffer = WriteBackBuffer(Session, batch_size=batch_size, flush_ms=args.flush_ms)
+        rate = await drive(buffer.submit)
+        await buffer.close()
+        print(f"{f'write-back batch={batch_size}':<28} {rate:>10.0f}  ({rate / baseline:.1f}x, {buffer.stats()['flushed_batches']} commits)")
+    await engine.dispose()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""End-to-end load test of the API against local stand-ins.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.load_suite --users 50 --concurrency 20 --output benchmarks/results/run.json
+    python -m benchmarks.load_suite --compare benchmarks/results/baseline.json
+
+Boots ``app.main.app`` in-process and drives it over ASGI. Each simulated
+user gets its own client address, so per-IP rate limits behave as in
+production. The dependencies are replaced as follows:
+
+* Gemini -- ``stub_gemini.StubGeminiServer`` with ``--gemini-latency``
+* Stripe -- webhooks are signed with a local ``STRIPE_WEBHOOK_SECRET``, so
+  the real verification path runs (Checkout itself is not exercised)
+* Postgres -- DATABASE_URL if set, otherwise a throwaway SQLite file
+* Redis -- REDIS_URL, or an in-process fakeredis with ``--fakeredis``
+* Celery -- an in-process outbox relay picks up queued tasks. With
+  ``--worker inline`` (default) it runs ``handle_gemini_message`` on the
+  same loop, the way the asyncio consumer does; ``--worker external``
+  publishes to the Redis broker for a real worker
+
+The scenarios run one after another: signup -> send-otp -> verify-otp,
+chatroom creation, Stripe upgrades for ``--pro-fraction`` of users, a message
+burst that runs into the Basic quota (429s are expected there), long-polls
+for a sample of replies, and history reads. For every endpoint the suite
+reports throughput, p50/p95/p99 latency and the number of SQL statements per
+request. ``--output`` writes this as JSON, and ``--compare`` flags endpoints
+whose p95 or throughput regressed by more than ``--tolerance``.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--rooms-per-user", type=int, default=2)
+    parser.add_argument("--messages-per-user", type=int, default=12, help="above the Basic quota to hit the 429 path")
+    parser.add_argument("--pro-fraction", type=float, default=0.2)
+    parser.add_argument("--wait-fraction", type=float, default=0.2, help="share of messages followed by a long-poll")
+    parser.add_argument("--history-reads", type=int, default=5, help="history reads per user")
+    parser.add_argument("--gemini-latency", type=float, default=0.2)
+    parser.add_argument("--worker", choices=["inline", "external", "none"], default="inline")
+    parser.add_argument("--fakeredis", action="store_true")
+    parser.add_argument("--bcrypt-rounds", type=int, help="overrides BCRYPT_ROUNDS (signup cost)")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+class Recorder:
+    """Latency, status codes and SQL statement counts per (method, route template)."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # endpoint -> [(started, seconds, status, statements)]
+        self.phases = []
+
+    def record(self, endpoint, started, seconds, status, statements):
+        self.samples[endpoint].append((started, seconds, status, statements))
+
+    def count(self) -> int:
+        return sum(len(samples) for samples in self.samples.values())
+
+    def phase(self, name, seconds, requests):
+        self.phases.append({"phase": name, "seconds": round(seconds, 3), "requests": requests})
+
+    def endpoints(self) -> dict:
+        report = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds * 1000 for _, seconds, _, _ in samples)
+            statuses = defaultdict(int)
+            for _, _, status, _ in samples:
+                statuses[str(status)] += 1
+            # Over the span this endpoint was actually being called
+            span = max(start + seconds for start, seconds, _, _ in samples) - min(start for start, *_ in samples)
+            report[endpoint] = {
+                "requests": len(samples),
+                "throughput_rps": round(len(samples) / span, 2) if span else 0.0,
+                "p50_ms": round(percentile(latencies, 50), 3),
+                "p95_ms": round(percentile(latencies, 95), 3),
+                "p99_ms": round(percentile(latencies, 99), 3),
+                "db_queries_per_request": round(sum(s for *_, s in samples) / len(samples), 2),
+                "status": dict(statuses),
+            }
+        return report
+
+
+_statements = contextvars.ContextVar("statements", default=None)
+
+
+class CountingMiddleware:
+    """Counts SQL statements per request; the suite's own equivalent of a DB-side query log."""
+
+    def __init__(self, app, recorder: Recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        from app.core.instrumentation import route_template
+
+        counter = [0]
+        token = _statements.set(counter)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _statements.reset(token)
+            self.recorder.record(
+                f"{scope['method']} {route_template(scope)}", started, time.perf_counter() - started, status, counter[0]
+            )
+
+
+def stripe_signature(payload: bytes, secret: str) -> str:
+    timestamp = int(time.time())
+    signed = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signed}"
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+async def run(args, stub):
+    import httpx
+    from sqlalchemy import event
+    from app.db.session import engine
+    from app.main import app
+    from app.models.user import Base
+    from app.db.session import AsyncSessionLocal
+    from app.services.gemini import handle_gemini_message
+    from app.services.outbox import OutboxRelay, publish_in_thread
+    from app.core.worker_runtime import WorkerRuntime
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_statement(*_):
+        counter = _statements.get()
+        if counter is not None:
+            counter[0] += 1
+
+    recorder = Recorder()
+    asgi = CountingMiddleware(app, recorder)
+    loop = asyncio.get_running_loop()
+    runtime = None
+    replies = []
+    worker_tasks = set()
+
+    async def run_inline(events):
+        for event in events:
+            message_id, content, chatroom_id = event.args
+            queued = time.perf_counter()
+
+            async def work(message_id=message_id, content=content, chatroom_id=chatroom_id, queued=queued):
+                await handle_gemini_message(runtime, message_id, content, chatroom_id)
+                replies.append(time.perf_counter() - queued)
+
+            # A fresh context, so the worker's SQL isn't counted against the request that queued it
+            task = loop.create_task(work(), context=contextvars.Context())
+            worker_tasks.add(task)
+            task.add_done_callback(worker_tasks.discard)
+
+    async def discard(events):
+        pass
+
+    # Sends commit outbox events; an in-process relay hands them to the chosen worker
+    if args.worker == "inline":
+        runtime = WorkerRuntime(loop=loop, max_connections=args.concurrency * 4)
+        relay = OutboxRelay(AsyncSessionLocal, publish=run_inline)
+    else:
+        relay = OutboxRelay(AsyncSessionLocal, publish=publish_in_thread if args.worker == "external" else discard)
+    relay_task = loop.create_task(relay.run(), context=contextvars.Context())
+
+    slots = asyncio.Semaphore(args.concurrency)
+    run_id = str(time.time_ns())[-6:]
+    clients = [
+        httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=asgi, client=(f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}", 40000)),
+            base_url="http://bench",
+        )
+        for i in range(args.users)
+    ]
+    users = [{"client": client, "mobile": f"9{run_id}{i:08d}"} for i, client in enumerate(clients)]
+
+    async def phase(name, coros):
+        async def limited(coro):
+            async with slots:
+                return await coro
+
+        before = recorder.count()
+        started = time.perf_counter()
+        results = await asyncio.gather(*[limited(coro) for coro in coros])
+        recorder.phase(name, time.perf_counter() - started, recorder.count() - before)
+        return results
+
+    async def onboard(user):
+        client = user["client"]
+        await client.post("/auth/signup", json={"mobile_number": user["mobile"], "password": "bench-password"})
+        otp = (await client.post("/auth/send-otp", json={"mobile_number": user["mobile"]})).json()["otp"]
+        token = (await client.post("/auth/verify-otp", json={"mobile_number": user["mobile"], "otp": otp})).json()
+        user["headers"] = {"Authorization": f"Bearer {token['access_token']}"}
+
+    async def create_rooms(user):
+        user["rooms"] = []
+        for n in range(args.rooms_per_user):
+            response = await user["client"].post("/chatroom", json={"name": f"room {n}"}, headers=user["headers"])
+            user["rooms"].append(response.json()["id"])
+
+    async def upgrade(user):
+        me = (await user["client"].get("/user/me", headers=user["headers"])).json()
+        payload = json.dumps({
+            "id": f"evt_{me['id']}", "object": "event", "type": "checkout.session.completed",
+            "data": {"object": {"object": "checkout.session", "metadata": {"user_id": str(me["id"])}}},
+        }).encode()
+        await user["client"].post(
+            "/webhook/stripe", content=payload,
+            headers={"stripe-signature": stripe_signature(payload, os.environ["STRIPE_WEBHOOK_SECRET"])},
+        )
+
+    async def burst(user, index):
+        room = user["rooms"][index % len(user["rooms"])]
+        response = await user["client"].post(
+            f"/chatroom/{room}/message", json={"content": f"question {index} from {user['mobile']}"},
+            headers=user["headers"],
+        )
+        if response.status_code == 200 and (index * args.wait_fraction) % 1 + args.wait_fraction >= 1:
+            await user["client"].get(f"/message/{response.json()['id']}/wait", headers=user["headers"])
+
+    async def read_history(user, index):
+        room = user["rooms"][index % len(user["rooms"])]
+        await user["client"].get("/chatroom", headers=user["headers"])
+        await user["client"].get(f"/chatroom/{room}", headers=user["headers"])
+        page = (await user["client"].get(f"/chatroom/{room}/messages?limit=20", headers=user["headers"])).json()
+        if page.get("next_cursor"):
+            await user["client"].get(
+                f"/chatroom/{room}/messages?limit=20&before={page['next_cursor']}", headers=user["headers"]
+            )
+
+    started = time.perf_counter()
+    await phase("onboarding", [onboard(user) for user in users])
+    await phase("chatrooms", [create_rooms(user) for user in users])
+    await phase("stripe upgrades", [upgrade(user) for user in users[: int(len(users) * args.pro_fraction)]])
+    await phase("message burst", [burst(user, i) for i in range(args.messages_per_user) for user in users])
+    drain_started = time.perf_counter()
+    relay.stop()
+    await relay_task
+    await relay.drain()
+    while worker_tasks:
+        await asyncio.gather(*list(worker_tasks), return_exceptions=True)
+    drain = time.perf_counter() - drain_started
+    await phase("history reads", [read_history(user, i) for i in range(args.history_reads) for user in users])
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        await client.aclose()
+    if runtime is not None:
+        await runtime.aclose()
+
+    ordered = sorted(seconds * 1000 for seconds in replies)
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git": git_revision(),
+            "database": engine.url.get_backend_name(),
+            "redis": "fakeredis" if args.fakeredis else os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "phases": recorder.phases,
+        "gemini_replies": {
+            "count": len(ordered),
+            "drain_seconds": round(drain, 3),
+            "p50_ms": round(percentile(ordered, 50), 3),
+            "p95_ms": round(percentile(ordered, 95), 3),
+            "p99_ms": round(percentile(ordered, 99), 3),
+            "stub_requests": stub.requests,
+        },
+        "endpoints": recorder.endpoints(),
+    }
+
+
+def print_report(results):
+    print(f"{'endpoint':<42} {'reqs':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8}  status")
+    for endpoint, row in results["endpoints"].items():
+        statuses = " ".join(f"{code}:{count}" for code, count in sorted(row["status"].items()))
+        print(
+            f"{endpoint:<42} {row['requests']:>6} {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.1f} "
+            f"{row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['db_queries_per_request']:>8.1f}  {statuses}"
+        )
+    print()
+    for phase in results["phases"]:
+        print(f"{phase['phase']:<18} {phase['requests']:>6} requests in {phase['seconds']:>7.2f}s")
+    replies = results["gemini_replies"]
+    print(
+        f"gemini replies     {replies['count']:>6} saved, p50 {replies['p50_ms']:.0f} ms, "
+        f"p95 {replies['p95_ms']:.0f} ms, drained {replies['drain_seconds']:.2f}s after the burst"
+    )
+
+
+def compare(results, baseline, tolerance) -> bool:
+    """Print per-endpoint deltas against ``baseline``; True if anything regressed."""
+    regressed = False
+    print(f"\n{'endpoint':<42} {'p95 base':>9} {'p95 now':>9} {'rps base':>9} {'rps now':>9}")
+    for endpoint, row in results["endpoints"].items():
+        base = baseline["endpoints"].get(endpoint)
+        if base is None:
+            continue
+        slower = row["p95_ms"] > base["p95_ms"] * (1 + tolerance)
+        fewer = row["throughput_rps"] < base["throughput_rps"] * (1 - tolerance)
+        flag = "  REGRESSION" if slower or fewer else ""
+        regressed = regressed or bool(flag)
+        print(
+            f"{endpoint:<42} {base['p95_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+            f"{base['throughput_rps']:>9.1f} {row['throughput_rps']:>9.1f}{flag}"
+        )
+    return regressed
+
+
+def main():
+    args = parse_args()
+    from benchmarks.stub_gemini import StubGeminiServer
+
+    stub = StubGeminiServer(latency=args.gemini_latency).start()
+    os.environ["GEMINI_API_URL"] = stub.url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("STRIPE_WEBHOOK_SECRET", "whsec_bench")
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    if args.fakeredis:
+        import fakeredis
+        import redis.asyncio
+
+        server = fakeredis.FakeServer()
+        redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+    try:
+        results = asyncio.run(run(args, stub))
+    finally:
+        stub.stop()
+    print_report(results)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        print(f"\nresults written to {args.output}")
+    if args.compare and compare(results, json.loads(Path(args.compare).read_text()), args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
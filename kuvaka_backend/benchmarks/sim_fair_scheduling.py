@@ -0,0 +1,167 @@
+"""Queue wait under a noisy neighbour: one FIFO queue vs tier queues vs tier queues + fair share.
+
+Usage (from kuvaka_backend/):
+    python -m benchmarks.sim_fair_scheduling --workers 50 --burst 3000
+
+A discrete-event simulation, so it needs no broker or database and runs in
+seconds. ``--workers`` worker slots each take ``--service`` seconds per
+task on average. Light users (``--pro-users`` Pro and ``--basic-users``
+Basic) send messages at random, together loading the workers to
+``--light-load``. At ``--burst-at`` one Basic user sends ``--burst``
+messages through the batch endpoint. Three setups are compared:
+
+* fifo -- every task in one ``gemini`` queue in commit order (before)
+* tiers -- one queue per tier, FIFO within it; workers take from the
+  queues in turn, as kombu does when a worker consumes several
+* tiers + fair share -- the same queues, but the outbox relay tops each up
+  to ``--queue-target`` messages every ``--poll`` seconds and picks users by
+  ``DeficitRoundRobin`` (the code the relay runs)
+
+Wait is measured from commit to the start of the Gemini call, as
+``gemini_queue_wait_seconds`` reports it.
+"""
+import argparse
+import heapq
+import itertools
+import os
+import random
+from collections import deque
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--service", type=float, default=1.0, help="mean seconds per Gemini call")
+    parser.add_argument("--pro-users", type=int, default=50)
+    parser.add_argument("--basic-users", type=int, default=250)
+    parser.add_argument("--light-load", type=float, default=0.5, help="worker utilisation from light users")
+    parser.add_argument("--burst", type=int, default=3000, help="messages from the noisy neighbour")
+    parser.add_argument("--burst-at", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=180.0, help="seconds of light traffic")
+    parser.add_argument("--queue-target", type=int, default=None)
+    parser.add_argument("--poll", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args()
+
+
+class Task:
+    __slots__ = ("user", "tier", "cost", "committed", "started")
+
+    def __init__(self, user, tier, cost, committed):
+        self.user = user
+        self.tier = tier
+        self.cost = cost
+        self.committed = committed
+        self.started = None
+
+
+def workload(args, task_cost):
+    rng = random.Random(args.seed)
+    tasks = []
+    users = [(f"pro-{i}", "pro") for i in range(args.pro_users)]
+    users += [(f"basic-{i}", "basic") for i in range(args.basic_users)]
+    rate = args.light_load * args.workers / args.service / len(users)
+    for user, tier in users:
+        at = rng.expovariate(rate)
+        while at < args.duration:
+            prompt = "x" * rng.randint(20, 400)
+            tasks.append(Task(user, tier, task_cost([0, prompt]), at))
+            at += rng.expovariate(rate)
+    # The batch endpoint takes 100 messages a request; the neighbour sends them as fast as it can
+    for i in range(args.burst):
+        tasks.append(Task("noisy", "basic", task_cost([0, "x" * 200]), args.burst_at + (i // 100) * 0.05))
+    tasks.sort(key=lambda task: task.committed)
+    return tasks, random.Random(args.seed + 1)
+
+
+def simulate(args, setup, tasks, rng, DeficitRoundRobin, queue_target):
+    queues = {"fifo": ["gemini"], "tiers": ["pro", "basic"], "fair": ["pro", "basic"]}[setup]
+    broker = {name: deque() for name in queues}
+    outbox = {}  # user -> deque of tasks not yet published (fair only)
+    rounds = {"pro": DeficitRoundRobin(), "basic": DeficitRoundRobin()}
+    events = []
+    seq = itertools.count()
+    for task in tasks:
+        heapq.heappush(events, (task.committed, next(seq), "commit", task))
+    if setup == "fair":
+        heapq.heappush(events, (0.0, next(seq), "relay", None))
+    idle = args.workers
+    turn = 0
+    finished = 0
+
+    def take():
+        nonlocal turn
+        for offset in range(len(queues)):
+            name = queues[(turn + offset) % len(queues)]
+            if broker[name]:
+                turn = (turn + offset + 1) % len(queues)
+                return broker[name].popleft()
+        return None
+
+    def relay():
+        for tier in ("pro", "basic"):
+            room = queue_target - len(broker[tier])
+            backlogs = {
+                user: [(task, task.cost) for task in itertools.islice(pending, 20)]
+                for user, pending in outbox.items() if pending and pending[0].tier == tier
+            }
+            if room > 0 and backlogs:
+                for task in rounds[tier].schedule(backlogs, room):
+                    outbox[task.user].popleft()
+                    broker[tier].append(task)
+
+    while events:
+        now, _, kind, task = heapq.heappop(events)
+        if kind == "commit":
+            if setup == "fair":
+                outbox.setdefault(task.user, deque()).append(task)
+            else:
+                broker["gemini" if setup == "fifo" else task.tier].append(task)
+        elif kind == "done":
+            idle += 1
+            finished += 1
+        elif kind == "relay":
+            relay()
+            if finished < len(tasks):
+                heapq.heappush(events, (now + args.poll, next(seq), "relay", None))
+        while idle:
+            task = take()
+            if task is None:
+                break
+            idle -= 1
+            task.started = now
+            heapq.heappush(events, (now + rng.expovariate(1 / args.service), next(seq), "done", task))
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+    from app.services.scheduler import SCHEDULER_QUEUE_TARGET, DeficitRoundRobin, task_cost
+
+    queue_target = args.queue_target or SCHEDULER_QUEUE_TARGET
+    print(
+        f"{args.workers} workers, {args.service:.1f} s per call, light load {args.light_load:.0%}, "
+        f"noisy neighbour sends {args.burst} at t={args.burst_at:.0f}s, queue target {queue_target}"
+    )
+    print(f"{'setup':<20} {'group':<12} {'tasks':>6} {'p50 s':>8} {'p99 s':>8} {'max s':>8}")
+    for setup, label in (("fifo", "fifo"), ("tiers", "tiers"), ("fair", "tiers + fair share")):
+        tasks, rng = workload(args, task_cost)
+        simulate(args, setup, tasks, rng, DeficitRoundRobin, queue_target)
+        groups = {"light pro": [], "light basic": [], "noisy": []}
+        for task in tasks:
+            group = "noisy" if task.user == "noisy" else f"light {task.tier}"
+            groups[group].append(task.started - task.committed)
+        for group, waits in groups.items():
+            print(
+                f"{label:<20} {group:<12} {len(waits):>6} {percentile(waits, 0.5):>8.2f} "
+                f"{percentile(waits, 0.99):>8.2f} {max(waits):>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
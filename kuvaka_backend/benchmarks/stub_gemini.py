@@ -0,0 +1,221 @@
+"""Local stand-in for the Gemini generateContent endpoint.
+
+Speaks just enough HTTP/1.1 (keep-alive, Content-Length bodies) to be driven by
+httpx. ``:streamGenerateContent`` paths answer with a chunked SSE stream that
+emits the reply word by word. Run standalone with
+``python -m benchmarks.stub_gemini --port 8089`` or start it in a background
+thread via ``StubGeminiServer(...).start()``.
+
+Fault injection, for exercising retries, the circuit breaker and the AIMD
+limiter: ``fault_rate`` answers that fraction of requests with
+``fault_status``; ``capacity`` answers 429 while more than that many
+requests are in flight; ``key_rate`` answers 429 to an API key that has
+already made that many requests in the current second (``requests_by_key``
+counts them); ``outage = True`` fails everything. Error responses carry
+``Retry-After: retry_after`` when it is set.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+
+class StubGeminiServer:
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0.0,
+        fault_rate=0.0, fault_status=503, capacity=None, retry_after=None, seed=None, key_rate=None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_status = fault_status
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.key_rate = key_rate
+        self.outage = False
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self.faults = 0
+        self.throttled = 0
+        self.requests_by_key = Counter()
+        self._key_window = (0, Counter())
+        self.active = 0
+        self.peak_active = 0
+        self._loop = None
+        self._server = None
+        self._stopping = None
+        self._handlers = set()
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/v1beta/models/stub:generateContent"
+
+    def build_reply(self, payload):
+        try:
+            text = payload["contents"][-1]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            text = ""
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": f"echo: {text}"}]}}]}
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                self.requests += 1
+                api_key = headers.get("x-goog-api-key", "")
+                self.requests_by_key[api_key] += 1
+                self.active += 1
+                self.peak_active = max(self.peak_active, self.active)
+                try:
+                    fault = self._fault(api_key)
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    if fault:
+                        await self._error_reply(writer, fault)
+                        continue
+                    payload = json.loads(body or b"{}")
+                    if b":streamGenerateContent" in request_line:
+                        await self._stream_reply(writer, payload)
+                        continue
+                    data = json.dumps(self.build_reply(payload)).encode()
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                        + f"Content-Length: {len(data)}\r\n\r\n".encode()
+                        + data
+                    )
+                    await writer.drain()
+                finally:
+                    self.active -= 1
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # stop() ending a kept-alive connection; returning quietly keeps asyncio from logging it
+            pass
+        finally:
+            self._handlers.discard(handler)
+            writer.close()
+
+    def _fault(self, api_key=""):
+        if self.outage:
+            self.faults += 1
+            return self.fault_status
+        if self.key_rate is not None:
+            second = int(time.time())
+            if self._key_window[0] != second:
+                self._key_window = (second, Counter())
+            counts = self._key_window[1]
+            counts[api_key] += 1
+            if counts[api_key] > self.key_rate:
+                self.throttled += 1
+                return 429
+        if self.capacity is not None and self.active > self.capacity:
+            self.throttled += 1
+            return 429
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.faults += 1
+            return self.fault_status
+        return None
+
+    async def _error_reply(self, writer, status):
+        data = json.dumps({"error": {"code": status, "message": "injected fault", "status": "UNAVAILABLE"}}).encode()
+        extra = f"Retry-After: {self.retry_after}\r\n" if self.retry_after is not None else ""
+        writer.write(
+            f"HTTP/1.1 {status} Error\r\nContent-Type: application/json\r\n{extra}"
+            f"Content-Length: {len(data)}\r\n\r\n".encode()
+            + data
+        )
+        await writer.drain()
+
+    async def _stream_reply(self, writer, payload):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        text = self.build_reply(payload)["candidates"][0]["content"]["parts"][0]["text"]
+        for word in text.split(" "):
+            event = {"candidates": [{"content": {"role": "model", "parts": [{"text": word + " "}]}}]}
+            frame = f"data: {json.dumps(event)}\r\n\r\n".encode()
+            writer.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def serve(self):
+        self._stopping = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            # Keep-alive connections outlive the listener; end their handlers before the loop goes
+            self._server.close()
+            handlers = list(self._handlers)
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    def start(self):
+        def runner():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.serve())
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=runner, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._thread and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Gemini generateContent server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--fault-status", type=int, default=503)
+    parser.add_argument("--capacity", type=int, default=None, help="answer 429 above this many concurrent requests")
+    parser.add_argument("--retry-after", default=None, help="Retry-After header value on errors")
+    parser.add_argument("--key-rate", type=int, default=None, help="answer 429 above this many requests/s per API key")
+    args = parser.parse_args()
+    server = StubGeminiServer(
+        args.host, args.port, args.latency,
+        fault_rate=args.fault_rate, fault_status=args.fault_status,
+        capacity=args.capacity, retry_after=args.retry_after, key_rate=args.key_rate,
+    )
+    print(f"Stub Gemini listening on {server.url}")
+    asyncio.run(server.serve())
+
+
+if __name__ == "__main__":
+    main()